@@ -22,11 +22,9 @@ def setExptParams():
 
 def compileAll(db,prog,modeSet,queries):
     start = time.time()
-    k = 0
-    for mode in modeSet:
-        if prog.findPredDef(mode):
-            k += 1
-            fun = prog.compile(mode)
+    defined = [mode for mode in modeSet if prog.findPredDef(mode)]
+    k = len(defined)
+    prog.compileAll(defined)
     fps = k/(time.time() - start)
     print("compiled",k,"of",len(modeSet),"functions at",fps,"fps")
     return fps
@@ -102,6 +100,9 @@ def runCross():
         ]:
         CROSSCOMPILERS.append(c)
         CROSSLEARNERS[c]=tensorflowxcomp.FixedRateGDLearner
+    from tensorlog import scipyxcomp
+    CROSSCOMPILERS.append(scipyxcomp.SciPyCrossCompiler)
+    CROSSLEARNERS[scipyxcomp.SciPyCrossCompiler]=scipyxcomp.FixedRateGDLearner
     results = {}
     for compilerClass in CROSSCOMPILERS:
         xc = compilerClass(prog)
@@ -1,5 +1,7 @@
 import logging
 import os
+import sys
+import time
 
 from tensorlog import masterconfig
 from tensorlog import expt
@@ -43,7 +45,32 @@ def runMain(num=250):
     params = setExptParams(num)
     return expt.Expt(params).run()
 
+def runSampledSoftmaxComparison(num=250,numSamples=20,epochs=10):
+    """ Compare learning with the full softmax to learning with a
+    softmax over the gold answers plus numSamples sampled answers. """
+    if not os.path.exists("tmp-cache"): os.mkdir("tmp-cache")
+    masterconfig.masterConfig().matrixdb.allow_weighted_tuples=False
+    result = {}
+    for name in ['full','sampled']:
+        params = setExptParams(num)
+        prog = params['prog']
+        if name=='full':
+            params['learner'] = learn.FixedRateSGDLearner(prog,regularizer=learn.L2Regularizer(),epochs=epochs)
+        else:
+            params['learner'] = learn.SampledSoftmaxSGDLearner(
+                prog,regularizer=learn.L2Regularizer(),epochs=epochs,numSamples=numSamples)
+        params['savedModel'] = 'learned-model.%s.db' % name
+        start = time.time()
+        acc,loss = expt.Expt(params).run()
+        result[name] = (acc,loss,time.time()-start)
+    for name,(acc,loss,elapsed) in sorted(result.items()):
+        print('%s softmax: acc %.3f loss %.3f time %.2f sec' % (name,acc,loss,elapsed))
+    return result
+
 if __name__=="__main__":
+  if len(sys.argv)>1 and sys.argv[1]=='sampled':
+    runSampledSoftmaxComparison(*[int(a) for a in sys.argv[2:]])
+    sys.exit(0)
   acc,loss = runMain() # expect 0.21,0.22
   print('acc,loss',acc,loss)
   params = setExptParams(250)
@@ -5,12 +5,16 @@ import tensorflow as tf
 from tensorlog import simple
 import expt
 
-def runMain(num=250):
+def runMain(num=250,pipeline=False):
   params = expt.setExptParams(num)
   prog = params['prog']
   tlog = simple.Compiler(db=prog.db, prog=prog, autoset_db_params=False)
   train_data = tlog.load_big_dataset('inputs/train-%d.exam' % num)
   mode = params['targetMode']
+  epochs = 10
+  if pipeline:
+    # minibatches are read by tensorflow from a tf.data pipeline, not fed
+    tlog.input_pipeline(mode,train_data,batch_size=125,epochs=epochs)
 
   loss = tlog.loss(mode)
   optimizer = tf.train.AdagradOptimizer(0.1)
@@ -19,15 +23,22 @@ def runMain(num=250):
   session = tf.Session()
   session.run(tf.global_variables_initializer())
   t0 = time.time()
-  epochs = 10
-  for i in range(epochs):
+  if pipeline:
+    try:
+      while True: session.run(train_step)
+    except tf.errors.OutOfRangeError:
+      pass
+  else:
+    for i in range(epochs):
       b = 0
       for (_,(TX,TY)) in tlog.minibatches(train_data,batch_size=125):
           print('epoch',i+1,'of',epochs,'minibatch',b+1)
           train_fd = {tlog.input_placeholder_name(mode):TX, tlog.target_output_placeholder_name(mode):TY}
           session.run(train_step, feed_dict=train_fd)
           b += 1
-  print('learning time',time.time()-t0,'sec')
+  learningTime = time.time()-t0
+  print('learning time',learningTime,'sec')
+  print('examples/sec',epochs*train_data.getX(mode).shape[0]/learningTime)
 
   predicted_y = tlog.inference(mode)
   actual_y = tlog.target_output_placeholder(mode)
@@ -42,7 +53,8 @@ def runMain(num=250):
   return acc #expect 27.2
 
 if __name__== "__main__":
-  runMain()
+  import sys
+  runMain(pipeline=('pipeline' in sys.argv[1:]))
 
   
 
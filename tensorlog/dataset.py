@@ -20,6 +20,12 @@ from tensorlog import util
 conf = config.Config()
 conf.normalize_outputs = True;  conf.help.normalize_outputs =  "In .exam files, l1-normalize the weights of valid outputs"
 
+# name of the index file in a sharded dataset directory
+SHARD_INDEX = 'shards.txt'
+
+# matches foo(x,y) in a ProPPR .examples file
+PROPPR_GOAL_REGEX = re.compile(r'(\w+)\((\w+),(\w+)\)')
+
 #
 # dealing with labeled training data
 #
@@ -31,6 +37,9 @@ class Dataset(object):
         self.xDict = xDict
         # likewise for Y matrices
         self.yDict = yDict
+        # directory the data is memory-mapped from, for a dataset
+        # deserialized from a sharded directory
+        self.shardDir = None
 
     def isSinglePredicate(self):
         """Returns true if all the examples are for a single predicate."""
@@ -91,6 +100,28 @@ class Dataset(object):
             currentOffset[modeIndex] += batchSize
             yield mode,bX,bY
 
+    def minibatchRowIterator(self,batchSize=100,shuffleFirst=True):
+        """Like minibatchIterator, but iterate over pairs (mode,rows)
+        where rows is an array of row numbers in the full data for mode.
+        The data itself is not copied or shuffled, so this is
+        appropriate for large datasets, or for memory-mapped ones."""
+        batches = []
+        for mode in self.modesToLearn():
+            rowNums = NP.arange(mutil.numRows(self.getX(mode)),dtype='int32')
+            if shuffleFirst: NR.shuffle(rowNums)
+            for lo in range(0,len(rowNums),batchSize):
+                batches.append((mode,rowNums[lo:lo+batchSize]))
+        if shuffleFirst:
+            order = NP.arange(len(batches))
+            NR.shuffle(order)
+            batches = [batches[j] for j in order]
+        return iter(batches)
+
+    def getRows(self,mode,rows):
+        """Return the pair X',Y' of submatrices of X and Y for the mode
+        which contain the given rows."""
+        return self.getX(mode)[rows],self.getY(mode)[rows]
+
     def pprint(self):
         return ['%s: X %s Y %s' % (str(mode),mutil.pprintSummary(self.xDict[mode]),mutil.pprintSummary(self.yDict[mode])) for mode in self.xDict]
 
@@ -98,10 +129,20 @@ class Dataset(object):
     # i/o and conversions
     #
 
-    def serialize(self,dir):
-        """Save the dataset on disk."""
+    def serialize(self,dir,sharded=False):
+        """Save the dataset on disk.  If sharded is true, the X and Y
+        matrices for each mode are saved as separate numpy arrays,
+        which deserialize will memory-map, so that processes can share
+        one copy of the data."""
         if not os.path.exists(dir):
             os.mkdir(dir)
+        if sharded:
+            with open(os.path.join(dir,SHARD_INDEX),'w') as fp:
+                for k,mode in enumerate(self.modesToLearn()):
+                    fp.write('%d\t%s\n' % (k,str(mode)))
+                    _saveCSR(os.path.join(dir,'%d.x' % k),self.xDict[mode])
+                    _saveCSR(os.path.join(dir,'%d.y' % k),self.yDict[mode])
+            return
         dx = dict([(str(k_v[0]),k_v[1]) for k_v in list(self.xDict.items())])
         dy = dict([(str(k_v[0]),k_v[1]) for k_v in list(self.yDict.items())])
         SIO.savemat(os.path.join(dir,"xDict"),dx,do_compression=True)
@@ -111,6 +152,8 @@ class Dataset(object):
     def deserialize(dir):
         """Recover a saved dataset."""
         logging.info('deserializing dataset file '+ dir)
+        if os.path.exists(os.path.join(dir,SHARD_INDEX)):
+            return Dataset._deserializeShards(dir)
         xDict = {}
         yDict = {}
         SIO.loadmat(os.path.join(dir,"xDict"),xDict)
@@ -121,38 +164,53 @@ class Dataset(object):
             for stringKey,mat in list(d.items()):
                 del d[stringKey]
                 if not stringKey.startswith('__'):
-                   d[declare.asMode(stringKey)] = SS.csr_matrix(mat)
+                   m = SS.csr_matrix(mat)
+                   d[declare.asMode(stringKey)] = mutil.csrMatrix(m.data,m.indices,m.indptr,m.shape)
         dset = Dataset(xDict,yDict)
         logging.info('deserialized dataset has %d modes and %d non-zeros' % (len(dset.modesToLearn()), dset.size()))
         return dset
 
+    @staticmethod
+    def _deserializeShards(dir):
+        xDict = {}
+        yDict = {}
+        for line in util.linesIn(os.path.join(dir,SHARD_INDEX)):
+            k,modeString = line.strip().split('\t')
+            mode = declare.asMode(modeString)
+            xDict[mode] = _loadCSR(os.path.join(dir,'%s.x' % k))
+            yDict[mode] = _loadCSR(os.path.join(dir,'%s.y' % k))
+        dset = Dataset(xDict,yDict)
+        dset.shardDir = os.path.abspath(dir)
+        logging.info('memory-mapped dataset has %d modes and %d non-zeros' % (len(dset.modesToLearn()), dset.size()))
+        return dset
 
     @staticmethod
-    def uncacheExamples(dsetFile,db,exampleFile,proppr=True):
+    def uncacheExamples(dsetFile,db,exampleFile,proppr=True,sharded=False):
         """Build a dataset file from an examples file, serialize it, and
         return the de-serialized dataset.  Or if that's not necessary,
-        just deserialize it.
+        just deserialize it.  If sharded is true the dataset is
+        serialized as shards that can be memory-mapped.
         """
         if not os.path.exists(dsetFile) or os.path.getmtime(exampleFile)>os.path.getmtime(dsetFile):
             logging.info('serializing examples in %s to %s' % (exampleFile,dsetFile))
             dset = Dataset.loadExamples(db,exampleFile,proppr=proppr)
-            dset.serialize(dsetFile)
+            dset.serialize(dsetFile,sharded=sharded)
             os.utime(dsetFile,None) #update the modification time for the directory
             return dset
         else:
             return Dataset.deserialize(dsetFile)
 
     @staticmethod
-    def uncacheMatrix(dsetFile,db,functorToLearn,functorInDB):
+    def uncacheMatrix(dsetFile,db,functorToLearn,functorInDB,sharded=False):
         """Build a dataset file from a DB matrix as specified with loadMatrix
         and serialize it.  Or if that's not necessary, just
-        deserialize it.
+        deserialize it.  Sharded is as in uncacheExamples.
         """
         if not os.path.exists(dsetFile):
             print(('preparing examples from',functorToLearn,'...'))
             dset = Dataset.loadMatrix(db,functorToLearn,functorInDB)
             print(('serializing dsetFile',dsetFile,'...'))
-            dset.serialize(dsetFile)
+            dset.serialize(dsetFile,sharded=sharded)
             return dset
         else:
             print(('de-serializing dsetFile',dsetFile,'...'))
@@ -170,7 +228,7 @@ class Dataset(object):
         functorToLearn = declare.asMode(functorToLearn)
         xrows = []
         yrows = []
-        m = db.matEncoding[(functorInDB,2)].tocoo()
+        m = db.matrix(declare.asMode('%s(i,o)' % functorInDB)).tocoo()
         n = db.dim()
         for i in range(len(m.data)):
             x = m.row[i]
@@ -189,7 +247,7 @@ class Dataset(object):
             assert len(parts)>=2, 'bad line: %r parts %r' % (line,parts)
             return declare.asMode(parts[0]+"/io"),parts[1],parts[2:]
         else:
-            regex = re.compile('(\w+)\((\w+),(\w+)\)')
+            regex = PROPPR_GOAL_REGEX
             mx = regex.search(parts[0])
             if not mx:
                 return None,None,None
@@ -207,6 +265,22 @@ class Dataset(object):
                         pos.append(my.group(3))
                 return mode,x,pos
 
+    @staticmethod
+    def _readExamples(db,fileName,proppr):
+        """Iterate over the examples in a file, as triples (mode,x,ys)
+        where x is the id of the input and ys is a list of ids of the
+        outputs.  Symbols not in the database are mapped to the id of
+        matrixdb.OOV_ENTITY_NAME."""
+        def getId(typeName,symbol):
+          s = symbol if db.schema.hasId(typeName,symbol) else matrixdb.OOV_ENTITY_NAME
+          return db.schema.getId(typeName,s)
+        for line in util.linesIn(fileName):
+          pred,x,ys = Dataset._parseLine(line,proppr=proppr)
+          if pred:
+            xType = db.schema.getDomain(pred.getFunctor(),2)
+            yType = db.schema.getRange(pred.getFunctor(),2)
+            yield pred,getId(xType,x),[getId(yType,y) for y in ys]
+
     @staticmethod
     def loadProPPRExamples(db,fileName):
         """Convert a proppr-style foo.examples file to a two dictionaries of
@@ -235,22 +309,15 @@ class Dataset(object):
         yColbuf = collections.defaultdict(list)
         xsResult = {}
         ysResult = {}
-        def getId(typeName,symbol):
-          s = symbol if db.schema.hasId(typeName,symbol) else matrixdb.OOV_ENTITY_NAME
-          return db.schema.getId(typeName,s)
-        for line in util.linesIn(fileName):
-          pred,x,ys = Dataset._parseLine(line,proppr=proppr)
-          if pred:
-            xType = db.schema.getDomain(pred.getFunctor(),2)
-            yType = db.schema.getRange(pred.getFunctor(),2)
+        for pred,xId,yIds in Dataset._readExamples(db,fileName,proppr):
             row_index = len(xDatabuf[pred])
             xDatabuf[pred].append(1.0)
             xRowbuf[pred].append(row_index)
-            xColbuf[pred].append(getId(xType,x))
-            for y in ys:
-              yDatabuf[pred].append( 1.0/len(ys) if conf.normalize_outputs else 1.0)
+            xColbuf[pred].append(xId)
+            for yId in yIds:
+              yDatabuf[pred].append( 1.0/len(yIds) if conf.normalize_outputs else 1.0)
               yRowbuf[pred].append(row_index)
-              yColbuf[pred].append(getId(yType,y))
+              yColbuf[pred].append(yId)
         for pred in list(xDatabuf.keys()):
           xType = db.schema.getDomain(pred.getFunctor(),2)
           yType = db.schema.getRange(pred.getFunctor(),2)
@@ -286,9 +353,116 @@ class Dataset(object):
                     fp.write('\t+%s(%s,%s)' % (theoryPred,x,y))
                 fp.write('\n')
 
+class StreamingDataset(object):
+    """A dataset which is read from a .exam file, or a ProPPR-style
+    .examples file, each time it is used, so the examples are never all
+    in memory at once.  It can be used in place of a Dataset by the
+    learners, which only need minibatchIterator.
+
+    If shuffleFirst is passed to minibatchIterator, the order of the
+    examples is randomized with a buffer of shuffleBufferSize
+    examples: each example read replaces one picked at random from
+    the buffer, which is passed on.  This only mixes examples that are
+    close together in the file, so a file sorted by (say) label should
+    be shuffled on disk first.
+    """
+
+    def __init__(self,db,fileName,proppr=False,shuffleBufferSize=10000,seed=None):
+        self.db = db
+        self.fileName = fileName
+        self.proppr = proppr
+        self.shuffleBufferSize = shuffleBufferSize
+        self.rng = NR.RandomState(seed)
+        # there are no shards to memory-map
+        self.shardDir = None
+        self._modes = None
+
+    def modesToLearn(self):
+        """Return list of modes associated with the data.  The first call
+        reads through the file."""
+        if self._modes is None:
+            modes = collections.OrderedDict()
+            for line in util.linesIn(self.fileName):
+                mode,_,_ = Dataset._parseLine(line,proppr=self.proppr)
+                if mode: modes[mode] = True
+            self._modes = list(modes.keys())
+        return self._modes
+
+    def isSinglePredicate(self):
+        """Returns true if all the examples are for a single predicate."""
+        return len(self.modesToLearn())==1
+
+    def hasMode(self,mode):
+        """True if there are examples of the mode in the dataset."""
+        return mode in self.modesToLearn()
+
+    def examples(self,shuffleFirst=True):
+        """Iterate over the examples as triples (mode,x,ys), where x is
+        the id of the input and ys a list of ids of outputs."""
+        stream = Dataset._readExamples(self.db,self.fileName,self.proppr)
+        if not shuffleFirst or self.shuffleBufferSize<=1:
+            for ex in stream: yield ex
+            return
+        buf = []
+        for ex in stream:
+            if len(buf)<self.shuffleBufferSize:
+                buf.append(ex)
+            else:
+                j = self.rng.randint(len(buf))
+                yield buf[j]
+                buf[j] = ex
+        for j in self.rng.permutation(len(buf)):
+            yield buf[j]
+
+    def minibatchIterator(self,batchSize=100,shuffleFirst=True):
+        """Iterate over triples (mode,X',Y') where X' and Y' are CSR
+        matrices with batchSize rows, one per example of that mode.  The
+        last minibatch for each mode may be smaller."""
+        pending = collections.OrderedDict()
+        for mode,x,ys in self.examples(shuffleFirst=shuffleFirst):
+            batch = pending.setdefault(mode,[])
+            batch.append((x,ys))
+            if len(batch)==batchSize:
+                del pending[mode]
+                yield (mode,) + self._matrices(mode,batch)
+        for mode,batch in pending.items():
+            yield (mode,) + self._matrices(mode,batch)
+
+    def _matrices(self,mode,batch):
+        """The X and Y matrices for a list of (x,ys) pairs, which are
+        the same as the rows loadExamples would build for them."""
+        functor = mode.getFunctor()
+        xType = self.db.schema.getDomain(functor,2)
+        yType = self.db.schema.getRange(functor,2)
+        n = len(batch)
+        xCols = NP.array([x for x,_ in batch],dtype='int32')
+        X = SS.csr_matrix((NP.ones(n,dtype='float32'),xCols,NP.arange(n+1,dtype='int32')), shape=(n,self.db.dim(xType)))
+        yLens = NP.array([len(ys) for _,ys in batch],dtype='int32')
+        yRows = NP.repeat(NP.arange(n,dtype='int32'),yLens)
+        yCols = NP.array([y for _,ys in batch for y in ys],dtype='int32')
+        if conf.normalize_outputs:
+            yData = 1.0/NP.repeat(yLens,yLens)
+        else:
+            yData = NP.ones(len(yCols))
+        Y = SS.csr_matrix(SS.coo_matrix((yData,(yRows,yCols)), shape=(n,self.db.dim(yType))),dtype='float32')
+        return X,Y
+
+def _saveCSR(prefix,m):
+    m = SS.csr_matrix(m,dtype='float32')
+    NP.save(prefix+'.data.npy',m.data)
+    NP.save(prefix+'.indices.npy',m.indices.astype('int32'))
+    NP.save(prefix+'.indptr.npy',m.indptr.astype('int32'))
+    NP.save(prefix+'.shape.npy',NP.array(m.shape,dtype='int64'))
+
+def _loadCSR(prefix):
+    # the arrays are memory-mapped, and read in only when they are used
+    arrays = [NP.load(prefix+'.%s.npy' % a, mmap_mode='r') for a in ('data','indices','indptr')]
+    shape = tuple(NP.load(prefix+'.shape.npy'))
+    return mutil.csrMatrix(arrays[0],arrays[1],arrays[2],shape)
+
 if __name__ == "__main__":
-    usage = 'usage: python -m dataset.py --serialize foo.cfacts|foo.db bar.exam|bar.examples glob.dset'
-    if sys.argv[1]=='--serialize':
+    usage = 'usage: python -m dataset.py --serialize|--serializeShards foo.cfacts|foo.db bar.exam|bar.examples glob.dset'
+    if sys.argv[1] in ('--serialize','--serializeShards'):
         assert len(sys.argv)==5,usage
         dbFile = sys.argv[2]
         examFile = sys.argv[3]
@@ -301,4 +475,5 @@ if __name__ == "__main__":
             assert False,usage
         assert examFile.endswith(".examples") or examFile.endswith(".exam"),usage
         dset = Dataset.loadExamples(db,examFile,proppr=examFile.endswith(".examples"))
-        dset.serialize(dsetFile)
+        dset.serialize(dsetFile,sharded=(sys.argv[1]=='--serializeShards'))
+
@@ -4,9 +4,15 @@
 #
 import os.path
 import logging
+import zlib
+import numpy as NP
 
+from tensorlog import config
 from tensorlog import util
 
+conf = config.Config()
+conf.compact_symbols = False;  conf.help.compact_symbols = 'Use CompactSymbolTable, which has no per-symbol python objects, for new schemas'
+
 THING = '__THING__' # name of default type
 NULL_ENTITY_NAME = '__NULL__'  #name of null entity marker
 OOV_ENTITY_NAME = '__OOV__'  #name of out-of-vocabulary marker entity
@@ -67,9 +73,9 @@ class AbstractSchema(object):
     """
     symbolFile = os.path.join(direc,"symbols.txt")
     if os.path.isfile(symbolFile):
-      return UntypedSchema.deserializeFrom(symbolFile)
+      return UntypedSchema.deserializeFrom(symbolFile,symbolDir=direc)
     else:
-      return TypedSchema.deserializeFrom(os.path.join(direc,"typed-symbols.txt"))
+      return TypedSchema.deserializeFrom(os.path.join(direc,"typed-symbols.txt"),symbolDir=direc)
 
   def getMaxId(self,typeName):
     """ Return max id of any symbol for this type
@@ -93,11 +99,18 @@ class AbstractSchema(object):
     """
     assert False, 'abstract method called'
 
+  def insertAll(self,typeName,symbols):
+    """Return an int32 array of ids for a list of distinct symbols in
+    the type, adding the new ones in the order they appear - so the
+    ids are the same as calling getId for each symbol in turn.
+    """
+    return _insertAll(self._stab[self.defaultType() if self.isTypeless() else typeName],symbols)
+
 
   def _safeSymbTab(self):
     """ Symbol table with reserved words 'i', 'o', and 'any'
     """
-    result = SymbolTable()
+    result = CompactSymbolTable() if conf.compact_symbols else SymbolTable()
     result.reservedSymbols.add("i")
     result.reservedSymbols.add("o")
     result.reservedSymbols.add(THING)
@@ -118,6 +131,52 @@ class AbstractSchema(object):
       assert i==k,'symbols out of sync for symbol "%s" type %d: expected index %d actual %d' % (sym,typeName,i,k)
       k += 1
 
+  def _saveCompactSymbTabs(self,direc):
+    """ Save the compact symbol tables, which can be memory-mapped when
+    the schema is deserialized
+    """
+    for typeName,stab in self._stab.items():
+      if isinstance(stab,CompactSymbolTable):
+        stab.save(_compactSymbTabPrefix(direc,typeName))
+
+def _compactSymbTabPrefix(direc,typeName):
+  return os.path.join(direc,'symbols-%s' % typeName)
+
+def _loadCompactSymbTab(direc,typeName):
+  """ Memory-map a saved compact symbol table, or return None if there
+  is not one
+  """
+  if direc is None: return None
+  prefix = _compactSymbTabPrefix(direc,typeName)
+  if not os.path.isfile(prefix+'.slots.npy'): return None
+  result = CompactSymbolTable.load(prefix)
+  result.reservedSymbols.update(["i","o",THING])
+  return result
+
+def _insertInOrder(stab,symbols):
+  """ Insert a list of symbols read from a serialized schema, checking
+  that symbols[k] gets the id k+1
+  """
+  if isinstance(stab,CompactSymbolTable):
+    ids = stab.getIds(symbols)
+    n = stab.getMaxId()
+    assert (ids[:n]==NP.arange(1,n+1)).all() and not ids[n:].any(),'symbols out of sync'
+    stab.extend(symbols[n:])
+  else:
+    for k,sym in enumerate(symbols):
+      i = stab.getId(sym)
+      assert i==k+1,'symbols out of sync for symbol "%s": expected index %d actual %d' % (sym,k+1,i)
+
+def _insertAll(stab,symbols):
+  if isinstance(stab,CompactSymbolTable):
+    ids = stab.getIds(symbols)
+    isNew = (ids==0)
+    if isNew.any():
+      ids[isNew] = stab.extend([symbols[k] for k in NP.flatnonzero(isNew)])
+    return ids
+  else:
+    return NP.array([stab.getId(sym) for sym in symbols],dtype=NP.int32)
+
 class UntypedSchema(AbstractSchema):
   """ A trivial schema where everything is a default type
   """
@@ -162,6 +221,7 @@ class UntypedSchema(AbstractSchema):
     """
     with open(os.path.join(direc,'symbols.txt'), 'w') as fp:
       self.serializeTo(fp)
+    self._saveCompactSymbTabs(direc)
 
   def serializeTo(self,fpLike):
     """Serialize the info needed to deserialize this object in a stream -
@@ -171,14 +231,16 @@ class UntypedSchema(AbstractSchema):
       fpLike.write(self.getSymbol(THING,i) + '\n')
 
   @staticmethod
-  def deserializeFrom(fileLike):
+  def deserializeFrom(fileLike,symbolDir=None):
+    """Restore from the symbols in a file, or from a saved compact symbol
+    table if there is one in symbolDir.
+    """
     result = UntypedSchema()
-    k = 1
-    for line in util.linesIn(fileLike):
-      sym = line.strip()
-      i = result.getId(THING,sym)
-      assert i==k,'symbols out of sync for symbol "%s": expected index %d actual %d' % (sym,i,k)
-      k += 1
+    stab = _loadCompactSymbTab(symbolDir,THING)
+    if stab is not None:
+      result._stab[THING] = stab
+    else:
+      _insertInOrder(result._stab[THING],[line.strip() for line in util.linesIn(fileLike)])
     return result
 
   def getMaxId(self,typeName):
@@ -271,6 +333,7 @@ class TypedSchema(AbstractSchema):
     """
     with open(os.path.join(direc,'typed-symbols.txt'), 'w') as fp:
       self.serializeTo(fp)
+    self._saveCompactSymbTabs(direc)
 
   def serializeTo(self,fp):
     for decl in self._declarations:
@@ -284,11 +347,16 @@ class TypedSchema(AbstractSchema):
         fp.write(self.getSymbol(typeName,i) + '\n')
 
   @staticmethod
-  def deserializeFrom(fileLike):
+  def deserializeFrom(fileLike,symbolDir=None):
+    """Restore from a file, using the saved compact symbol table for a
+    type instead of the symbols listed in the file if there is one in
+    symbolDir.
+    """
     result = TypedSchema()
     readingTypeDecs = True
     currentType = None
-    k = -1
+    # symbols for the current type, or None if they come from a saved table
+    symbols = None
     for line in util.linesIn(fileLike):
       line = line.strip()
       if readingTypeDecs and line:
@@ -307,19 +375,25 @@ class TypedSchema(AbstractSchema):
       elif not readingTypeDecs and line and currentType is None:
         # first line after empty line (signalled by 'currentType is None') is type name
         currentType = line
-        result.insertType(currentType)
-        k = 1
+        stab = _loadCompactSymbTab(symbolDir,currentType)
+        if stab is not None:
+          result._stab[currentType] = stab
+          symbols = None
+        else:
+          result.insertType(currentType)
+          symbols = []
       elif not readingTypeDecs and line and currentType is not None:
         # lines following the name of a type are symbols for that type
-        sym = line
-        i = result.getId(currentType,sym)
-        assert i==k,'symbols out of sync for symbol "%s" type %d: expected index %d actual %d' % (sym,currentType,i,k)
-        k += 1
+        if symbols is not None: symbols.append(line)
       elif not readingTypeDecs and not line:
         # empty line terminates list of symbols for a type
+        if symbols is not None: _insertInOrder(result._stab[currentType],symbols)
         currentType = None
+        symbols = None
       else:
         assert False,'cannot deserialize a TypedSchema from %r' % fileLike
+    if currentType is not None and symbols is not None:
+      _insertInOrder(result._stab[currentType],symbols)
     return result
 
   def getMaxId(self,typeName):
@@ -386,3 +460,221 @@ class SymbolTable(object):
 
   def getMaxId(self):
     return self._nextId
+
+def _segmentPositions(starts,lens):
+  """Indices of the elements of the segments [starts[k],starts[k]+lens[k])
+  of an array, concatenated in order."""
+  ends = NP.cumsum(lens)
+  return NP.repeat(starts-(ends-lens),lens) + NP.arange(ends[-1] if len(ends) else 0)
+
+def _encodeAll(symbols):
+  """Encode a list of symbols as (buf,starts,lens,hashes), where the
+  utf-8 encoding of symbols[k] is buf[starts[k]:starts[k]+lens[k]]"""
+  encoded = [s.encode('utf-8') for s in symbols]
+  n = len(encoded)
+  lens = NP.fromiter(map(len,encoded),dtype=NP.int64,count=n)
+  hashes = NP.fromiter(map(zlib.crc32,encoded),dtype=NP.uint32,count=n)
+  buf = NP.frombuffer(b''.join(encoded),dtype=NP.uint8)
+  return buf,NP.cumsum(lens)-lens,lens,hashes
+
+class CompactSymbolTable(object):
+  """A drop-in replacement for SymbolTable that scales to tens of
+  millions of symbols.  Symbols are stored as utf-8 in one contiguous
+  byte buffer, with an array of offsets, and located with an
+  open-addressing (linear probing) hash index kept in NumPy arrays,
+  so there are no per-symbol python objects.  Tables can be saved,
+  and loaded back with memory-mapping, and getIds and extend look up
+  or insert many symbols at once with vectorized operations.
+  """
+
+  def __init__(self,initSymbols=[]):
+    self.reservedSymbols = set()
+    # symbol i is _buf[_offsets[i]:_offsets[i+1]], for 1<=i<=N,
+    # and _hashes[i] is its crc32
+    self._buf = NP.zeros(1024,dtype=NP.uint8)
+    self._offsets = NP.zeros(1024,dtype=NP.int64)
+    self._hashes = NP.zeros(1024,dtype=NP.uint32)
+    # the hash index: each slot is 0 or a symbol id, and the slots
+    # are kept at most half full
+    self._slots = NP.zeros(1024,dtype=NP.int32)
+    self._nextId = 0
+    for s in initSymbols:
+      self.insert(s)
+    self._empty = True
+
+  #
+  # the SymbolTable interface
+  #
+
+  def insert(self,symbol):
+    """Insert a symbol, and return its id."""
+    b = symbol.encode('utf-8')
+    h = zlib.crc32(b)
+    i,pos = self._find(b,h)
+    if i: return i
+    self._ensureWritable()
+    self._reserve(len(b),1)
+    i = self._nextId = self._nextId + 1
+    lo = self._offsets[i]
+    self._buf[lo:lo+len(b)] = NP.frombuffer(b,dtype=NP.uint8)
+    self._offsets[i+1] = lo+len(b)
+    self._hashes[i] = h
+    self._slots[pos] = i
+    self._empty = False
+    if 2*self._nextId > len(self._slots):
+      self._rehash(2*len(self._slots))
+    return i
+
+  def getSymbolList(self):
+    """Get an array of all defined symbols."""
+    return [self.getSymbol(i) for i in range(1,self._nextId+1)]
+
+  def getSymbol(self,id):
+    if id==0: return None
+    return self._buf[self._offsets[id]:self._offsets[id+1]].tobytes().decode('utf-8')
+
+  def hasId(self,symbol):
+    b = symbol.encode('utf-8')
+    return self._find(b,zlib.crc32(b))[0]>0
+
+  def getId(self,symbol):
+    """Get the numeric id, between 1 and N, of a symbol.
+    """
+    return self.insert(symbol)
+
+  def getMaxId(self):
+    return self._nextId
+
+  #
+  # bulk operations
+  #
+
+  def getIds(self,symbols):
+    """Return an int32 array with the ids of a list of symbols, with 0
+    for symbols that are not in the table."""
+    return self._lookup(*_encodeAll(symbols))
+
+  def extend(self,symbols):
+    """Insert a list of distinct symbols, none of which are already in
+    the table, and return an array of their ids."""
+    qbuf,qstarts,qlens,qhashes = _encodeAll(symbols)
+    n = len(qlens)
+    self._ensureWritable()
+    self._reserve(len(qbuf),n)
+    lo = self._offsets[self._nextId+1]
+    self._buf[lo:lo+len(qbuf)] = qbuf
+    ids = NP.arange(self._nextId+1,self._nextId+n+1,dtype=NP.int32)
+    self._offsets[ids+1] = lo + qstarts + qlens
+    self._hashes[ids] = qhashes
+    self._nextId += n
+    if n: self._empty = False
+    if 2*self._nextId > len(self._slots):
+      self._rehash(2*self._nextId)
+    else:
+      self._place(ids,qhashes)
+    found = self._lookup(qbuf,qstarts,qlens,qhashes)
+    assert (found==ids).all(),'extend: symbols must be distinct and new'
+    return ids
+
+  def save(self,prefix):
+    """Save the table in NumPy files with the given prefix."""
+    n = self._nextId
+    NP.save(prefix+'.buf.npy',self._buf[:self._offsets[n+1]])
+    NP.save(prefix+'.offsets.npy',self._offsets[:n+2])
+    NP.save(prefix+'.hashes.npy',self._hashes[:n+1])
+    NP.save(prefix+'.slots.npy',self._slots)
+
+  @staticmethod
+  def load(prefix,mmap=True):
+    """Load a table saved with save().  If mmap is True the arrays are
+    memory-mapped, so they are only read as they are used; they are
+    copied into memory if symbols are inserted later."""
+    mode = 'r' if mmap else None
+    result = CompactSymbolTable()
+    result._buf = NP.load(prefix+'.buf.npy',mmap_mode=mode)
+    result._offsets = NP.load(prefix+'.offsets.npy',mmap_mode=mode)
+    result._hashes = NP.load(prefix+'.hashes.npy',mmap_mode=mode)
+    result._slots = NP.load(prefix+'.slots.npy',mmap_mode=mode)
+    result._nextId = len(result._offsets)-2
+    result._empty = False
+    return result
+
+  #
+  # internals
+  #
+
+  def _find(self,b,h):
+    """Return (i,pos) where i is the id of the symbol with utf-8
+    encoding b and hash h, or 0 if it is absent, and pos is the slot
+    holding it, or the empty slot where it should be placed."""
+    slots = self._slots
+    mask = len(slots)-1
+    pos = h & mask
+    while True:
+      i = int(slots[pos])
+      if i==0 or (self._hashes[i]==h and self._buf[self._offsets[i]:self._offsets[i+1]].tobytes()==b):
+        return i,pos
+      pos = (pos+1) & mask
+
+  def _lookup(self,qbuf,qstarts,qlens,qhashes):
+    result = NP.zeros(len(qlens),dtype=NP.int32)
+    mask = len(self._slots)-1
+    pending = NP.arange(len(qlens))
+    k = 0
+    while pending.size:
+      # look at the k-th slot in the probe sequence of each pending query
+      cand = self._slots[(qhashes[pending].astype(NP.int64)+k) & mask]
+      pending,cand = pending[cand>0],cand[cand>0]
+      candLens = self._offsets[cand+1]-self._offsets[cand]
+      same = (self._hashes[cand]==qhashes[pending]) & (candLens==qlens[pending])
+      q,c,lens = pending[same],cand[same],candLens[same]
+      diff = self._buf[_segmentPositions(self._offsets[c],lens)] != qbuf[_segmentPositions(qstarts[q],lens)]
+      mismatches = NP.bincount(NP.repeat(NP.arange(len(q)),lens),weights=diff,minlength=len(q))
+      hit = mismatches==0
+      result[q[hit]] = c[hit]
+      done = NP.zeros(len(qlens),dtype=bool)
+      done[q[hit]] = True
+      pending = pending[~done[pending]]
+      k += 1
+    return result
+
+  def _place(self,ids,hashes):
+    """Put ids into the hash index, in rounds: in round k, each id that
+    is not yet placed tries the k-th slot in its probe sequence, and
+    one id wins each free slot."""
+    mask = len(self._slots)-1
+    k = 0
+    while ids.size:
+      pos = (hashes.astype(NP.int64)+k) & mask
+      free = self._slots[pos]==0
+      freePos,first = NP.unique(pos[free],return_index=True)
+      winners = NP.flatnonzero(free)[first]
+      self._slots[freePos] = ids[winners]
+      placed = NP.zeros(len(ids),dtype=bool)
+      placed[winners] = True
+      ids,hashes = ids[~placed],hashes[~placed]
+      k += 1
+
+  def _rehash(self,minSlots):
+    # the number of slots must be a power of two
+    self._slots = NP.zeros(1 << int(minSlots-1).bit_length(),dtype=NP.int32)
+    ids = NP.arange(1,self._nextId+1,dtype=NP.int32)
+    self._place(ids,self._hashes[ids])
+
+  def _reserve(self,numBytes,numIds):
+    """Make sure there is room for numBytes more bytes and numIds more
+    symbols."""
+    needBytes = self._offsets[self._nextId+1]+numBytes
+    if needBytes > len(self._buf):
+      self._buf = NP.concatenate([self._buf,NP.zeros(max(needBytes,len(self._buf)),dtype=NP.uint8)])
+    needIds = self._nextId+numIds+2
+    if needIds > len(self._offsets):
+      grow = max(needIds,len(self._offsets))
+      self._offsets = NP.concatenate([self._offsets,NP.zeros(grow,dtype=NP.int64)])
+      self._hashes = NP.concatenate([self._hashes,NP.zeros(grow,dtype=NP.uint32)])
+
+  def _ensureWritable(self):
+    # memory-mapped arrays are read-only
+    for a in ('_buf','_offsets','_hashes','_slots'):
+      if not getattr(self,a).flags.writeable:
+        setattr(self,a,NP.array(getattr(self,a)))
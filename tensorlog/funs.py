@@ -3,9 +3,12 @@
 # functions, which support evaluation and backprop
 #
 
+import os
 import sys
 import logging
 import copy
+import threading
+import concurrent.futures
 
 from tensorlog import opfunutil
 from tensorlog import ops
@@ -17,6 +20,25 @@ conf = config.Config()
 conf.trace = False;         conf.help.trace =         "Print debug info during function eval"
 conf.long_trace = False;    conf.help.long_trace =    "Print output of functions during eval - only for small tasks"
 
+# marks threads which are running a branch of a SumFunction
+_branchState = threading.local()
+
+# thread pools shared by SumFunctions, by number of workers, and the
+# process they were created in - threads are not inherited by forked
+# processes
+_branchPools = {}
+_branchPoolPid = None
+
+def _branchExecutor(workers):
+    global _branchPools,_branchPoolPid
+    if _branchPoolPid!=os.getpid():
+        _branchPools = {}
+        _branchPoolPid = os.getpid()
+    if workers not in _branchPools:
+        # the calling thread runs one of the branches itself
+        _branchPools[workers] = concurrent.futures.ThreadPoolExecutor(workers-1)
+    return _branchPools[workers]
+
 class Function(object):
     """The tensorlog representation of a function. This supports eval and
     evalGrad operations, and take a list of input values as the inputs.
@@ -201,19 +223,63 @@ class SumFunction(Function):
           if fun.outputType is None: fun.outputType = self.outputType
         for fun in self.funs:
           if fun.inputTypes is not None: self.inputTypes = fun.inputTypes
+        # if more than one, the number of threads used to evaluate
+        # the rule branches - see Program.setBranchWorkers
+        self.workers = 0
     def __repr__(self):
         return 'SumFunction(%r)' % self.funs
+    def _parallel(self):
+        # branches nested inside a parallel branch are run serially,
+        # so no thread waits for work queued behind it
+        return self.workers>1 and len(self.funs)>1 and not getattr(_branchState,'active',False)
+    def _mapBranches(self,task,pad,gradAccum=None):
+        """Return [task(f,fpad,fgrad) for f in self.funs], running the
+        tasks in a pool of threads.  Each task gets its own slice of the
+        scratchpad and, if gradAccum is given, its own gradient
+        accumulator, and these are merged back in the order of the
+        branches, so the result does not depend on the scheduling."""
+        pads = [pad.slice() for f in self.funs]
+        grads = [gradAccum.__class__() if gradAccum is not None else None for f in self.funs]
+        errstate = numpy.geterr()
+        def runBranch(k):
+            saved = getattr(_branchState,'active',False)
+            _branchState.active = True
+            try:
+                # numpy's error handling is set per thread
+                with numpy.errstate(**errstate):
+                    return task(self.funs[k],pads[k],grads[k])
+            finally:
+                _branchState.active = saved
+        executor = _branchExecutor(self.workers)
+        futures = [executor.submit(runBranch,k) for k in range(1,len(self.funs))]
+        results = [runBranch(0)] + [f.result() for f in futures]
+        for k in range(len(self.funs)):
+            pad.merge(pads[k])
+            if gradAccum is not None:
+                for paramName,grad in grads[k].items():
+                    gradAccum.accum(paramName,grad)
+        return results
     def pprintSummary(self):
         rhs = 'SumFunction' if self.outputType is None else 'SumFunction(%s)' % (self.outputType)
         return rhs
     def _doEval(self,db,values,pad):
-        addends = [f.eval(db,values,pad) for f in self.funs]
+        if self._parallel():
+            # bring the matrices up to date before the branches use
+            # them - anything the branches still encode lazily, like
+            # dense blocks, is encoded under matrixdb's lock
+            db.mergeDeltas()
+            addends = self._mapBranches(lambda f,fpad,_: f.eval(db,values,fpad), pad)
+        else:
+            addends = [f.eval(db,values,pad) for f in self.funs]
         accum = addends[0]
         for i in range(1,len(addends)):
             accum = accum + addends[i]
         return accum
     def _doBackprop(self,delta,gradAccum,pad):
-        addends = [f.backprop(delta,gradAccum,pad) for f in self.funs]
+        if self._parallel():
+            addends = self._mapBranches(lambda f,fpad,fgrad: f.backprop(delta,fgrad,fpad), pad, gradAccum)
+        else:
+            addends = [f.backprop(delta,gradAccum,pad) for f in self.funs]
         accum = addends[0]
         for i in range(1,len(addends)):
             try:
@@ -227,7 +293,9 @@ class SumFunction(Function):
     def children(self):
         return self.funs
     def copy(self):
-        return SumFunction([f.copy() for f in self.funs])
+        ret = SumFunction([f.copy() for f in self.funs])
+        ret.workers = self.workers
+        return ret
 
 class SoftmaxFunction(Function):
     """A function which computes row-wise softmax of an inner function."""
@@ -244,7 +312,8 @@ class SoftmaxFunction(Function):
         return rhs
     def _doEval(self,db,values,pad):
         unnorm = self.fun.eval(db,values,pad)
-        return mutil.softmax(db,unnorm)
+        nullId = db.nullId(self.outputType)
+        return mutil.byRowBlocks(lambda m: mutil.softmax(db,m,nullId=nullId),unnorm)
     def _doBackprop(self,delta,pad):
         # see comments for learner.crossEntropyGrad
         assert False, 'should not call this directly'
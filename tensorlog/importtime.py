@@ -0,0 +1,39 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# benchmark the time and memory needed to import tensorlog modules
+#
+
+import os
+import sys
+import subprocess
+
+# run in a fresh interpreter, so nothing is already imported
+PROBE = """
+import resource,sys,time
+start = time.time()
+import %s
+elapsed = time.time() - start
+maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+backends = [m for m in ('tensorflow','theano') if m in sys.modules]
+print('%%.3f\\t%%.1f\\t%%s' %% (elapsed,maxRSS,','.join(backends) or '-'))
+"""
+
+DEFAULT_MODULES = ['tensorlog.program','tensorlog.simple','tensorlog.score','tensorlog.expt']
+
+def importStats(moduleName):
+    """Return a triple (seconds,maxRSS in Mb,list of backends imported)
+    for importing a module in a new python process."""
+    env = dict(os.environ)
+    # make sure this copy of tensorlog is the one imported
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    out = subprocess.check_output([sys.executable,'-c',PROBE % moduleName],env=env).decode()
+    secs,rss,backends = out.strip().split('\t')
+    return float(secs),float(rss),[] if backends=='-' else backends.split(',')
+
+if __name__=="__main__":
+    modules = sys.argv[1:] or DEFAULT_MODULES
+    print('module\tsec\tmaxRSS(Mb)\tbackends imported')
+    for m in modules:
+        secs,rss,backends = importStats(m)
+        print('%s\t%.3f\t%.1f\t%s' % (m,secs,rss,','.join(backends) or '-'))
@@ -52,11 +52,9 @@ class Interp(object):
 
     def set(self,depth=None,echo=None,normalize=None,maxTraceMsg=-1,trace=None):
         if depth!=None:
-            self.prog.maxDepth = depth
-            self.prog.clearFunctionCache()
+            self.prog.setMaxDepth(depth)
         if normalize!=None:
-            self.prog.normalize = normalize
-            self.prog.clearFunctionCache()
+            self.prog.setNormalize(normalize)
         if echo!=None:
             self.numTopEcho = echo
         if trace!=None:
@@ -99,10 +97,7 @@ class Interp(object):
 
     def _listFunction(self,modeSpec):
         mode = declare.asMode(modeSpec)
-        key = (mode,0)
-        if key not in self.prog.function:
-            self.prog.compile(mode)
-        fun = self.prog.function[key]
+        fun = self.prog.getFunction(mode)
         print("\n".join(fun.pprint()))
 
     def eval(self,modeSpec,sym,inputType=None,outputType=None):
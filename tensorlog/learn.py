@@ -6,6 +6,7 @@
 import sys
 import time
 import math
+import logging
 import numpy as NP
 import scipy.sparse as SS
 import collections
@@ -22,6 +23,7 @@ from tensorlog import opfunutil
 conf = config.Config()
 conf.minGradient = -100;   conf.help.minGradient = "Clip gradients smaller than this to minGradient"
 conf.maxGradient = +100;   conf.help.minGradient = "Clip gradients larger than this to maxGradient"
+conf.dedupRows = True;     conf.help.dedupRows = "Evaluate each distinct row of a minibatch only once in predict and crossEntropyGrad"
 
 ##############################################################################
 # helper classes
@@ -226,7 +228,8 @@ class Tracer(object):
     @staticmethod
     def loss(learner,Y,P,kw):
         #perExample=False since we care about the sum xe+reg which is being optimized
-        xe = learner.crossEntropy(Y,P,perExample=False)  
+        #use the cross entropy from crossEntropyGrad, if it was passed in
+        xe = kw['crossEnt'] if 'crossEnt' in kw else learner.crossEntropy(Y,P,perExample=False)
         reg = learner.regularizer.regularizationCost(learner.prog)
         return [('loss', (xe+reg)), ('crossEnt', xe), ('reg',reg)]
 
@@ -309,11 +312,35 @@ class Learner(object):
     #
 
     def predict(self,mode,X,pad=None):
-        """Make predictions on a data matrix associated with the given mode."""
+        """Make predictions on a data matrix associated with the given
+        mode.  If a scratchpad is passed in, every row of X is
+        evaluated, so that the intermediate results saved on it have a
+        row for each example."""
+        U,inverse = self.distinctRows(X) if pad is None else (X,None)
         if not pad: pad = opfunutil.Scratchpad() 
         predictFun = self.prog.getPredictFunction(mode)
-        result = predictFun.eval(self.prog.db, [X], pad)
-        return result
+        result = predictFun.eval(self.prog.db, [U], pad)
+        return result if inverse is None else mutil.gatherRows(result,inverse)
+
+    def distinctRows(self,X,Y=None):
+        """Return a pair (U,inverse), where U holds the distinct rows of X
+        and row i of X is row inverse[i] of U, or (X,None) if the rows
+        are all different or conf.dedupRows is false.  Every row of the
+        output of a function depends only on the same row of the input,
+        so the output for X can be gathered from the output for U.  If
+        Y is given, rows i and j are only the same if both X and Y
+        agree on them.
+        """
+        if not conf.dedupRows or mutil.numRows(X)<2:
+            return X,None
+        if Y is None:
+            U,inverse = mutil.distinctRows(X)
+        else:
+            _,inverse = mutil.distinctRows(SS.csr_matrix(SS.hstack([X,Y]),dtype='float32'))
+            U = mutil.gatherRows(X,NP.unique(inverse,return_index=True)[1])
+        n,u = mutil.numRows(X),mutil.numRows(U)
+        logging.info('minibatch of %d rows has %d distinct rows: dedup ratio %.3f' % (n,u,float(n)/u))
+        return (X,None) if u==n else (U,inverse)
 
     def datasetPredict(self,dset,copyXs=True):
         """ Return predictions on a dataset. """
@@ -390,9 +417,13 @@ class Learner(object):
         """Compute the parameter gradient associated with softmax
         normalization followed by a cross-entropy cost function.  If a
         scratchpad is passed in, then intermediate results of the
-        gradient computation will be saved on that scratchpad.
+        gradient computation will be saved on that scratchpad, with a
+        row for each example.  Otherwise repeated rows of X are only
+        evaluated once, and the softmax, loss and initial delta are
+        only computed for the distinct rows.
         """
 
+        U,inverse = self.distinctRows(X,Y) if pad is None else (X,None)
         if not pad: pad = opfunutil.Scratchpad()
 
         # More detail: in learning we use a softmax normalization
@@ -408,20 +439,56 @@ class Learner(object):
         # do the prediction, saving intermediate outputs on the scratchpad
         predictFun = self.prog.getPredictFunction(mode)
         assert isinstance(predictFun,funs.SoftmaxFunction),'crossEntropyGrad specialized to work for softmax normalization'
-        P = self.predict(mode,X,pad)
-
-        # compute gradient
+        # the softmax, the loss, and the initial delta are computed
+        # together from the unnormalized scores, so P is only built
+        # once and log(P) comes directly from the log-softmax
+        unnorm = predictFun.fun.eval(self.prog.db,[U],pad)
+        nullId = self.prog.db.nullId(predictFun.outputType)
         paramGrads = GradAccumulator()
         #TODO assert rowSum(Y) = all ones - that's assumed here in
         #initial delta of Y-P
-        predictFun.fun.backprop(Y-P,paramGrads,pad)
+        if inverse is None:
+            P,xe,delta = mutil.softmaxCrossEntropy(self.candidateScores(unnorm,Y),Y,nullId)
+            pad[predictFun.id].output = P
+            predictFun.fun.backprop(delta,paramGrads,pad)
+        else:
+            # only the distinct rows of X (with their Y rows) are
+            # evaluated, and each stands for all its copies, so its
+            # loss and delta are weighted by its number of copies
+            copies = NP.bincount(inverse)
+            YU = mutil.gatherRows(Y,NP.unique(inverse,return_index=True)[1])
+            PU,xe,delta = mutil.softmaxCrossEntropy(self.candidateScores(unnorm,YU),YU,nullId,rowWeights=copies)
+            pad[predictFun.id].output = PU
+            predictFun.fun.backprop(delta,paramGrads,pad)
+            # gradients of row-vector parameters have a row for each
+            # row of the delta, so here for each distinct example,
+            # holding the gradient for all its copies.  The copies
+            # have the same gradient, so divide by the number of
+            # copies and give each example its row again, so that
+            # meanUpdate clips each example's gradient as before
+            perCopy = SS.diags(1.0/copies)
+            for (functor,arity),grad in paramGrads.items():
+                if arity==1:
+                    assert mutil.numRows(grad)==len(copies),'gradient for %s/%d does not have a row per example' % (functor,arity)
+                    paramGrads[(functor,arity)] = mutil.gatherRows(SS.csr_matrix(perCopy*grad,dtype='float32'),inverse)
+            # the tracer is passed a row for each example
+            P = mutil.gatherRows(PU,inverse)
 
         # the tracer function may output status, and may also write
         # information to the counters in paramGrads
+        tracerArgs = dict(tracerArgs)
+        tracerArgs['crossEnt'] = xe
         self.tracer(self,paramGrads,Y,P,**tracerArgs)
 
         return paramGrads
 
+    def candidateScores(self,unnorm,Y):
+        """The unnormalized scores that the softmax in crossEntropyGrad
+        is computed over.  By default this is every answer reachable
+        from the inputs.
+        """
+        return unnorm
+
     #
     # parameter updates
     #
@@ -514,9 +581,9 @@ class FixedRateSGDLearner(FixedRateGDLearner):
         self.miniBatchSize = miniBatchSize
     
     def train(self,dset):
+        """Train on a Dataset, or a dataset.StreamingDataset, which is
+        read from its file in each epoch."""
         trainStartTime = time.time()
-        modes = dset.modesToLearn()
-        n = len(modes)
         for i in range(self.epochs):
             startTime = time.time()
             epochCounter = GradAccumulator.counter()
@@ -536,6 +603,28 @@ class FixedRateSGDLearner(FixedRateGDLearner):
 
             self.epochTracer(self,epochCounter,i=i,startTime=trainStartTime)
 
+class SampledSoftmaxSGDLearner(FixedRateSGDLearner):
+
+    """ A stochastic gradient descent learner which approximates the
+    softmax over all reachable answers by a softmax over the gold
+    answers plus numSamples other answers for each example, sampled
+    in proportion to their unnormalized scores, with an importance
+    correction for the sampling (see
+    mutil.sampleSoftmaxCandidates).  The delta passed to backprop is
+    then non-zero only for these candidates, which is much cheaper
+    when the output type has many entities.  Note that the losses
+    reported by the tracer are for the sampled softmax.
+    """
+
+    def __init__(self,prog,epochs=10,rate=0.1,regularizer=None,tracer=None,miniBatchSize=100,numSamples=50,seed=None):
+        super(SampledSoftmaxSGDLearner,self).__init__(
+            prog,epochs=epochs,rate=rate,regularizer=regularizer,tracer=tracer,miniBatchSize=miniBatchSize)
+        self.numSamples = numSamples
+        self.rng = NP.random.RandomState(seed)
+
+    def candidateScores(self,unnorm,Y):
+        return mutil.sampleSoftmaxCandidates(unnorm,Y,self.numSamples,rng=self.rng)
+
 ##############################################################################
 # regularizers
 ##############################################################################
@@ -26,7 +26,7 @@ if __name__ == "__main__":
     elif db and ('--mode' in optdict):
         functor,rest = optdict['--mode'].split("/")
         arity = int(rest)
-        m = db.matEncoding.get((functor,arity))
+        m = db._current((functor,arity)) if db.inDB(functor,arity) else None
         assert m is not None,'mode should be of the form functor/arity for something in the database'
         for goal,weight in list(db.matrixAsPredicateFacts(functor,arity,m).items()):
             print(('\t'.join([goal.functor] + goal.args + ['%g' % (weight)])))
@@ -11,6 +11,7 @@ def masterConfig():
   from tensorlog import mutil
   from tensorlog import ops
   from tensorlog import program
+  from tensorlog import score
   from tensorlog import xcomp
 
   master =  config.Config()
@@ -30,6 +31,8 @@ def masterConfig():
   master.help.ops = 'config for tensorlog.ops'
   master.program = program.conf
   master.help.program = 'conf for tensorlog.program'
+  master.score = score.conf
+  master.help.score = 'config for tensorlog.score'
   master.xcomp = xcomp.conf
   master.help.xcomp = 'config for tensorlog.xcomp'
   try:
@@ -38,6 +41,12 @@ def masterConfig():
     master.help.debug = 'config for tensorlog.debug'
   except ImportError:
     logging.warn('debug module not imported')
+  try:
+    from tensorlog import tensorflowxcomp
+    master.tensorflowxcomp = tensorflowxcomp.conf
+    master.help.tensorflowxcomp = 'config for tensorlog.tensorflowxcomp'
+  except ImportError:
+    logging.warn('tensorflowxcomp module not imported')
   return master
 
 if __name__ == "__main__":
@@ -10,6 +10,9 @@ import scipy.sparse
 import scipy.io
 import collections
 import logging
+import multiprocessing
+import threading
+import numpy as NP
 
 from tensorlog import config
 from tensorlog import declare
@@ -23,11 +26,20 @@ conf = config.Config()
 conf.allow_weighted_tuples = True;     conf.help.allow_weighted_tuples = 'Allow last column of cfacts file to be a weight for the fact'
 conf.default_to_typed_schema = False;  conf.help.default_to_typed_schema = 'If true use TypedSchema() as default schema in MatrixDB'
 conf.ignore_types = False;             conf.help.ignore_types = 'Ignore type declarations, even if they are present'
+conf.pattern_relations = False;        conf.help.pattern_relations = 'Store binary relations whose weights are all 1.0 without a data array, saving memory but making matmuls with them 1.3-2x slower'
+conf.dense_blocks = True;              conf.help.dense_blocks = 'Multiply by relations whose non-zeros fit in a small block using a mutil.DenseBlock'
+conf.delta_merge_threshold = 100000;   conf.help.delta_merge_threshold = 'Merge facts added to an already-encoded relation into its matrix when this many are buffered'
+conf.load_workers = 1;                 conf.help.load_workers = 'Number of processes used by MatrixDB.loadFile to parse fact files - 1 reads them in this process, None uses one per CPU'
+conf.load_chunk_bytes = 1<<26;         conf.help.load_chunk_bytes = 'Uncompressed fact files larger than this are split into pieces that are parsed in parallel'
 
 NULL_ENTITY_NAME = dbschema.NULL_ENTITY_NAME
 THING = dbschema.THING
 OOV_ENTITY_NAME = dbschema.OOV_ENTITY_NAME
 
+# held while a relation's matrix or dense block is brought up to date,
+# which may happen lazily in threads that evaluate rules in parallel
+_encodingLock = threading.RLock()
+
 #functor in declarations of trainable relations, eg trainable(posWeight,1)
 TRAINABLE_DECLARATION_FUNCTOR = 'trainable'
 
@@ -37,11 +49,29 @@ class MatrixDB(object):
   def __init__(self,initSchema=None):
     #matEncoding[(functor,arity)] encodes predicate as a matrix
     self.matEncoding = {}
+    #blockEncoding[(functor,2)] is a pair (m,b) where b is a
+    #mutil.DenseBlock encoding the matrix m, or None if m is not
+    #compact enough.  It is only valid while m is matEncoding[(functor,2)]
+    self.blockEncoding = {}
     # mark which matrices are 'parameters' by (functor,arity) pair
     self.paramSet = set()
     self.paramList = []
+    # changed whenever a parameter is set or facts are added, so that
+    # cached inference results can be recognized as out of date
+    self.paramVersion = 0
     # buffers for reading in facts in tab-sep form
     self._databuf = self._rowbuf = self._colbuf = None
+    # facts parsed by bufferFiles, as lists of (data,rows,cols) arrays
+    self._arraybuf = None
+    # facts added to relations that are already encoded, as lists
+    # (data,rows,cols) for each key, and the encoded relations that
+    # are out of date, because of added facts or because their types
+    # have new symbols.  These are brought up to date when they are
+    # next used.
+    self._deltabuf = {}
+    self._staleKeys = set()
+    # the number of symbols of each type when buffers were last flushed
+    self._symbolCounts = {}
     if initSchema is not None:
       self.schema = initSchema
     elif conf.default_to_typed_schema and not conf.ignore_types:
@@ -74,9 +104,33 @@ class MatrixDB(object):
     if outOfVocabularySymbolsAllowed and not self.schema.hasId(typeName,s):
         return self.onehot(OOV_ENTITY_NAME,typeName)
     assert self.schema.hasId(typeName,s),'constant %s (type %s) not in db' % (s,typeName)
-    n = self.dim(typeName)
     i = self.schema.getId(typeName,s)
-    return scipy.sparse.csr_matrix( ([float(1.0)],([0],[i])), shape=(1,n), dtype='float32')
+    return self.onehotsFromIds([i],typeName)
+
+  def onehots(self,symbols,typeName=None,outOfVocabularySymbolsAllowed=False):
+    """An n-row matrix where row k is a onehot representation of
+    symbols[k]."""
+    typeName = self._fillDefault(typeName)
+    def symbolId(s):
+      if outOfVocabularySymbolsAllowed and not self.schema.hasId(typeName,s):
+        s = OOV_ENTITY_NAME
+      assert self.schema.hasId(typeName,s),'constant %s (type %s) not in db' % (s,typeName)
+      return self.schema.getId(typeName,s)
+    return self.onehotsFromIds([symbolId(s) for s in symbols],typeName)
+
+  def onehotsFromIds(self,ids,typeName=None):
+    """An n-row matrix where row k is a onehot representation of the
+    symbol with id ids[k].  The matrix is built directly in CSR form,
+    since each row has exactly one non-zero."""
+    typeName = self._fillDefault(typeName)
+    n = self.dim(typeName)
+    indices = NP.asarray(ids,dtype='int32')
+    assert indices.ndim==1,'ids must be a one-dimensional array'
+    assert indices.size==0 or (indices.min()>=0 and indices.max()<n),'id out of range for type %s' % typeName
+    numRows = indices.size
+    data = NP.ones(numRows,dtype='float32')
+    indptr = NP.arange(numRows+1,dtype='int32')
+    return scipy.sparse.csr_matrix((data,indices,indptr), shape=(numRows,n), dtype='float32')
 
   def zeros(self,numRows=1,typeName=None):
     typeName = self._fillDefault(typeName)
@@ -90,6 +144,11 @@ class MatrixDB(object):
     n = self.dim(typeName)
     return scipy.sparse.csr_matrix( ([float(1.0)]*n,([0]*n,[j for j in range(n)])), shape=(1,n), dtype='float32')
 
+  def nullId(self,typeName=None):
+    """The id of the null entity in a type, by default THING."""
+    if typeName is None: typeName = THING
+    return self.schema.getId(typeName,NULL_ENTITY_NAME)
+
   def nullMatrix(self,numRows=1,typeName=None,numCols=0):
     """A matrix where every row is a one-hot encoding of the null entity.
     The number of columns is specified by numCols or by
@@ -98,7 +157,7 @@ class MatrixDB(object):
     """
     if typeName is None: typeName = THING
     if numCols==0: numCols = self.dim(typeName)
-    nullId = 1
+    nullId = self.nullId(typeName)
     return scipy.sparse.csr_matrix( ([float(1.0)]*numRows,
                                      (list(range(numRows)),[nullId]*numRows)),
                                     shape=(numRows,numCols),
@@ -124,22 +183,99 @@ class MatrixDB(object):
     assert (mode.functor,mode.arity) in self.matEncoding, \
            "can't find matrix for %s: is this defined in the program or database?" % str(mode)
     if not self.transposeNeeded(mode,transpose):
-      result = self.matEncoding[(mode.functor,mode.arity)]
+      result = self._current((mode.functor,mode.arity))
     else:
-      result = self.matEncoding[(mode.functor,mode.arity)].transpose()
+      result = self._current((mode.functor,mode.arity)).transpose()
       result = scipy.sparse.csr_matrix(result,dtype='float32')
       mutil.checkCSR(result,'db.matrix mode %s transpose %s' % (str(mode),str(transpose)))
     return result
 
+  def vecMatMul(self,v,mode,transpose=False):
+    """Returns v * self.matrix(mode,transpose), using the dense-block
+    encoding of the matrix if it has one."""
+    return self.vecMatMulFunction(mode,transpose)(v)
+
+  def vecMatMulFunction(self,mode,transpose=False):
+    """Returns a function f where f(v) = self.vecMatMul(v,mode,transpose).
+    Everything f needs is looked up (and transposed) in advance, so it
+    can be applied to several blocks of rows of v at once."""
+    key = (mode.functor,mode.arity)
+    block = self._denseBlock(key)
+    if block is not None:
+      if self.transposeNeeded(mode,transpose):
+        block = block.transpose()
+      # the product is built as a dense array, so larger minibatches
+      # fall back to the csr matrix, which is only looked up if needed
+      maxRows = max(1,mutil.conf.maxBlockProductCells // block.block.shape[1])
+      csrFun = []
+      def vecMatMul(v):
+        if mutil.numRows(v)<=maxRows:
+          return block.vecMatMul(v)
+        if not csrFun:
+          csrFun.append(self._csrVecMatMulFunction(mode,transpose))
+        return csrFun[0](v)
+      return vecMatMul
+    return self._csrVecMatMulFunction(mode,transpose)
+
+  def _csrVecMatMulFunction(self,mode,transpose):
+    key = (mode.functor,mode.arity)
+    m = self._current(key)
+    if mutil.isPattern(m):
+      if self.transposeNeeded(mode,transpose):
+        m = mutil.patternTranspose(m)
+      return lambda v: mutil.patternVecMatMul(v,m)
+    m = self.matrix(mode,transpose)
+    return lambda v: v * m
+
+  def _compactPattern(self,key):
+    """Drop the data array of a fixed binary relation whose weights
+    are all 1.0."""
+    if conf.pattern_relations and key[1]==2 and key not in self.paramSet:
+      m = self.matEncoding[key]
+      if not mutil.isPattern(m) and mutil.isAllOnes(m):
+        self.matEncoding[key] = mutil.patternOnly(m)
+
+  def _denseBlock(self,key):
+    # parameters change too often to keep a block up to date
+    if not conf.dense_blocks or key[1]!=2 or key in self.paramSet:
+      return None
+    m = self._current(key)
+    encoding = self.blockEncoding.get(key)
+    if encoding is None or encoding[0] is not m:
+      with _encodingLock:
+        encoding = self.blockEncoding.get(key)
+        if encoding is None or encoding[0] is not m:
+          self._encodeBlock(key)
+        encoding = self.blockEncoding[key]
+    return encoding[1]
+
+  def _encodeBlock(self,key):
+    """Select the dense-block encoding for a binary relation if it is
+    compact enough."""
+    m = self.matEncoding[key]
+    block = mutil.DenseBlock.fromCSR(m) if key[1]==2 and key not in self.paramSet else None
+    if block is not None:
+      logging.debug('%s/%d stored as a %d x %d dense block' % (key[0],key[1],block.block.shape[0],block.block.shape[1]))
+    self.blockEncoding[key] = (m,block)
+
   def vector(self,mode):
     """Returns a row vector for a unary predicate."""
     assert mode.arity==1, "mode arity for '%s' must be 1" % mode
-    result = self.matEncoding[(mode.functor,mode.arity)]
+    result = self._current((mode.functor,mode.arity))
     return result
 
   def matrixPreimage(self,mode):
     """The preimage associated with this mode, eg if mode is p(i,o) then
     return a row vector equivalent to 1 * M_p^T."""
+    m = self._current((mode.functor,mode.arity))
+    if mutil.isPattern(m):
+      # with all-ones weights, the preimage just counts non-zeros
+      # in each row of matrixPreimageMat(mode)^T
+      if self.transposeNeeded(mode,transpose=True):
+        counts = NP.diff(m.indptr)
+      else:
+        counts = NP.bincount(m.indices,minlength=m.shape[1])
+      return scipy.sparse.csr_matrix(counts.reshape(1,-1),dtype='float32')
     return self.matrixPreimageOnes(mode) * self.matrixPreimageMat(mode)
 
   def matrixPreimageMat(self,mode):
@@ -169,7 +305,7 @@ class MatrixDB(object):
     return (mode.functor,mode.arity) in self.paramSet
 
   def markAsParam(self,functor,arity):
-    logging.warn('MatrixDB.markAsParam is deprecated - use markAsParameter')
+    logging.warning('MatrixDB.markAsParam is deprecated - use markAsParameter')
     self.markAsParameter(functor,arity)
 
   def markAsParameter(self,functor,arity):
@@ -177,6 +313,11 @@ class MatrixDB(object):
     if (functor,arity) not in self.paramSet:
       self.paramSet.add((functor,arity))
       self.paramList.append((functor,arity))
+      self.blockEncoding.pop((functor,arity),None)
+      m = self._current((functor,arity)) if (functor,arity) in self.matEncoding else None
+      if m is not None and mutil.isPattern(m):
+        # parameters need their own values
+        self.matEncoding[(functor,arity)] = scipy.sparse.csr_matrix(m,dtype='float32',copy=True)
 
   def clearParameterMarkings(self):
     """ Clear previously marked parameters"""
@@ -185,14 +326,18 @@ class MatrixDB(object):
 
   def getParameter(self,functor,arity):
     assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
-    return self.matEncoding[(functor,arity)]
+    return self._current((functor,arity))
 
   def parameterIsInitialized(self,functor,arity):
     return (functor,arity) in self.matEncoding
 
   def setParameter(self,functor,arity,replacement):
     assert (functor,arity) in self.paramSet,'%s/%d not a parameter' % (functor,arity)
+    # the replacement supersedes any facts added since the last merge
+    self._deltabuf.pop((functor,arity),None)
+    self._staleKeys.discard((functor,arity))
     self.matEncoding[(functor,arity)] = replacement
+    self.paramVersion += 1
 
   #
   # convert from vectors, matrixes to symbols - for i/o and debugging
@@ -258,9 +403,9 @@ class MatrixDB(object):
         w = m1.data[i]
         if b==None:
           if i==0 and w<1e-10:
-            logging.warn('ignoring low weight %g placed on index 0 for type %s in predicate %s' % (w,typeName1,functor))
+            logging.warning('ignoring low weight %g placed on index 0 for type %s in predicate %s' % (w,typeName1,functor))
           elif i==0:
-            logging.warn('ignoring large weight %g placed on index 0 for type %s in predicate %s' % (w,typeName1,functor))
+            logging.warning('ignoring large weight %g placed on index 0 for type %s in predicate %s' % (w,typeName1,functor))
           else:
             assert False,'cannot find symbol on fact with weight %g for index %d for type %s in predicate %s' % (w,i,typeName1,functor)
         if b is not None:
@@ -275,10 +420,11 @@ class MatrixDB(object):
     return (functor,arity) in self.matEncoding
 
   def summary(self,functor,arity):
-    m = self.matEncoding[(functor,arity)]
+    m = self._current((functor,arity))
     return 'in DB: %s' % mutil.pprintSummary(m)
 
   def listing(self):
+    self.mergeDeltas()
     for (functor,arity),m in sorted(self.matEncoding.items()):
       print(('%s/%d: %s' % (functor,arity,self.summary(functor,arity))))
     if not self.isTypeless():
@@ -290,9 +436,11 @@ class MatrixDB(object):
     return len(list(self.matEncoding.keys()))
 
   def size(self):
+    self.mergeDeltas()
     return sum([m.nnz for m in list(self.matEncoding.values())])
 
   def parameterSize(self):
+    self.mergeDeltas()
     return sum([m.nnz for  ((fun,arity),m) in list(self.matEncoding.items()) if (fun,arity) in self.paramSet])
 
   def createPartner(self):
@@ -318,6 +466,7 @@ class MatrixDB(object):
     Values of the filter are None (save everything), 'fixed' (save non-parameters)
     or 'params' (save parameters only).
     """
+    self.mergeDeltas()
     if filter is None:
       d = self.matEncoding
     elif filter=='params':
@@ -366,6 +515,9 @@ class MatrixDB(object):
     db = MatrixDB()
     db.schema = dbschema.AbstractSchema.deserialize(direc)
     db.matEncoding = db._restoreMatDictWithScipy(os.path.join(direc,"db.mat"))
+    for key in db.matEncoding:
+      db._compactPattern(key)
+      if conf.dense_blocks and key[1]==2: db._encodeBlock(key)
     logging.info('deserialized database has %d relations and %d non-zeros' % (db.numMatrices(),db.size()))
     db.checkTyping()
     return db
@@ -390,7 +542,8 @@ class MatrixDB(object):
   # high level routines for loading files
 
   def addLines(self,lines):
-    """ Clear the buffers, add lines, and flush the buffers.
+    """ Clear the buffers, add lines, and flush the buffers.  Facts for
+    relations that are already encoded are added to them.
     """
     self.startBuffers()
     for line in lines:
@@ -398,15 +551,23 @@ class MatrixDB(object):
     self.flushBuffers()
 
   @staticmethod
-  def loadFile(filenames,initSchema=None):
+  def loadFile(filenames,initSchema=None,workers=0):
     """Return a MatrixDB created by loading a file, or colon-separated
-    list of files.
+    list of files.  Files ending in .gz, .bz2 or .xz are decompressed.
+    If workers is not 1 the files are parsed by bufferFiles, with that
+    many processes - None means one per CPU, and the default of 0
+    means to use conf.load_workers.
     """
+    workers = conf.load_workers if workers==0 else workers
+    workers = multiprocessing.cpu_count() if workers is None else workers
     db = MatrixDB(initSchema=initSchema)
     db.startBuffers()
-    for f in filenames.split(":"):
-      db.bufferFile(f)
-      logging.info('buffered file %s' % f)
+    if workers>1:
+      db.bufferFiles(filenames.split(":"),workers)
+    else:
+      for f in filenames.split(":"):
+        db.bufferFile(f)
+        logging.info('buffered file %s' % f)
     db.flushBuffers()
     logging.info('loaded database has %d relations and %d non-zeros' % (db.numMatrices(),db.size()))
     return db
@@ -418,6 +579,7 @@ class MatrixDB(object):
     self._databuf = collections.defaultdict(list)
     self._rowbuf = collections.defaultdict(list)
     self._colbuf = collections.defaultdict(list)
+    self._arraybuf = collections.defaultdict(list)
 
   def bufferFile(self,filename):
     """Load triples from a file and buffer them internally."""
@@ -427,49 +589,267 @@ class MatrixDB(object):
       if not k%10000: logging.info('read %d lines' % k)
       self._bufferLine(line,filename,k)
 
+  def bufferFiles(self,filenames,workers):
+    """Load triples from a list of files and buffer them internally,
+    giving the same result as calling bufferFile on each file in turn.
+    Pieces of the files are parsed by a pool of worker processes, each
+    producing arrays of local symbol numbers and a list of the local
+    symbols, and these are mapped to the ids in the schema here, one
+    piece at a time, in order.
+    """
+    chunks = _factFileChunks(filenames,workers)
+    pool = multiprocessing.get_context('fork').Pool(min(workers,len(chunks)))
+    try:
+      for parsed in pool.imap(_parseFactChunk, chunks):
+        self._bufferParsedChunk(parsed)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _bufferParsedChunk(self,parsed):
+    """Buffer the facts in a piece of a file parsed by _parseFactChunk,
+    applying its declarations in between the facts before and after
+    them."""
+    filename,symbols,ncols,functors,a1,a2,w,lineNos,decls = parsed
+    lo = 0
+    for hi,k,line in decls + [(len(ncols),None,None)]:
+      if hi>lo:
+        self._bufferParsed(filename,symbols,ncols[lo:hi],functors[lo:hi],a1[lo:hi],a2[lo:hi],w[lo:hi],lineNos[lo:hi])
+      if line is not None:
+        self._bufferLine(line,filename,k)
+      lo = hi
+    logging.info('buffered %d lines of %s' % (len(ncols),filename))
+
+  def _bufferParsed(self,filename,symbols,ncols,functors,a1,a2,w,lineNos):
+    """Buffer facts parsed by _parseFactChunk, following the same rules
+    as _bufferLine.  The arrays have an entry for each fact: its number
+    of columns, the local numbers of the functor and the symbols in
+    columns 2 and 3 (or -1), and the float value of the last column
+    (or nan)."""
+    n = len(ncols)
+    # decide the arity of the facts by calling _factArity once for
+    # each combination of column count, functor, and kind of last
+    # column - not a number, negative, zero, or positive
+    wKind = NP.select([NP.isnan(w),w<0,w==0],[0,1,2],3).astype(NP.int8)
+    wSample = [None,-1.0,0.0,1.0]
+    arity = NP.zeros(n,dtype=NP.int8)
+    weighted = NP.zeros(n,dtype=bool)
+    keep = NP.ones(n,dtype=bool)
+    for nc,f,kind in NP.unique(NP.stack([ncols,functors,wKind],axis=1),axis=0).tolist():
+      rows = (ncols==nc) & (functors==f) & (wKind==kind)
+      a,isWeight,problem = self._factArity(nc,symbols[f],wSample[kind])
+      if problem:
+        report = logging.error if a is None else logging.warning
+        for r in NP.flatnonzero(rows):
+          report('line %d of %s: %s' % (lineNos[r],filename,problem % (symbols[a2[r]] if nc==3 else w[r])))
+      if a is None:
+        keep &= ~rows
+      else:
+        arity[rows] = a
+        weighted[rows] = isWeight
+    weight = NP.where(weighted,w,1.0)
+    # find the types of the arguments, or -1 for none
+    typeIndex = {}
+    types = -NP.ones((n,2),dtype=NP.int32)
+    keys = NP.zeros(n,dtype=NP.int32)
+    keyList = []
+    for f,a in set(zip(functors[keep].tolist(),arity[keep].tolist())):
+      functor = symbols[f]
+      rows = keep & (functors==f) & (arity==a)
+      argTypes = self._argTypes(functor,a)
+      if argTypes is None:
+        for r in NP.flatnonzero(rows):
+          logging.error('line %d of %s: undeclared relation %s/%d' % (lineNos[r],filename,functor,a))
+        keep &= ~rows
+        continue
+      ti,tj = argTypes
+      keys[rows] = len(keyList)
+      keyList.append((functor,a))
+      types[rows,0] = typeIndex.setdefault(ti,len(typeIndex))
+      if a==2:
+        types[rows,1] = typeIndex.setdefault(tj,len(typeIndex))
+    types[~keep,:] = -1
+    typeNames = sorted(typeIndex,key=typeIndex.get)
+    # give each type's symbols ids, adding new ones in the order they
+    # first appear, as _bufferTriplet would
+    seqSyms = NP.stack([a1,a2],axis=1).ravel()
+    seqTypes = types.ravel()
+    seqIds = NP.zeros(len(seqSyms),dtype=NP.int32)
+    for t,typeName in enumerate(typeNames):
+      sel = NP.flatnonzero(seqTypes==t)
+      uniq,first = NP.unique(seqSyms[sel],return_index=True)
+      ordered = uniq[NP.argsort(first)]
+      lookup = NP.zeros(len(symbols),dtype=NP.int32)
+      lookup[ordered] = self.schema.insertAll(typeName,[symbols[i] for i in ordered])
+      seqIds[sel] = lookup[seqSyms[sel]]
+    ids = seqIds.reshape(n,2)
+    rowIds = NP.where(arity==1,0,ids[:,0])
+    colIds = NP.where(arity==1,ids[:,0],ids[:,1])
+    for k,key in enumerate(keyList):
+      rows = keep & (keys==k)
+      data,r,c = weight[rows],rowIds[rows],colIds[rows]
+      if key in self.matEncoding:
+        databuf,rowbuf,colbuf = self._deltabuf.setdefault(key,([],[],[]))
+        databuf.extend(data.tolist()); rowbuf.extend(r.tolist()); colbuf.extend(c.tolist())
+        self._staleKeys.add(key)
+        self.paramVersion += 1
+        if len(databuf)>=conf.delta_merge_threshold:
+          self._mergeDelta(key)
+      else:
+        self._arraybuf[key].append((data,r,c))
+
   def flushBuffers(self):
     """Flush all triples from the buffer."""
-    for f,arity in list(self._databuf.keys()):
+    flushed = list(set(self._databuf.keys()) | set(self._arraybuf.keys()))
+    for f,arity in flushed:
       self._flushBuffer(f,arity)
     self._databuf = None
     self.startBuffers()
-
-  def _flushBuffer(self,functor,arity):
-    """Flush the triples defining predicate p from the buffer and define
-    p's matrix encoding"""
-    key = (functor,arity)
-    logging.info('flushing %d buffered non-zero values for predicate %s' % (len(self._databuf[key]),functor))
+    # relations encoded earlier may need to grow to cover new symbols
+    for key,m in list(self.matEncoding.items()):
+      if m.shape!=self._shape(key):
+        self._staleKeys.add(key)
+    # new relations or new symbols change the results of inference,
+    # and new symbols also change the dimension of its outputs
+    symbolCounts = dict((t,self.schema.getMaxId(t)) for t in self.schema.getTypes())
+    if flushed or symbolCounts!=self._symbolCounts:
+      self.paramVersion += 1
+      self._symbolCounts = symbolCounts
+
+  def _shape(self,key):
+    """The shape of the matrix for a relation, given the current
+    symbol tables."""
+    functor,arity = key
     if arity==2:
       nrows = self.schema.getMaxId(self.schema.getDomain(functor,arity)) + 1
       ncols = self.schema.getMaxId(self.schema.getRange(functor,arity)) + 1
     else:
       nrows = 1
       ncols = self.schema.getMaxId(self.schema.getDomain(functor,arity)) + 1
-    coo_matrix = scipy.sparse.coo_matrix((self._databuf[key],(self._rowbuf[key],self._colbuf[key])), shape=(nrows,ncols))
+    return (nrows,ncols)
+
+  def _flushBuffer(self,functor,arity):
+    """Flush the triples defining predicate p from the buffer and define
+    p's matrix encoding"""
+    key = (functor,arity)
+    data,rows,cols = self._databuf[key],self._rowbuf[key],self._colbuf[key]
+    if key in self._arraybuf:
+      pieces = [(NP.array(data,dtype=NP.float64),NP.array(rows,dtype=NP.int32),NP.array(cols,dtype=NP.int32))] + self._arraybuf[key]
+      data,rows,cols = [NP.concatenate(p) for p in zip(*pieces)]
+    logging.info('flushing %d buffered non-zero values for predicate %s' % (len(data),functor))
+    coo_matrix = scipy.sparse.coo_matrix((data,(rows,cols)), shape=self._shape(key))
     self.matEncoding[key] = scipy.sparse.csr_matrix(coo_matrix,dtype='float32')
     self.matEncoding[key].sort_indices()
     mutil.checkCSR(self.matEncoding[key], 'flushBuffer %s/%d' % key)
-
-  def _bufferTriplet(self,functor,arity,a1,a2,w,filename,k):
-    key = (functor,arity)
-    if (key in self.matEncoding):
-      logging.error("predicate encoding is already completed for "+str(key)+ " at line: "+line)
-      return
+    self._compactPattern(key)
+    if conf.dense_blocks and arity==2:
+      self._encodeBlock(key)
+
+  def _current(self,key):
+    """The matrix encoding a relation, after bringing it up to date."""
+    if key in self._staleKeys:
+      with _encodingLock:
+        if key in self._staleKeys:
+          self._mergeDelta(key)
+    return self.matEncoding[key]
+
+  def mergeDeltas(self):
+    """Bring the matrices for all relations up to date, by merging in
+    added facts and growing them to cover new symbols."""
+    with _encodingLock:
+      for key in list(self._staleKeys):
+        self._mergeDelta(key)
+
+  def _mergeDelta(self,key):
+    """Merge the facts added to an encoded relation into its matrix,
+    growing it first if its types have new symbols.  Only this
+    relation's derived encodings (pattern and dense block) change.
+    The relation stays stale until its new matrix is stored."""
+    shape = self._shape(key)
+    m = self.matEncoding[key]
+    if m.shape!=shape:
+      m = mutil.grow(m,shape)
+    if key in self._deltabuf:
+      data,rows,cols = self._deltabuf.pop(key)
+      logging.info('merging %d added non-zero values for predicate %s' % (len(data),key[0]))
+      delta = scipy.sparse.coo_matrix((data,(rows,cols)),shape=shape)
+      m = scipy.sparse.csr_matrix(m + delta,dtype='float32')
+      m.sort_indices()
+      mutil.checkCSR(m,'mergeDelta %s/%d' % key)
+    self.matEncoding[key] = m
+    self._compactPattern(key)
+    self._staleKeys.discard(key)
+
+  def _argTypes(self,functor,arity):
+    """The types of the arguments of a relation, with None for the
+    second type of a unary relation, or None if the relation's types
+    are not known."""
     ti = self.schema.getArgType(functor,arity,0)
     tj = self.schema.getArgType(functor,arity,1)
     if ti is None or (tj is None and arity==2):
+      return None
+    return ti,tj
+
+  def _factArity(self,ncols,functor,w):
+    """Decide how to read a line of a .cfacts file which has ncols
+    columns and starts with functor, where w is its last column as a
+    float, or None if that isn't a number.  Returns a triple
+    (arity,weighted,problem): arity is None if the line is illegal,
+    weighted is True if w is the weight of the fact, and otherwise
+    the weight is 1.0, and problem is None or a message to report,
+    with a %s for the last column.  This is used by _bufferLine and
+    by _bufferParsed for the parallel loader.
+    """
+    if ncols==4:
+      # must be functor,a1,a2,weight
+      if w is None or w<0: return None,False,'illegal weight %s'
+      return 2,True,None
+    elif ncols==2:
+      # must be functor,a1
+      return 1,False,None
+    # might be functor,a1,a2 OR functor,a1,weight
+    if self.schema.isTypeless():
+      if w is not None and conf.allow_weighted_tuples: return 1,True,None
+      # can't make this a weighted tuple
+      return 2,False,None
+    elif self.schema.getDomain(functor,2) and not self.schema.getDomain(functor,1):
+      # must be binary
+      return 2,False,None
+    elif self.schema.getDomain(functor,1) and not self.schema.getDomain(functor,2):
+      if w is None or w<0: return None,False,'illegal weight %s'
+      return 1,True,None
+    elif w is not None and w>0:
+      return 1,True,'assuming %s is a weight'
+    else:
+      return 2,False,None
+
+  def _bufferTriplet(self,functor,arity,a1,a2,w,filename,k):
+    key = (functor,arity)
+    argTypes = self._argTypes(functor,arity)
+    if argTypes is None:
       logging.error('line %d of %s: undeclared relation %s/%d' % (k,filename,functor,arity))
+      return
+    ti,tj = argTypes
+    if key in self.matEncoding:
+      # the relation is already encoded, so buffer the fact as an
+      # addition to be merged in later
+      databuf,rowbuf,colbuf = self._deltabuf.setdefault(key,([],[],[]))
+      self._staleKeys.add(key)
+      self.paramVersion += 1
     else:
-      i = self.schema.getId(ti, a1)
-      self._databuf[key].append(w)
-      if arity==1:
-        self._rowbuf[key].append(0)
-        self._colbuf[key].append(i)
-      else:
-        assert arity==2 and a2 is not None
-        self._rowbuf[key].append(i)
-        j = self.schema.getId(tj, a2)
-        self._colbuf[key].append(j)
+      databuf,rowbuf,colbuf = self._databuf[key],self._rowbuf[key],self._colbuf[key]
+    i = self.schema.getId(ti, a1)
+    databuf.append(w)
+    if arity==1:
+      rowbuf.append(0)
+      colbuf.append(i)
+    else:
+      assert arity==2 and a2 is not None
+      rowbuf.append(i)
+      j = self.schema.getId(tj, a2)
+      colbuf.append(j)
+    if key in self._deltabuf and len(databuf)>=conf.delta_merge_threshold:
+      self._mergeDelta(key)
 
   #
   # the real work in parsing a .cfacts file
@@ -510,46 +890,96 @@ class MatrixDB(object):
 
     # data lines
     parts = line.split("\t")
-    if len(parts)==4:
-      # must be functor,a1,a2,weight
-      functor,a1,a2,weight_string = parts[0],parts[1],parts[2],parts[3]
-      w = _atof(weight_string)
-      if w is None or w<0:
-        logging.error('line %d of %s: illegal weight' % (k,filename,weight_string))
-        return
-      self._bufferTriplet(functor,2,a1,a2,w,filename,k)
-    elif len(parts)==2:
-      # must be functor,a1
-      functor,a1 = parts[0],parts[1]
-      self._bufferTriplet(functor,1,a1,None,1.0,filename,k)
-    elif len(parts)==3:
-      # might be functor,a1,a2 OR functor,a1,weight
-      possible_weight_string = parts[2]
-      w = _atof(possible_weight_string)
-      if self.schema.isTypeless() and (w is not None) and conf.allow_weighted_tuples:
-        functor,a1 = parts[0],parts[1]
-        self._bufferTriplet(functor,1,a1,None,w,filename,k)
-      elif self.schema.isTypeless():
-        # can't make this a weighted tuple
-        functor,a1,a2 = parts[0],parts[1],parts[2]
-        self._bufferTriplet(functor,2,a1,a2,1.0,filename,k)
-      elif not self.schema.isTypeless():
-        functor = parts[0]
-        if self.schema.getDomain(functor,2) and not self.schema.getDomain(functor,1):
-          # must be binary
-          a1,a2 = parts[1],parts[2]
-          self._bufferTriplet(functor,2,a1,a2,1.0,filename,k)
-        elif self.schema.getDomain(functor,1) and not self.schema.getDomain(functor,2):
-          assert w is not None and w>=0,'line %d file %s: illegal weight %s' % (k,filename,possible_weight_string)
-          a1 = parts[1]
-          self._bufferTriplet(functor,1,a1,None,w,filename,k)
-        elif w is not None and w>0:
-          a1 = parts[1]
-          logging.warn('line %d file %s: assuming %s is a weight' % (k,filename,possible_weight_string))
-          self._bufferTriplet(functor,1,a1,None,w,filename,k)
-        else:
-          a1,a2 = parts[1],parts[2]
-          self._bufferTriplet(functor,2,a1,a2,1.0,filename,k)
-    else:
+    if len(parts)<2 or len(parts)>4:
       logging.error('line %d file %s: illegal line %r' % (k,filename,line))
       return
+    w = _atof(parts[-1]) if len(parts)>2 else None
+    arity,weighted,problem = self._factArity(len(parts),parts[0],w)
+    if problem:
+      report = logging.error if arity is None else logging.warning
+      report('line %d of %s: %s' % (k,filename,problem % parts[-1]))
+    if arity is None:
+      return
+    a2 = parts[2] if arity==2 else None
+    self._bufferTriplet(parts[0],arity,parts[1],a2,w if weighted else 1.0,filename,k)
+
+##############################################################################
+# These functions are defined at the top-level of a module so that
+# they can be run in worker processes by MatrixDB.bufferFiles
+##############################################################################
+
+def _factFileChunks(filenames,workers):
+  """Split a list of files into (filename,start,end) pieces, where
+  start and end are byte offsets, or None for a whole file.
+  Compressed files are never split.
+  """
+  sizes = [0 if util.isCompressed(f) else os.path.getsize(f) for f in filenames]
+  chunkBytes = max(1, min(conf.load_chunk_bytes, -(-sum(sizes)//workers)))
+  chunks = []
+  for f,size in zip(filenames,sizes):
+    if size<=chunkBytes:
+      chunks.append((f,None,None))
+    else:
+      chunks.extend((f,lo,min(size,lo+chunkBytes)) for lo in range(0,size,chunkBytes))
+  return chunks
+
+def _chunkLines(filename,start,end):
+  """Lines of a file which start at a byte offset in [start,end)."""
+  if start is None:
+    for line in util.linesIn(filename):
+      yield line
+  else:
+    with open(filename,'rb') as fp:
+      def lineStart(pos):
+        if pos==0: return 0
+        fp.seek(pos-1)
+        fp.readline()
+        return fp.tell()
+      lo,hi = lineStart(start),lineStart(end)
+      fp.seek(lo)
+      for line in fp.read(hi-lo).decode('utf-8').split('\n'):
+        yield line
+
+def _parseFactChunk(chunk):
+  """Parse a piece of a fact file made by _factFileChunks, without
+  looking at the schema.  Returns the filename, a list of local symbols
+  (including functors), arrays with the number of columns, local functor
+  and argument numbers, weight and line number of each fact, and a list
+  of declarations as (number of facts before it, line number, line)
+  triples.
+  """
+  filename,start,end = chunk
+  where = filename if start is None else '%s at byte %d' % (filename,start)
+  symbolIndex = {}
+  ncols,functors,a1,a2,w,lineNos = [],[],[],[],[],[]
+  decls = []
+  k = 0
+  for line in _chunkLines(filename,start,end):
+    k += 1
+    line = line.strip()
+    if not line: continue
+    if line.startswith('#'):
+      if line.find(':-')>=0:
+        decls.append((len(ncols),k,line))
+      continue
+    parts = line.split("\t")
+    if len(parts)<2 or len(parts)>4:
+      logging.error('line %d file %s: illegal line %r' % (k,where,line))
+      continue
+    ncols.append(len(parts))
+    functors.append(symbolIndex.setdefault(parts[0],len(symbolIndex)))
+    a1.append(symbolIndex.setdefault(parts[1],len(symbolIndex)))
+    if len(parts)>=3:
+      a2.append(symbolIndex.setdefault(parts[2],len(symbolIndex)))
+      try:
+        w.append(float(parts[-1]))
+      except ValueError:
+        w.append(NP.nan)
+    else:
+      a2.append(-1)
+      w.append(NP.nan)
+    lineNos.append(k)
+  symbols = sorted(symbolIndex,key=symbolIndex.get)
+  return (where,symbols,NP.array(ncols,dtype=NP.int8),NP.array(functors,dtype=NP.int32),
+          NP.array(a1,dtype=NP.int32),NP.array(a2,dtype=NP.int32),
+          NP.array(w,dtype=NP.float64),NP.array(lineNos,dtype=NP.int32),decls)
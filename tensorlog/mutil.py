@@ -7,8 +7,12 @@ import scipy.sparse as SS
 import scipy.io
 import numpy as NP
 import numpy.random as NR
+import os
 import math
 import logging
+import collections
+import concurrent.futures
+import threading
 
 from tensorlog import config
 
@@ -19,6 +23,13 @@ conf.densifyMean = True;             conf.help.densifyMean = 'use dense matrices
 conf.maxExpandFactor = 3;            conf.help.maxExpand = 'K, where you can can use B + KM the sparse-matrix memory M when densifying matrices'
 conf.maxExpandIntercept = 10000;     conf.help.maxExpand = 'B, where you can can use B + KM the sparse-matrix memory M when densifying matrices'
 conf.warnAboutDensity = False;       conf.help.warnAboutDensity = 'warn when you fail to densify a matrix'
+conf.auditDtypes = False;           conf.help.auditDtypes = 'count, for each op, dtype conversions and matrices that do not have float32 data and int32 indices'
+conf.maxDistinctRowsExpand = 4.0;    conf.help.maxDistinctRowsExpand = 'K, where distinctRows compares the rows of a matrix only if padding them to the same length needs at most K times its memory'
+conf.maxBlockExpand = 2.0;           conf.help.maxBlockExpand = 'K, where a DenseBlock is used for a matrix if it needs at most K times the memory of the non-zeros of its csr encoding'
+conf.maxBlockProductCells = 1<<22;   conf.help.maxBlockProductCells = 'a DenseBlock is only multiplied by messages whose product has at most this many cells, and larger ones use the csr matrix'
+conf.minBlockDensity = 0.25;         conf.help.minBlockDensity = 'a DenseBlock is used for a matrix only if at least this fraction of the block is non-zero'
+conf.rowBlockThreads = 1;            conf.help.rowBlockThreads = 'number of threads used by byRowBlocks to apply an operation to blocks of rows of a large matrix'
+conf.rowBlockMinNnz = 200000;        conf.help.rowBlockMinNnz = 'matrices with fewer non-zeros than this are not split into row blocks by byRowBlocks'
 
 NP.seterr(all='raise',under='ignore')
 # stop execution & print traceback for various floating-point issues
@@ -27,6 +38,71 @@ NP.seterr(all='raise',under='ignore')
 # comparison to None in scipy is switching to elementwise so we're going to check type instead
 NONETYPE=type(None) 
 
+# dtype audit counts, used if conf.auditDtypes is set: maps (context,event)
+# to the number of times the event happened in that context, where a
+# context is usually an op, and an event is a conversion like
+# 'int64->int32' or a matrix with the wrong dtype like 'indices int64'
+dtypeAudit = collections.Counter()
+# the audit context is set separately by each thread, eg by the
+# branches of a SumFunction that are evaluated in parallel
+_auditState = threading.local()
+_auditLock = threading.Lock()
+
+def setAuditContext(context):
+    """Attribute later dtype audit events in this thread to context."""
+    _auditState.context = context
+
+def _auditContext():
+    return getattr(_auditState,'context','unknown')
+
+def _countAuditEvent(context,event):
+    with _auditLock:
+        dtypeAudit[(context,event)] += 1
+
+def auditDtypes(m,context=None):
+    """In audit mode, count m if it is a csr matrix without float32 data
+    and int32 indices."""
+    if conf.auditDtypes and isinstance(m,SS.csr_matrix):
+        context = context or _auditContext()
+        if m.dtype!=NP.float32: _countAuditEvent(context,'data %s' % m.dtype)
+        if m.indices.dtype!=NP.int32: _countAuditEvent(context,'indices %s' % m.indices.dtype)
+        if m.indptr.dtype!=NP.int32: _countAuditEvent(context,'indptr %s' % m.indptr.dtype)
+
+def dtypeAuditReport():
+    """Return the dtype audit counts as a list of (context,event,count)
+    triples, most frequent first."""
+    return [(context,event,n) for ((context,event),n) in dtypeAudit.most_common()]
+
+def _asDtype(a,dtype):
+    a = NP.asarray(a)
+    if a.dtype==dtype: return a
+    if conf.auditDtypes: _countAuditEvent(_auditContext(),'%s->%s' % (a.dtype,NP.dtype(dtype)))
+    return a.astype(dtype)
+
+def csrMatrix(data,indices,indptr,shape):
+    """Build a csr matrix with float32 data and int32 indices and indptr
+    from the given arrays, without copying arrays that already have
+    those dtypes.  Conversions are counted in audit mode."""
+    return SS.csr_matrix((_asDtype(data,NP.float32),_asDtype(indices,NP.int32),_asDtype(indptr,NP.int32)),
+                         shape=shape,copy=False)
+
+def _indptrFromLengths(rowLens):
+    """An int32 csr indptr array for rows of the given lengths."""
+    indptr = NP.zeros(len(rowLens)+1,dtype=NP.int32)
+    NP.cumsum(rowLens,out=indptr[1:])
+    return indptr
+
+def _rowPositions(indptr,rows):
+    """For a list of rows of a csr matrix with the given indptr, return
+    (positions,newIndptr), where positions indexes the stored entries
+    of those rows, in order, and newIndptr is the indptr of a matrix
+    made of just those rows."""
+    starts = indptr[rows]
+    lens = indptr[NP.asarray(rows)+1] - starts
+    newIndptr = _indptrFromLengths(lens)
+    positions = NP.repeat(starts-newIndptr[:-1],lens) + NP.arange(newIndptr[-1])
+    return positions,newIndptr
+
 def summary(mat):
     """Helpful string describing a matrix for debugging."""
     checkCSR(mat)
@@ -152,7 +228,7 @@ def mapData(dataFun,mat):
     """Apply some function to the mat.data array of the sparse matrix and return a new one."""
     checkCSR(mat)
     newdata = dataFun(mat.data)
-    return SS.csr_matrix((newdata,mat.indices,mat.indptr), shape=mat.shape, dtype='float32')
+    return csrMatrix(newdata,mat.indices,mat.indptr,mat.shape)
 
 def stack(mats):
     """Vertically stack matrices and return a sparse csr matrix."""
@@ -183,13 +259,202 @@ def repeat(row,n):
     d = NP.tile(row.data,n)
     inds = NP.tile(row.indices,n)
     #create the indptr
-    numNZCols = row.indptr[1]
-    if numNZCols>0:
-        ptrs = NP.array(range(0,numNZCols*n+1,numNZCols))
+    ptrs = NP.arange(n+1,dtype=NP.int32)*int(row.indptr[1])
+    return csrMatrix(d,inds,ptrs,(n,numCols(row)))
+
+def grow(m,shape):
+    """Return a csr matrix of a larger shape which agrees with m where m
+    is defined and is zero elsewhere.  The result shares m's data and
+    indices arrays."""
+    checkCSR(m)
+    assert shape[0]>=numRows(m) and shape[1]>=numCols(m),'cannot shrink a %r matrix to %r' % (m.shape,shape)
+    indptr = NP.concatenate([m.indptr, NP.repeat(m.indptr[-1:], shape[0]-numRows(m))])
+    return SS.csr_matrix((m.data,m.indices,indptr),shape=shape,dtype=m.dtype)
+
+def onehotIds(m):
+    """If every row of the csr matrix m is a one-hot vector, return an
+    array with the column of each row's non-zero, and otherwise
+    return None."""
+    if m.nnz==numRows(m) and (NP.diff(m.indptr)==1).all() and (m.data==1.0).all():
+        return m.indices
+    return None
+
+def distinctRows(m):
+    """Return a pair (U,inverse) where U is a csr matrix holding the
+    distinct rows of m, in the order they first appear, and row i of m
+    is row inverse[i] of U.  One-hot rows are compared by their column,
+    and other rows by their sorted non-zeros.  If padding every row to
+    the length of the longest would need more than
+    conf.maxDistinctRowsExpand times the memory of m, all the rows
+    are treated as distinct."""
+    checkCSR(m)
+    n = numRows(m)
+    keys = onehotIds(m)
+    if keys is None:
+        if not m.has_sorted_indices:
+            m = m.copy()
+            m.sort_indices()
+        rowLens = NP.diff(m.indptr)
+        width = int(rowLens.max()) if n else 0
+        if n*(2*width+1) > conf.maxDistinctRowsExpand*(2*m.nnz+n):
+            return m,NP.arange(n,dtype=NP.int32)
+        # each row's key is its length, columns and the bits of its
+        # data, padded with zeros to the longest row
+        keys = NP.zeros((n,2*width+1),dtype=NP.int32)
+        keys[:,0] = rowLens
+        rowIds = NP.repeat(NP.arange(n),rowLens)
+        offsets = NP.arange(m.nnz) - NP.repeat(m.indptr[:-1],rowLens)
+        keys[rowIds,1+offsets] = m.indices
+        keys[rowIds,1+width+offsets] = NP.ascontiguousarray(m.data,dtype=NP.float32).view(NP.int32)
+        # compare the rows by a hash of their keys, and check that
+        # rows with the same hash really are the same
+        coefs = NP.random.RandomState(0).randint(1,2**62,size=keys.shape[1]).astype(NP.uint64)
+        hashes = (keys.astype(NP.uint64)*coefs).sum(axis=1)
+        _,first,inverse = NP.unique(hashes,return_index=True,return_inverse=True)
+        if (keys!=keys[first[inverse.ravel()]]).any():
+            _,first,inverse = NP.unique(keys,axis=0,return_index=True,return_inverse=True)
     else:
-        ptrs = NP.zeros(n+1, dtype='int')
-    return SS.csr_matrix((d,inds,ptrs),shape=(n,numCols(row)), dtype='float32')
+        _,first,inverse = NP.unique(keys,return_index=True,return_inverse=True)
+    # number the distinct rows in the order they first appear
+    order = NP.argsort(first)
+    rank = NP.empty(len(order),dtype=NP.int32)
+    rank[order] = NP.arange(len(order))
+    return gatherRows(m,first[order]),rank[inverse.ravel()]
+
+def gatherRows(m,rows):
+    """Return the csr matrix whose i-th row is row rows[i] of m."""
+    positions,indptr = _rowPositions(m.indptr,rows)
+    return csrMatrix(m.data[positions],m.indices[positions],indptr,(len(rows),numCols(m)))
+
+def sumRowsInto(m,rows,numRowsOut):
+    """Return the csr matrix with numRowsOut rows, where row k is the
+    sum of the rows i of m with rows[i]==k.  This is the adjoint of
+    gatherRows."""
+    checkCSR(m)
+    n = numRows(m)
+    g = SS.csr_matrix((NP.ones(n,dtype=NP.float32),(rows,NP.arange(n))),shape=(numRowsOut,n),dtype='float32')
+    return SS.csr_matrix(g * m,dtype='float32')
+
+def csrIndices(m):
+    """Return an nnz x 2 int64 array holding the (row,column) position of
+    each stored entry of a csr matrix, in the order of m.data, which
+    is the format tensorflow uses for the indices of a SparseTensor."""
+    checkCSR(m)
+    rows = NP.repeat(NP.arange(numRows(m),dtype='int64'), NP.diff(m.indptr))
+    return NP.stack([rows, m.indices.astype('int64')], axis=1)
 
+def transposePermutation(m):
+    """Return (mT,perm), where mT is the transpose of the csr matrix m, in
+    csr format, and perm is an int array such that mT.data is
+    m.data[perm]."""
+    checkCSR(m)
+    positions = SS.csr_matrix((NP.arange(m.nnz),m.indices,m.indptr), shape=m.shape)
+    positionsT = positions.transpose().tocsr()
+    perm = positionsT.data
+    mT = SS.csr_matrix((m.data[perm],positionsT.indices,positionsT.indptr), shape=positionsT.shape, dtype=m.dtype)
+    return mT,perm
+
+def isAllOnes(m):
+    """True if every stored value of a csr matrix is 1.0."""
+    checkCSR(m)
+    return m.nnz>0 and bool(NP.all(m.data==1.0))
+
+def patternOnly(m):
+    """Return a csr matrix with the same structure as m, where every
+    stored value is 1.0.  The values are a read-only view of a single
+    float, so the result needs memory only for indices and indptr.
+    """
+    checkCSR(m)
+    data = NP.broadcast_to(NP.float32(1.0),(m.nnz,))
+    return SS.csr_matrix((data,m.indices,m.indptr),shape=m.shape,dtype='float32')
+
+def isPattern(m):
+    """True if m was produced by patternOnly."""
+    return isinstance(m,SS.csr_matrix) and m.nnz>0 and m.data.strides==(0,)
+
+def patternTranspose(m):
+    """The transpose of a matrix produced by patternOnly, in the same
+    form."""
+    rows = NP.repeat(NP.arange(numRows(m),dtype=m.indices.dtype), NP.diff(m.indptr))
+    order = NP.argsort(m.indices,kind='stable')
+    indptr = NP.zeros(numCols(m)+1,dtype=m.indptr.dtype)
+    NP.cumsum(NP.bincount(m.indices,minlength=numCols(m)),out=indptr[1:])
+    data = NP.broadcast_to(NP.float32(1.0),(m.nnz,))
+    return SS.csr_matrix((data,rows[order],indptr),shape=(numCols(m),numRows(m)),dtype='float32')
+
+def patternVecMatMul(v,m):
+    """Return v*m, where m was produced by patternOnly, by summing the
+    rows of m selected by the non-zeros of v.  Only the selected rows
+    of m are ever given a data array."""
+    checkCSR(v)
+    assert numCols(v)==numRows(m),'cannot multiply %s by %s' % (summary(v),summary(m))
+    needed,inverse = NP.unique(v.indices,return_inverse=True)
+    positions,indptr = _rowPositions(m.indptr,needed)
+    selected = csrMatrix(NP.ones(indptr[-1],dtype='float32'),m.indices[positions],indptr,(len(needed),numCols(m)))
+    # NP.unique always returns int64 positions
+    vSelected = csrMatrix(v.data,inverse.ravel().astype(NP.int32),v.indptr,(numRows(v),len(needed)))
+    return vSelected * selected
+
+class DenseBlock(object):
+    """A matrix whose non-zeros all lie inside a small block of rows and
+    columns, stored as the offset of the block and a dense ndarray
+    holding it.  The transpose shares the ndarray.
+    """
+
+    def __init__(self,rowOffset,colOffset,block,shape):
+        self.rowOffset = rowOffset
+        self.colOffset = colOffset
+        self.block = block
+        self.shape = shape
+
+    @staticmethod
+    def fromCSR(m,maxBlockExpand=-1,minBlockDensity=-1):
+        """Return a DenseBlock encoding the csr matrix m, or None if
+        the dense block would need more than maxBlockExpand times the
+        memory of the data and indices of m, or if less than
+        minBlockDensity of the block is non-zero.  The size of m's
+        indptr is not counted, since it depends only on the number of
+        rows, not on how dense the block is.
+        """
+        checkCSR(m)
+        if maxBlockExpand<0: maxBlockExpand = conf.maxBlockExpand
+        if minBlockDensity<0: minBlockDensity = conf.minBlockDensity
+        if m.nnz==0: return None
+        nonemptyRows = NP.flatnonzero(NP.diff(m.indptr))
+        r0,r1 = nonemptyRows[0],nonemptyRows[-1]+1
+        c0,c1 = NP.min(m.indices),NP.max(m.indices)+1
+        cells = float(r1-r0)*(c1-c0)
+        if cells > maxBlockExpand*2*m.nnz or m.nnz < minBlockDensity*cells:
+            return None
+        block = NP.asarray(m[r0:r1,c0:c1].todense(),dtype='float32')
+        return DenseBlock(int(r0),int(c0),block,m.shape)
+
+    def transpose(self):
+        return DenseBlock(self.colOffset,self.rowOffset,self.block.T,(self.shape[1],self.shape[0]))
+
+    def toCSR(self):
+        (h,w) = self.block.shape
+        tmp = SS.csr_matrix(self.block)
+        indptr = NP.concatenate([NP.zeros(self.rowOffset,dtype=tmp.indptr.dtype),
+                                 tmp.indptr,
+                                 NP.repeat(tmp.indptr[-1],self.shape[0]-self.rowOffset-h)])
+        return SS.csr_matrix((tmp.data,tmp.indices+self.colOffset,indptr),shape=self.shape,dtype='float32')
+
+    def vecMatMul(self,v):
+        """Return the csr matrix v*M, where M is the matrix encoded by
+        this block.  Only the columns of v inside the block's rows
+        are used."""
+        checkCSR(v)
+        assert numCols(v)==self.shape[0],'cannot multiply %s by %r block matrix' % (summary(v),self.shape)
+        (h,w) = self.block.shape
+        d = NP.ascontiguousarray(v[:,self.rowOffset:self.rowOffset+h].dot(self.block),dtype='float32')
+        # find the non-zeros of the flattened product, which are in
+        # csr order, rather than converting d with SS.csr_matrix,
+        # which is several times slower
+        flat = NP.flatnonzero(d)
+        indices = (flat % w + self.colOffset).astype('int32')
+        indptr = NP.searchsorted(flat, NP.arange(numRows(v)+1)*w).astype('int32')
+        return csrMatrix(d.ravel()[flat],indices,indptr,(numRows(v),self.shape[1]))
 
 def alterMatrixRows(mat,alterationFun):
     """ apply alterationFun(data,lo,hi) to each row.
@@ -197,29 +462,135 @@ def alterMatrixRows(mat,alterationFun):
     for i in range(numRows(mat)):
         alterationFun(mat.data,mat.indptr[i],mat.indptr[i+1],mat.indices)
 
-def softmax(db,mat):
-    """ Compute the softmax of each row of a matrix.
+# weight of the score of the null entity in the softmax
+NULL_EPSILON = -10
+
+def _logSoftmaxRows(mat,nullId):
+    """ Row-wise log-softmax over the non-zero entries of a matrix, where
+    every row also gets a score of NULL_EPSILON added to the null
+    entity, whose id is nullId.  Returns (logP,rowIds) where logP is a csr_matrix with
+    log-probabilities in its data array, and rowIds[k] is the row of
+    the k-th stored entry.  This is done with vectorized operations
+    over the CSR arrays, rather than a loop over rows.
+    """
+    checkCSR(mat)
+    n = numRows(mat)
+    data = mat.data.astype('float32')
+    indices = mat.indices
+    indptr = mat.indptr
+    rowLens = NP.diff(indptr)
+    if NP.any(data==0):
+        # explicit zeros are not candidate answers
+        keep = data!=0
+        rowLens = NP.bincount(NP.repeat(NP.arange(n),rowLens)[keep],minlength=n)
+        data = data[keep]
+        indices = indices[keep]
+        indptr = _indptrFromLengths(rowLens)
+    # add NULL_EPSILON to the score of the null entity, inserting a new
+    # entry at the front of rows that don't have one
+    rowIds = NP.repeat(NP.arange(n),rowLens)
+    isNull = indices==nullId
+    data = NP.where(isNull,data+NULL_EPSILON,data).astype('float32')
+    hasNull = NP.zeros(n,dtype=bool)
+    hasNull[rowIds[isNull]] = True
+    missing = NP.flatnonzero(~hasNull)
+    if missing.size:
+        data = NP.insert(data,indptr[missing],NULL_EPSILON).astype('float32')
+        indices = NP.insert(indices,indptr[missing],nullId)
+        rowLens = rowLens + (~hasNull)
+        indptr = _indptrFromLengths(rowLens)
+        rowIds = NP.repeat(NP.arange(n),rowLens)
+    # every row is now non-empty, so reduceat is well-defined
+    rowMax = NP.maximum.reduceat(data,indptr[:-1])
+    assert not NP.any(NP.isnan(rowMax)),"softmax: NaN rowMax"
+    shifted = data - rowMax[rowIds]
+    rowNorm = NP.add.reduceat(NP.exp(shifted),indptr[:-1])
+    logData = shifted - NP.log(rowNorm)[rowIds]
+    logP = csrMatrix(logData,indices,indptr,mat.shape)
+    logP.sort_indices()
+    return logP,rowIds
+
+def _expSoftmaxData(logData):
+    """ Exponentiate log-probabilities, replacing values that underflow
+    to zero with something small. """
+    data = NP.exp(logData)
+    data[data==0] = math.exp(NULL_EPSILON)
+    return data
+
+def softmax(db,mat,typeName=None,nullId=None):
+    """ Compute the softmax of each row of a matrix.  The null entity
+    gets a score of exp(NULL_EPSILON) in every row.  Its id is nullId,
+    or if that is None, the id of the null entity of the given type in
+    db.
+    """
+    if nullId is None: nullId = db.nullId(typeName)
+    logP,_ = _logSoftmaxRows(mat,nullId)
+    return csrMatrix(_expSoftmaxData(logP.data),logP.indices,logP.indptr,logP.shape)
+
+def softmaxCrossEntropy(mat,Y,nullId,rowWeights=None):
+    """ Fused softmax, cross-entropy and gradient computation.  Given
+    unnormalized scores mat, target distributions Y, and the id of the
+    null entity, returns a triple (P,xe,delta) where P=softmax(mat),
+    xe is the summed cross-entropy of P relative to Y, and delta=Y-P
+    is the initial delta for backprop through the unnormalized
+    scores.  If rowWeights
+    is given, row i stands for rowWeights[i] identical examples, so
+    its cross-entropy and delta are multiplied by rowWeights[i].
     """
-    nullEpsilon = -10  # scores for null entity will be exp(nullMatrix)
-    result = db.nullMatrix(numRows(mat),numCols=numCols(mat))*nullEpsilon + mat
-    denseResult,undensifier = densify(result)
-    if type(denseResult)!=NONETYPE:
-        return undensify(denseSoftmax(denseResult), undensifier)
+    checkCSR(Y)
+    logP,_ = _logSoftmaxRows(mat,nullId)
+    P = csrMatrix(_expSoftmaxData(logP.data),logP.indices,logP.indptr,logP.shape)
+    # as in learn.Learner.crossEntropy, target entries outside the support of
+    # P contribute nothing to the loss
+    if rowWeights is None:
+        xe = -float(Y.multiply(logP).sum())
+        delta = SS.csr_matrix(Y - P, dtype='float32')
     else:
-        def softMaxAlteration(data,lo,hi,unused):
-            rowMax = max(data[lo:hi])
-            assert not math.isnan(rowMax),"softMaxAlteration: NaN rowMax"
-            data[lo:hi] = NP.exp(data[lo:hi] - rowMax)
-            rowNorm = sum(data[lo:hi])
-            assert not math.isnan(rowNorm),"softMaxAlteration: NaN rowNorm"
-            data[lo:hi] /= rowNorm
-            #replace the zeros in data, which are underflow, with something small
-            minValue = math.exp(nullEpsilon)
-            segment = data[lo:hi]
-            segment[segment==0] = minValue
-            data[lo:hi] = segment
-        alterMatrixRows(result,softMaxAlteration)
-        return result
+        W = SS.diags(NP.asarray(rowWeights,dtype=NP.float32))
+        xe = -float((W * Y.multiply(logP)).sum())
+        delta = SS.csr_matrix(W * (Y - P), dtype='float32')
+    return P,xe,delta
+
+def sampleSoftmaxCandidates(mat,Y,numSamples,rng=NR):
+    """ Restrict each row of a matrix of unnormalized scores to the
+    entries that are non-zero in Y, plus at most numSamples other
+    entries, sampled without replacement in proportion to their
+    scores.  The score of each sampled entry j is corrected by
+    subtracting log(pi_j), where pi_j = min(1, numSamples*s_j/S) is
+    its approximate probability of inclusion and S is the row total
+    of the non-gold scores, so a softmax over the result approximates
+    the softmax over the full row.
+    """
+    checkCSR(mat); checkCSR(Y)
+    mat = SS.csr_matrix(mat,dtype='float32',copy=True)
+    mat.eliminate_zeros()
+    if mat.nnz==0: return mat
+    n = numRows(mat)
+    rowLens = NP.diff(mat.indptr)
+    rowIds = NP.repeat(NP.arange(n),rowLens)
+    isGold = NP.asarray(Y[rowIds,mat.indices]).ravel()!=0
+    neg = NP.flatnonzero(~isGold)
+    negRows = rowIds[neg]
+    weights = NP.maximum(mat.data[neg],NP.finfo('float32').tiny)
+    # sampling without replacement: the k entries of a row with the
+    # smallest exponential keys -log(u)/w
+    keys = -NP.log(rng.random_sample(len(neg)))/weights
+    order = NP.lexsort((keys,negRows))
+    sortedRows = negRows[order]
+    rank = NP.arange(len(neg)) - NP.searchsorted(sortedRows,sortedRows,side='left')
+    chosen = neg[order[rank<numSamples]]
+    # importance correction for the sampled entries
+    negTotal = NP.bincount(negRows,weights=weights,minlength=n)
+    negCount = NP.bincount(negRows,minlength=n)
+    chosenRows = rowIds[chosen]
+    inclusion = NP.minimum(1.0,numSamples*mat.data[chosen]/negTotal[chosenRows])
+    inclusion[negCount[chosenRows]<=numSamples] = 1.0
+    data = mat.data.copy()
+    data[chosen] -= NP.log(inclusion).astype('float32')
+    keep = isGold
+    keep[chosen] = True
+    newIndptr = NP.concatenate(([0],NP.cumsum(NP.bincount(rowIds[keep],minlength=n))))
+    return SS.csr_matrix((data[keep],mat.indices[keep],newIndptr), shape=mat.shape, dtype='float32')
 
 def denseSoftmax(m):
     #we want to make sure we keep the zero entries as zero
@@ -285,20 +656,8 @@ def shuffleRows(m,shuffledRowNums=None):
     if type(shuffledRowNums)==NONETYPE:
         shuffledRowNums = NP.arange(numRows(m))
         NR.shuffle(shuffledRowNums)
-    data = NP.array(m.data)
-    indices = NP.array(m.indices)
-    indptr = NP.array(m.indptr)
-    lo = 0
-    for i in range(m.indptr.size-1 ):
-        r = shuffledRowNums[i]
-        rowLen = m.indptr[r+1] - m.indptr[r]
-        indptr[i] = lo
-        indptr[i+1] = lo + rowLen
-        lo += rowLen
-        for j in range(rowLen):
-            data[indptr[i]+j] = m.data[m.indptr[r]+j]
-            indices[indptr[i]+j] = m.indices[m.indptr[r]+j]
-    result = SS.csr_matrix((data,indices,indptr), shape=m.shape, dtype='float32')
+    positions,indptr = _rowPositions(m.indptr,shuffledRowNums)
+    result = csrMatrix(m.data[positions],m.indices[positions],indptr,m.shape)
     result.sort_indices()
     return result
 
@@ -310,21 +669,71 @@ def selectRows(m,lo,hi):
     #data for rows [lo, hi) are in cells [jLo...jHi)
     jLo = m.indptr[lo]
     jHi = m.indptr[hi]
-    #allocate space
-    data = NP.zeros(jHi - jLo)
-    indices = NP.zeros(jHi - jLo, dtype='int')
-    indptr = NP.zeros(hi - lo + 1, dtype='int')
-    for i in range(hi - lo):
-        rowLen = m.indptr[lo+i+1] - m.indptr[lo+i]
-        #translate the index pointers
-        indptr[i] = m.indptr[lo+i] - jLo
-        for j in range(rowLen):
-            k = m.indptr[lo+i]+j
-            data[indptr[i] + j] = m.data[k]
-            indices[indptr[i] + j] = m.indices[k]
-    indptr[hi-lo] = m.indptr[hi] - jLo
-    result = SS.csr_matrix((data,indices,indptr), shape=(hi-lo,numCols(m)), dtype='float32')
-    return result
+    return csrMatrix(NP.array(m.data[jLo:jHi],dtype=NP.float32),
+                     NP.array(m.indices[jLo:jHi],dtype=NP.int32),
+                     NP.array(m.indptr[lo:hi+1]-jLo,dtype=NP.int32),
+                     (hi-lo,numCols(m)))
+
+def rowBlock(m,lo,hi):
+    """Return rows lo...hi-1 of a csr matrix, sharing its data and
+    indices arrays."""
+    jLo = m.indptr[lo]
+    jHi = m.indptr[hi]
+    return csrMatrix(m.data[jLo:jHi],m.indices[jLo:jHi],m.indptr[lo:hi+1]-jLo,(hi-lo,numCols(m)))
+
+def stackRowBlocks(blocks):
+    """Vertically stack csr matrices by concatenating their arrays, so
+    the rows of the result are exactly the rows of the blocks."""
+    offsets = NP.cumsum([0] + [b.nnz for b in blocks])
+    indptr = NP.concatenate([blocks[0].indptr[:1]] + [b.indptr[1:]+off for b,off in zip(blocks,offsets)])
+    return csrMatrix(NP.concatenate([b.data for b in blocks]),
+                     NP.concatenate([b.indices for b in blocks]),
+                     indptr,(int(sum(numRows(b) for b in blocks)),numCols(blocks[0])))
+
+def _rowBlockBounds(m,numBlocks):
+    """Split the rows of m into at most numBlocks ranges (lo,hi) with
+    about the same number of non-zeros."""
+    n = numRows(m)
+    targets = NP.arange(1,numBlocks)*(m.nnz/float(numBlocks))
+    cuts = NP.unique(NP.concatenate([[0],NP.searchsorted(m.indptr,targets),[n]]).clip(0,n))
+    return list(zip(cuts[:-1],cuts[1:]))
+
+# the pool used by byRowBlocks, and the process and number of threads
+# it was created for - threads are not inherited by forked processes
+_rowBlockPool = None
+_rowBlockPoolKey = None
+
+def _rowBlockExecutor(threads):
+    global _rowBlockPool,_rowBlockPoolKey
+    if _rowBlockPoolKey!=(os.getpid(),threads):
+        _rowBlockPool = concurrent.futures.ThreadPoolExecutor(threads-1)
+        _rowBlockPoolKey = (os.getpid(),threads)
+    return _rowBlockPool
+
+def byRowBlocks(fun,*mats):
+    """Return fun(*mats), where fun computes each row of its csr output
+    from the same row of its inputs (or from a one-row input, which is
+    broadcast).  If conf.rowBlockThreads>1 and the inputs are large, the
+    inputs with the most rows are split into blocks of rows, fun is
+    applied to the blocks by conf.rowBlockThreads threads, and the
+    outputs are stacked.  The sparse products in scipy and the numpy
+    operations on large arrays release the GIL, so the blocks run in
+    parallel, and the result is the same as the unsplit one.
+    """
+    threads = conf.rowBlockThreads
+    n = max(numRows(m) for m in mats)
+    split = [numRows(m)==n for m in mats]
+    if threads<=1 or n<2 or sum(m.nnz for m,s in zip(mats,split) if s)<conf.rowBlockMinNnz:
+        return fun(*mats)
+    bounds = _rowBlockBounds(max([m for m,s in zip(mats,split) if s],key=lambda m:m.nnz),min(threads,n))
+    errstate = NP.geterr()
+    def doBlock(lo,hi):
+        # numpy's error handling is set per thread
+        with NP.errstate(**errstate):
+            return fun(*[rowBlock(m,lo,hi) if s else m for m,s in zip(mats,split)])
+    futures = [_rowBlockExecutor(threads).submit(doBlock,lo,hi) for (lo,hi) in bounds[1:]]
+    blocks = [doBlock(*bounds[0])] + [f.result() for f in futures]
+    return stackRowBlocks(blocks)
 
 if __name__=="__main__":
     tmp = []
@@ -79,6 +79,16 @@ class Scratchpad(object):
         if key not in self.d:
             self.d[key] = MutableObject()
         self.d[key] = val
+    def slice(self):
+        """A scratchpad for evaluating one subtree of a function in
+        another thread.  It starts with the entries of this scratchpad,
+        and merge copies its entries back."""
+        result = Scratchpad()
+        result.d = dict(self.d)
+        return result
+    def merge(self,other):
+        """Copy the entries of a slice back into this scratchpad."""
+        self.d.update(other.d)
 
 # Arguably the environment and scratchpad should be combined, since
 # they perform similar tasks.  But the environment is indexed by
@@ -46,8 +46,12 @@ class Op(opfunutil.OperatorOrFunction):
     """Evaluate an operator inside an environment."""
     if conf.trace:
       print(('op eval'),self, end=' ')
+    if mutil.conf.auditDtypes:
+      mutil.setAuditContext('%s.eval' % self.__class__.__name__)
     self._doEval(env,pad)
     pad[self.id].output = env[self.dst]
+    if mutil.conf.auditDtypes:
+      mutil.auditDtypes(env[self.dst])
     if conf.trace:
       print(('stores'),mutil.summary(env[self.dst]), end=' ')
       if conf.long_trace>env[self.dst].nnz: print(('holding'),env.db.matrixAsSymbolDict(env[self.dst]), end=' ')
@@ -65,6 +69,8 @@ class Op(opfunutil.OperatorOrFunction):
       print(('call op bp'),self,'delta[',self.dst,'] shape',env.delta[self.dst].get_shape(), end=' ')
       if conf.long_trace: print((env.db.matrixAsSymbolDict(env.delta[self.dst])))
       else: print()
+    if mutil.conf.auditDtypes:
+      mutil.setAuditContext('%s.backprop' % self.__class__.__name__)
     self._doBackprop(env,gradAccum,pad)
     pad[self.id].delta = env.delta[self.dst]
     if conf.trace:
@@ -221,10 +227,10 @@ class VecMatMulOp(Op):
     if self.transpose: buf += ".T"
     return buf
   def _doEval(self,env,pad):
-    env[self.dst] = env[self.src] * env.db.matrix(self.matMode,self.transpose)
+    env[self.dst] = mutil.byRowBlocks(env.db.vecMatMulFunction(self.matMode,self.transpose),env[self.src])
   def _doBackprop(self,env,gradAccum,pad):
     # dst = f(src,mat)
-    env.delta[self.src] = env.delta[self.dst] * env.db.matrix(self.matMode,(not self.transpose))
+    env.delta[self.src] = env.db.vecMatMul(env.delta[self.dst],self.matMode,(not self.transpose))
     mutil.checkCSR(env.delta[self.src],'delta[%s]' % self.src)
     if env.db.isParameter(self.matMode):
       update = env[self.src].transpose() * (env.delta[self.dst])
@@ -282,7 +288,7 @@ class ComponentwiseVecMulOp(Op):
   def _ppLHS(self):
     return "%s o %s" % (self.src,self.src2)
   def _doEval(self,env,pad):
-    env[self.dst] = mutil.broadcastAndComponentwiseMultiply(env[self.src],env[self.src2])
+    env[self.dst] = mutil.byRowBlocks(mutil.broadcastAndComponentwiseMultiply,env[self.src],env[self.src2])
   def _doBackprop(self,env,gradAccum,pad):
     env.delta[self.src] = mutil.broadcastAndComponentwiseMultiply(env.delta[self.dst],env[self.src2])
     env.delta[self.src2] = mutil.broadcastAndComponentwiseMultiply(env.delta[self.dst],env[self.src])
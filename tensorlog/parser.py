@@ -115,6 +115,9 @@ class RuleCollection(object):
     def __init__(self,syntax=None):
         self.index = collections.defaultdict(list)
         self.syntax = syntax or conf.syntax
+        # 'functor/arity' keys of rules as they are added or changed,
+        # so a program can tell which compiled functions are out of date
+        self.changeLog = []
 
     def _key(self,g):
         return '%s/%d' % (g.functor,g.arity)
@@ -122,6 +125,7 @@ class RuleCollection(object):
     def add(self,r):
         key = self._key(r.lhs)
         self.index[key] += [r]
+        self.changeLog.append(key)
 
     def size(self):
         return sum(len(self.index[k]) for k in list(self.index.keys()))
@@ -132,10 +136,13 @@ class RuleCollection(object):
     def mapRules(self,mapfun):
         for key in self.index:
             try:
-              self.index[key] = list(map(mapfun, self.index[key]))
+              mapped = list(map(mapfun, self.index[key]))
             except:
               print(("Trouble mapping rule %s:"%key))
               raise
+            if any(r1 is not r2 for r1,r2 in zip(mapped,self.index[key])):
+              self.changeLog.append(key)
+            self.index[key] = mapped
 
     def listing(self):
         for key in self.index:
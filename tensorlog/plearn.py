@@ -5,6 +5,7 @@
 
 import os
 import time
+import itertools
 import collections
 import multiprocessing
 import multiprocessing.pool
@@ -39,6 +40,26 @@ def _doBackpropTask(task):
     paramGrads = workerLearner.crossEntropyGrad(mode,X,Y,tracerArgs=args)
     return (mutil.numRows(X),paramGrads)
 
+def _workerDataset(shardDir):
+    """Each worker memory-maps a sharded dataset the first time it
+    sees a task for it, and keeps it in a global variable called
+    'workerShards', which is only defined for worker subprocesses.
+    """
+    global workerShards
+    if not 'workerShards' in globals(): workerShards = {}
+    if not shardDir in workerShards:
+        workerShards[shardDir] = dataset.Dataset.deserialize(shardDir)
+    return workerShards[shardDir]
+
+def _doShardBackpropTask(task):
+    """ Like _doBackpropTask, but the task contains only the rows of
+    a sharded dataset to use.
+    """
+    (shardDir,mode,rows,args) = task
+    X,Y = _workerDataset(shardDir).getRows(mode,rows)
+    paramGrads = workerLearner.crossEntropyGrad(mode,X,Y,tracerArgs=args)
+    return (len(rows),paramGrads)
+
 def _doAcceptNewParams(paramDict):
     for (functor,arity),value in list(paramDict.items()):
         workerLearner.prog.db.setParameter(functor,arity,value)
@@ -47,6 +68,11 @@ def _doPredict(miniBatch):
     (mode,X,Y) = miniBatch
     return (mode,X,workerLearner.predict(mode,X))
 
+def _doShardPredict(task):
+    (shardDir,mode,rows) = task
+    X,_ = _workerDataset(shardDir).getRows(mode,rows)
+    return (mode,rows,workerLearner.predict(mode,X))
+
 ##############################################################################
 # A parallel learner.
 ##############################################################################
@@ -88,6 +114,8 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
     #
     def datasetPredict(self,dset,copyXs=True):
         """ Return predictions on a dataset. """
+        if dset.shardDir:
+            return self._shardedDatasetPredict(dset,copyXs)
         xDictBuffer = collections.defaultdict(list)
         yDictBuffer = collections.defaultdict(list)
         miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize,shuffleFirst=False))
@@ -107,6 +135,57 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
         logging.info('predictions restacked')
         return dataset.Dataset(xDict,yDict)
 
+    def _shardedDatasetPredict(self,dset,copyXs):
+        # workers read the inputs from the shards, so only the
+        # predictions are sent back
+        tasks = [(dset.shardDir,mode,rows) for (mode,rows)
+                 in dset.minibatchRowIterator(batchSize=self.miniBatchSize,shuffleFirst=False)]
+        logging.info('predicting for %d sharded miniBatches with the worker pool...' % len(tasks))
+        yDictBuffer = collections.defaultdict(list)
+        for (mode,rows,P) in self.pool.imap(_doShardPredict, tasks, chunksize=1):
+            yDictBuffer[mode].append(P)
+        xDict = {}
+        yDict = {}
+        for mode in yDictBuffer:
+            if copyXs: xDict[mode] = dset.getX(mode)
+            yDict[mode] = mutil.stack(yDictBuffer[mode])
+        return dataset.Dataset(xDict,yDict)
+
+    def backpropTasks(self,dset,i,startTime):
+        """Return a function to map over a list of backprop tasks for
+        one epoch, the list of tasks, and the total number of examples
+        in them.  For a sharded dataset a task holds just the row
+        numbers of a minibatch, not the data."""
+        if dset.shardDir:
+            batches = list(dset.minibatchRowIterator(batchSize=self.miniBatchSize))
+            tasks = [(dset.shardDir,mode,rows,{'i':i,'k':k,'startTime':startTime,'mode':mode})
+                     for k,(mode,rows) in enumerate(batches)]
+            return _doShardBackpropTask,tasks,sum(len(rows) for (mode,rows) in batches)
+        elif isinstance(dset,dataset.StreamingDataset):
+            # the tasks are generated as the file is read, and the
+            # number of examples is only known when they are done
+            tasks = (ParallelFixedRateGDLearner.miniBatchToTask(b,i,k,startTime)
+                     for k,b in enumerate(dset.minibatchIterator(batchSize=self.miniBatchSize)))
+            return _doBackpropTask,tasks,None
+        else:
+            miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize))
+            tasks = [ParallelFixedRateGDLearner.miniBatchToTask(k_b[1],i,k_b[0],startTime) for k_b in enumerate(miniBatches)]
+            return _doBackpropTask,tasks,self.totalNumExamples(miniBatches)
+
+    def mapBackprop(self,bpFun,bpInputs,totalN):
+        """Compute gradients for the tasks from backpropTasks with the
+        worker pool, and return the outputs and the total number of
+        examples.  Tasks from a generator are sent to the pool a few at
+        a time, so only a few minibatches are in memory at once."""
+        if isinstance(bpInputs,list):
+            return self.pool.map(bpFun, bpInputs),totalN
+        bpOutputs = []
+        while True:
+            window = list(itertools.islice(bpInputs,2*self.parallel))
+            if not window: break
+            bpOutputs.extend(self.pool.map(bpFun, window, chunksize=1))
+        return bpOutputs,sum(n for (n,_) in bpOutputs)
+
     @staticmethod
     def miniBatchToTask(batch,i,k,startTime):
         """Convert a minibatch to a task to submit to _doBackpropTask"""
@@ -140,20 +219,16 @@ class ParallelFixedRateGDLearner(learn.FixedRateSGDLearner):
     # 
 
     def train(self,dset):
-        modes = dset.modesToLearn()
         trainStartTime = time.time()
         for i in range(self.epochs):
             logging.info("starting epoch %d" % i)
             startTime = time.time()
             #generate the tasks
-            miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize))
-            bpInputs = [ParallelFixedRateGDLearner.miniBatchToTask(k_b[1],i,k_b[0],startTime) for k_b in enumerate(miniBatches)]
-            totalN = self.totalNumExamples(miniBatches)
-            logging.info("created %d minibatch tasks, total of %d examples" % (len(bpInputs),totalN))
+            bpFun,bpInputs,totalN = self.backpropTasks(dset,i,startTime)
             #generate gradients - in parallel
-            bpOutputs = self.pool.map(_doBackpropTask, bpInputs)
+            bpOutputs,totalN = self.mapBackprop(bpFun,bpInputs,totalN)
             #update params using the gradients
-            logging.info("gradients for %d minibatch tasks computed" % len(bpInputs))
+            logging.info("gradients for %d minibatch tasks computed, total of %d examples" % (len(bpOutputs),totalN))
             self.processGradients(bpOutputs,totalN)
             logging.info("gradients merged")
             # send params to workers
@@ -174,7 +249,6 @@ class ParallelAdaGradLearner(ParallelFixedRateGDLearner):
         super(ParallelAdaGradLearner,self).__init__(prog,**kw)
 
     def train(self,dset):
-        modes = dset.modesToLearn()
         trainStartTime = time.time()
         sumSquareGrads = learn.GradAccumulator()
         for i in range(self.epochs):
@@ -182,12 +256,10 @@ class ParallelAdaGradLearner(ParallelFixedRateGDLearner):
             logging.info("starting epoch %d" % i)
             startTime = time.time()
             #generate the tasks
-            miniBatches = list(dset.minibatchIterator(batchSize=self.miniBatchSize))
-            bpInputs = [ParallelFixedRateGDLearner.miniBatchToTask(k_b[1],i,k_b[0],startTime) for k_b in enumerate(miniBatches)]
-            totalN = self.totalNumExamples(miniBatches)
+            bpFun,bpInputs,totalN = self.backpropTasks(dset,i,startTime)
 
             #generate gradients - in parallel
-            bpOutputs = self.pool.map(_doBackpropTask, bpInputs)
+            bpOutputs,totalN = self.mapBackprop(bpFun,bpInputs,totalN)
 
             # accumulate to sumSquareGrads
             totalGradient = learn.GradAccumulator()
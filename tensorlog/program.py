@@ -3,9 +3,14 @@
 # top-level constructs for Tensorlog - Programs and Interpreters
 #
 
+import gc
+import io
 import sys
+import time
+import pickle
 import logging
 import collections
+import multiprocessing
 import numpy as np
 import os
 
@@ -16,6 +21,7 @@ from tensorlog import declare
 from tensorlog import funs
 from tensorlog import matrixdb
 from tensorlog import mutil
+from tensorlog import ops
 from tensorlog import opfunutil
 from tensorlog import parser
 from tensorlog import util
@@ -23,6 +29,8 @@ from tensorlog import util
 conf = config.Config()
 conf.max_depth = 10;        conf.help.max_depth = "Maximum depth of program recursion"
 conf.normalize = 'softmax'; conf.help.normalize = "Default normalization, set to 'softmax', 'log+softmax', or 'none'"
+conf.result_cache_bytes = 0; conf.help.result_cache_bytes = "If positive, cache up to this many bytes of output rows of eval for one-hot inputs"
+conf.branch_workers = 0;    conf.help.branch_workers = "If more than one, evaluate the rules defining a predicate in this many threads"
 
 ##############################################################################
 ## a program
@@ -33,6 +41,22 @@ class Program(object):
     def __init__(self, db=None, rules=parser.RuleCollection(), plugins=None, calledFromProPPRProgram=False):
         self.db = db
         self.function = {}
+        # dependencies of the compiled functions: for each key
+        # (mode,depth) in self.function, the 'functor/arity' names of
+        # the rules and database predicates it was compiled from, and
+        # the keys of the functions it calls
+        self._usesPreds = {}
+        self._calls = {}
+        self._compiling = []
+        self.numCompiled = 0
+        # changed whenever compiled functions are discarded
+        self.functionVersion = 0
+        # set in compileAll workers, where the parent process installs
+        # the top-level functions
+        self._deferInstall = False
+        self.resultCache = ResultCache(conf.result_cache_bytes) if conf.result_cache_bytes>0 else None
+        # threads used by each SumFunction, see setBranchWorkers
+        self.branchWorkers = conf.branch_workers
         self.rules = rules
         self.maxDepth = conf.max_depth
         self.normalize = conf.normalize
@@ -43,9 +67,94 @@ class Program(object):
             return r
         if not calledFromProPPRProgram:
             self.rules.mapRules(checkRule)
+        self._rulesSeen = len(self.rules.changeLog)
 
     def clearFunctionCache(self):
         self.function = {}
+        self.functionVersion += 1
+        self._usesPreds = {}
+        self._calls = {}
+
+    def updateFunctions(self,changedPreds):
+        """Recompile the functions that depend, directly or through the
+        predicates they call, on the rules or database predicates in
+        changedPreds, a list of 'functor/arity' strings.  Returns the
+        number of functions recompiled.
+        """
+        changed = set(changedPreds)
+        stale = self._invalidate(lambda key: self._usesPreds[key] & changed)
+        return self._recompile(stale,'change to %s' % ",".join(sorted(changed)))
+
+    def setMaxDepth(self,depth):
+        """Reset the max depth, recompiling only the functions that
+        reach the depths where the old and new bounds differ.  Returns
+        the number of functions recompiled."""
+        unchanged = min(depth,self.maxDepth)
+        self.maxDepth = depth
+        stale = self._invalidate(lambda key: key[1]>unchanged)
+        return self._recompile(stale,'max depth change')
+
+    def setNormalize(self,normalize):
+        """Reset the normalizer, which is only applied to the top-level
+        functions, and recompile those.  Returns the number of functions
+        recompiled."""
+        self.normalize = normalize
+        stale = self._invalidate(lambda key: key[1]==0)
+        return self._recompile(stale,'normalizer change')
+
+    def _invalidate(self,isStale):
+        """Remove the compiled functions with keys for which isStale(key)
+        is true, and every function that calls one of them, directly or
+        indirectly.  Returns the removed keys."""
+        callers = collections.defaultdict(set)
+        for key,called in list(self._calls.items()):
+            for k in called: callers[k].add(key)
+        stale = set(key for key in self.function if isStale(key))
+        frontier = list(stale)
+        while frontier:
+            for key in callers[frontier.pop()]:
+                if key not in stale:
+                    stale.add(key)
+                    frontier.append(key)
+        for key in stale:
+            self._forget(key)
+        if stale: self.functionVersion += 1
+        return stale
+
+    def _forget(self,key):
+        self.function.pop(key,None)
+        self._usesPreds.pop(key,None)
+        self._calls.pop(key,None)
+
+    def _recompile(self,stale,why):
+        """Recompile the top-level functions among the stale keys - the
+        deeper ones they need are recompiled along the way."""
+        if not stale: return 0
+        before = self.numCompiled
+        for (mode,depth) in stale:
+            if depth==0: self.compile(mode)
+        n = self.numCompiled - before
+        logging.info('recompiled %d functions after %s (%d invalidated, %d kept)' % (n,why,len(stale),len(self.function)-n))
+        return n
+
+    def _syncRules(self):
+        """Update the compiled functions for rules added since the last
+        call."""
+        log = self.rules.changeLog
+        if len(log)>self._rulesSeen:
+            changed = log[self._rulesSeen:]
+            self._rulesSeen = len(log)
+            self.updateFunctions(changed)
+
+    @staticmethod
+    def _predsUsedBy(mode,predDef):
+        """The 'functor/arity' names of everything a predicate definition
+        refers to."""
+        result = set(['%s/%d' % (mode.functor,mode.arity)])
+        for r in predDef or []:
+            for g in r.rhs + (r.features or []) + (r.findall or []):
+                result.add('%s/%d' % (g.functor,g.arity))
+        return result
 
     def findPredDef(self,mode):
         """Find the set of rules with a lhs that match the given mode."""
@@ -54,15 +163,32 @@ class Program(object):
     def compile(self,mode,depth=0):
         """ Produce an funs.Function object which implements the predicate definition
         """
+        key = (mode,depth)
+        if self._compiling:
+            self._calls[self._compiling[-1]].add(key)
+        else:
+            self._syncRules()
+        if key not in self.function:
+            self._usesPreds[key] = set()
+            self._calls[key] = set()
+            self._compiling.append(key)
+            try:
+                self._compileUncached(mode,depth)
+            except:
+                self._forget(key)
+                raise
+            finally:
+                self._compiling.pop()
+            self.numCompiled += 1
+        return self.function[key]
+
+    def _compileUncached(self,mode,depth):
         #find the rules which define this predicate/function
-
-        if (mode,depth) in self.function:
-            return self.function[(mode,depth)]
-
         if depth>self.maxDepth:
             self.function[(mode,depth)] = funs.NullFunction(mode)
         else:
             predDef = self.findPredDef(mode)
+            self._usesPreds[(mode,depth)] = self._predsUsedBy(mode,predDef)
             if predDef is None or len(list(predDef))==0:
                 assert False,'no rules match mode %s' % mode
             elif len(predDef)==1:
@@ -75,6 +201,7 @@ class Program(object):
                 #clauses
                 ruleFuns = [bpcompiler.BPCompiler(mode,self,depth,r).getFunction() for r in predDef]
                 self.function[(mode,depth)] = funs.SumFunction(ruleFuns)
+                self.function[(mode,depth)].workers = self.branchWorkers
             if depth==0:
                 if self.normalize=='softmax':
                     self.function[(mode,0)] = funs.SoftmaxFunction(self.function[(mode,0)])
@@ -85,13 +212,68 @@ class Program(object):
                 else:
                     assert not self.normalize, 'bad value of self.normalize: %r' % self.normalize
                 # label internal nodes/ops of function with ids
-                self.function[(mode,0)].install()
-        return self.function[(mode,depth)]
+                if not self._deferInstall:
+                    self.function[(mode,0)].install()
+
+    def compileAll(self,modes,workers=None):
+        """Compile a list of modes, with a pool of worker processes.
+        workers is an integer number of workers or None, which will
+        be interpreted as the number of CPUs; if it is 0 or 1 the
+        modes are compiled one after another in this process.  The
+        result is the same as calling compile for each mode in order.
+        """
+        modes = [m for m in modes if (m,0) not in self.function]
+        workers = multiprocessing.cpu_count() if workers is None else workers
+        if workers<=1 or len(modes)<=1:
+            for mode in modes: self.compile(mode)
+            return
+        self._syncRules()
+        # several small chunks per worker, to balance the load
+        chunkSize = max(1,len(modes)//(4*workers))
+        chunks = [modes[i:i+chunkSize] for i in range(0,len(modes),chunkSize)]
+        pool = multiprocessing.get_context('fork').Pool(
+            workers, initializer=_initCompileWorker, initargs=(self,))
+        try:
+            for payload in pool.imap_unordered(_doCompileTask, chunks):
+                self._adoptCompiled(payload)
+        finally:
+            pool.close()
+            pool.join()
+        # install in order, as compile would have
+        for mode in modes:
+            self.function[(mode,0)].install()
+        logging.info('compiled %d modes with %d workers' % (len(modes),workers))
+
+    def _adoptCompiled(self,payload):
+        """Add the functions compiled by a compileAll worker, keeping any
+        function already compiled for the same (mode,depth), and make
+        the DefinedPredOps in the new functions call the kept ones."""
+        # unpickling makes many small objects, which otherwise trigger
+        # repeated collections over the whole heap
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            entries = _CompiledUnpickler(io.BytesIO(payload),self).load()
+        finally:
+            if gcWasEnabled: gc.enable()
+        adopted = []
+        for key,fun,usesPreds,calls in entries:
+            if key not in self.function:
+                self.function[key] = fun
+                self._usesPreds[key] = usesPreds
+                self._calls[key] = calls
+                self.numCompiled += 1
+                adopted.append(fun)
+        def relink(node):
+            if isinstance(node,ops.DefinedPredOp):
+                node.subfun = self.function[(node.funMode,node.depth)]
+            else:
+                for child in node.children(): relink(child)
+        for fun in adopted:
+            relink(fun)
 
     def getPredictFunction(self,mode):
-        if (mode,0) not in self.function: self.compile(mode)
-        fun = self.function[(mode,0)]
-        return fun
+        return self.getFunction(mode)
 
     def getParamList(self):
         """ Return a set of (functor,arity) pairs corresponding to the parameters """
@@ -99,6 +281,7 @@ class Program(object):
 
     def getFunction(self,mode):
         """ Return the compiled function for a mode """
+        self._syncRules()
         if (mode,0) not in self.function: self.compile(mode)
         return self.function[(mode,0)]
 
@@ -109,15 +292,69 @@ class Program(object):
         """
         return self.eval(mode, [self.db.onehot(s,typeName=typeName) for s in symbols])
 
+    def evalIds(self,mode,ids,typeName=None):
+        """ After compilation, evaluate a function on a batch of queries.
+        Input is an array of integer symbol ids, which is converted
+        directly to a matrix X with one onehot row per id, without any
+        symbol lookups.  If typeName is not given the input type of the
+        compiled function is used.  Row k of the result is the answer
+        for ids[k].
+        """
+        if typeName is None and not self.db.isTypeless():
+            typeName = self.getFunction(mode).inputTypes[0]
+        return self.eval(mode, [self.db.onehotsFromIds(ids,typeName=typeName)])
+
     def eval(self,mode,inputs):
         """ After compilation, evaluate a function.  Input is a list of onehot
         vectors, which will be bound to the corresponding input
         arguments.
         """
-        if (mode,0) not in self.function: self.compile(mode)
-        fun = self.function[(mode,0)]
+        fun = self.getFunction(mode)
+        if self.resultCache is not None and len(inputs)==1:
+            return self._cachedEval(mode,fun,inputs[0])
         return fun.eval(self.db, inputs, opfunutil.Scratchpad())
 
+    def setBranchWorkers(self,workers):
+        """Evaluate and backprop through the rules defining a predicate
+        in a pool of this many threads, or one after another if workers
+        is 0 or 1.  This applies to functions already compiled as well
+        as later ones."""
+        self.branchWorkers = workers
+        def setWorkers(node):
+            if isinstance(node,funs.SumFunction):
+                node.workers = workers
+            for child in node.children():
+                setWorkers(child)
+        for fun in self.function.values():
+            setWorkers(fun)
+
+    def enableResultCache(self,maxBytes):
+        """Cache up to maxBytes of the output rows computed by eval, or
+        stop caching if maxBytes is zero."""
+        self.resultCache = ResultCache(maxBytes) if maxBytes>0 else None
+
+    def _cachedEval(self,mode,fun,X):
+        """Evaluate fun on X, using cached output rows for the one-hot
+        rows of X that have been seen before, and evaluating only the
+        other rows."""
+        ids = mutil.onehotIds(X)
+        if ids is None:
+            return fun.eval(self.db, [X], opfunutil.Scratchpad())
+        cache = self.resultCache
+        cache.setVersion((self.normalize,self.db.paramVersion,self.functionVersion))
+        keys = [(mode,i) for i in ids.tolist()]
+        rows = [cache.get(key) for key in keys]
+        missing = [r for r,row in enumerate(rows) if row is None]
+        if missing:
+            start = time.time()
+            P = fun.eval(self.db, [X[missing]], opfunutil.Scratchpad())
+            cache.recordMisses(len(missing),time.time()-start)
+            for k,r in enumerate(missing):
+                rows[r] = P[k]
+                cache.put(keys[r],rows[r])
+            if len(missing)==len(rows): return P
+        return rows[0] if len(rows)==1 else mutil.stack(rows)
+
     def evalGradSymbols(self,mode,symbols):
         """ After compilation, evaluate a function.  Input is a list of
         symbols that will be converted to onehot vectors, and bound to
@@ -131,8 +368,7 @@ class Program(object):
         vectors, which will be bound to the corresponding input
         arguments.
         """
-        if (mode,0) not in self.function: self.compile(mode)
-        fun = self.function[(mode,0)]
+        fun = self.getFunction(mode)
         return fun.evalGrad(self.db, inputs)
 
     def setAllWeights(self):
@@ -199,6 +435,138 @@ class Program(object):
       return parser.Parser(syntax='pythonic').parseStream(fileLike)
 
 
+##############################################################################
+# These functions are defined at the top-level of a module so that
+# they can be sent to worker processes via pickling.
+##############################################################################
+
+def _initCompileWorker(prog):
+    """Called when each subprocess in a compileAll pool is created, to
+    save the program in a global variable called 'workerProg', and a
+    map from the ids of the functions already sent back to the parent
+    process to their (mode,depth) keys.
+    """
+    global workerProg,workerShipped
+    workerProg = prog
+    workerProg._deferInstall = True
+    workerShipped = dict((id(fun),key) for key,fun in prog.function.items())
+
+def _doCompileTask(modes):
+    """Compile some modes, and return the new functions as a pickled
+    list of (key,function,usesPreds,calls) tuples.  The program, and
+    functions already known to the parent, are pickled as references,
+    so they are not copied."""
+    for mode in modes:
+        workerProg.compile(mode)
+    entries = [(key,fun,workerProg._usesPreds[key],workerProg._calls[key])
+               for key,fun in workerProg.function.items() if id(fun) not in workerShipped]
+    buf = io.BytesIO()
+    _CompiledPickler(buf,workerProg,workerShipped).dump(entries)
+    for key,fun,_,_ in entries:
+        workerShipped[id(fun)] = key
+    return buf.getvalue()
+
+class _CompiledPickler(pickle.Pickler):
+    def __init__(self,fileLike,prog,shipped):
+        super(_CompiledPickler,self).__init__(fileLike,pickle.HIGHEST_PROTOCOL)
+        self.prog = prog
+        self.shipped = shipped
+    def persistent_id(self,obj):
+        if obj is self.prog: return ('prog',)
+        if isinstance(obj,funs.Function) and id(obj) in self.shipped: return ('fun',self.shipped[id(obj)])
+        return None
+
+class _CompiledUnpickler(pickle.Unpickler):
+    def __init__(self,fileLike,prog):
+        super(_CompiledUnpickler,self).__init__(fileLike)
+        self.prog = prog
+    def persistent_load(self,pid):
+        if pid[0]=='prog': return self.prog
+        return self.prog.function[pid[1]]
+
+class ResultCache(object):
+    """An LRU cache of rows output by the functions of a Program,
+    keyed by (mode, input symbol id).  The cache is emptied when its
+    version, which changes with the normalization, the database
+    parameters, and the compiled functions, changes.  Rows are stored
+    as arrays and returned as new 1-row sparse matrices, and the least
+    recently used rows are evicted to keep their total size, including
+    the bookkeeping for each row, under maxBytes.
+    """
+
+    # estimated bytes used by the key of a row and its slot in the
+    # OrderedDict, beyond what sys.getsizeof reports for the row
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self,maxBytes):
+        self.maxBytes = maxBytes
+        self.rows = collections.OrderedDict()
+        self.numBytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.missTime = 0.0
+
+    @staticmethod
+    def _entry(row):
+        return (np.array(row.data,dtype='float32'),np.array(row.indices,dtype='int32'),row.shape[1])
+
+    @staticmethod
+    def _size(row):
+        """Bytes used to cache a row, which is a 1-row csr matrix or an
+        entry built from one."""
+        entry = row if isinstance(row,tuple) else ResultCache._entry(row)
+        data,indices,_ = entry
+        return sys.getsizeof(data) + sys.getsizeof(indices) + sys.getsizeof(entry) + ResultCache.ENTRY_OVERHEAD
+
+    def setVersion(self,version):
+        """Drop all the rows if the version has changed."""
+        if version!=self.version:
+            self.clear()
+            self.version = version
+
+    def get(self,key):
+        entry = self.rows.get(key)
+        if entry is None:
+            return None
+        self.rows.move_to_end(key)
+        self.hits += 1
+        # callers get their own copy, which they can change
+        data,indices,numCols = entry
+        return mutil.csrMatrix(data.copy(),indices.copy(),np.array([0,len(data)],dtype='int32'),(1,numCols))
+
+    def put(self,key,row):
+        entry = self._entry(row)
+        size = self._size(entry)
+        if size>self.maxBytes: return
+        if key in self.rows:
+            self.numBytes -= self._size(self.rows.pop(key))
+        self.rows[key] = entry
+        self.numBytes += size
+        while self.numBytes>self.maxBytes:
+            _,evicted = self.rows.popitem(last=False)
+            self.numBytes -= self._size(evicted)
+
+    def recordMisses(self,n,seconds):
+        self.misses += n
+        self.missTime += seconds
+
+    def clear(self):
+        self.rows.clear()
+        self.numBytes = 0
+
+    def hitRate(self):
+        return self.hits/float(max(1,self.hits+self.misses))
+
+    def savedTime(self):
+        """Estimated seconds saved, assuming each hit would have taken the
+        average evaluation time of a miss."""
+        return self.hits*self.missTime/max(1,self.misses)
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'hitRate':self.hitRate(),
+                'savedTime':self.savedTime(), 'rows':len(self.rows), 'bytes':self.numBytes}
+
 #
 # subclass of Program that corresponds more or less to Proppr....
 #
@@ -231,7 +599,7 @@ class ProPPRProgram(Program):
             pass
         elif ruleIdPred is not None:
             # TODO check this stuff and add type inference!
-            assert (ruleIdPred,1) in self.db.matEncoding,'there is no unary predicate called %s' % ruleIdPred
+            assert self.db.inDB(ruleIdPred,1),'there is no unary predicate called %s' % ruleIdPred
             self.db.markAsParameter("weighted",1)
             self.db.setParameter("weighted",1,self.db.vector(declare.asMode('%s(o)' % ruleIdPred)) * epsilon)
         else:
@@ -246,7 +614,7 @@ class ProPPRProgram(Program):
 
     def getRuleWeights(self):
         """ Return a vector of the weights for a rule """
-        return self.db.matEncoding[('weighted',1)]
+        return self.db._current(('weighted',1))
 
     def setFeatureWeights(self,epsilon=1.0):
         def possibleModes(rule):
@@ -0,0 +1,66 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# benchmark evaluation of large minibatches with the ops split into
+# row blocks (see mutil.byRowBlocks) by different numbers of threads
+#
+
+import sys
+import time
+import multiprocessing
+import numpy.random as NR
+
+from tensorlog import declare
+from tensorlog import matrixdb
+from tensorlog import mutil
+from tensorlog import parser
+from tensorlog import program
+
+RULES = ['p(X,Y):-r(X,Z),r(Z,Y).', 'p(X,Y):-r(X,Y),s(Y).']
+
+def syntheticProgram(numEntities=20000,degree=20,seed=0):
+  """A program over a random graph r/2 with about degree edges from
+  each entity, and a weighted property s/1 of some of them."""
+  rng = NR.RandomState(seed)
+  lines = []
+  for i in range(numEntities):
+    for j in rng.randint(numEntities,size=degree):
+      lines.append('r\te%d\te%d\t%.3f\n' % (i,j,rng.uniform(0.5,1.5)))
+    if i%3==0:
+      lines.append('s\te%d\t%.3f\n' % (i,rng.uniform(0.5,1.5)))
+  db = matrixdb.MatrixDB()
+  db.addLines(lines)
+  rules = parser.RuleCollection()
+  for r in RULES: rules.add(parser.Parser().parseRule(r))
+  return program.Program(db=db,rules=rules)
+
+def timeEval(prog,X,threads,repeats=3):
+  """Return (best time in seconds,output) for evaluating p/io on the
+  rows of X with conf.rowBlockThreads set to threads."""
+  mode = declare.asMode('p/io')
+  saved = mutil.conf.rowBlockThreads
+  mutil.conf.rowBlockThreads = threads
+  try:
+    best = None
+    for _ in range(repeats):
+      start = time.time()
+      result = prog.eval(mode,[X])
+      elapsed = time.time() - start
+      best = elapsed if best is None else min(best,elapsed)
+    return best,result
+  finally:
+    mutil.conf.rowBlockThreads = saved
+
+if __name__=="__main__":
+  numRows = int(sys.argv[1]) if len(sys.argv)>1 else 5000
+  maxThreads = int(sys.argv[2]) if len(sys.argv)>2 else multiprocessing.cpu_count()
+  prog = syntheticProgram()
+  X = prog.db.onehots(['e%d' % i for i in NR.RandomState(1).randint(20000,size=numRows)])
+  base,expected = timeEval(prog,X,1)
+  print('threads\tsec\tspeedup\tsame output')
+  print('1\t%.3f\t1.00\tTrue' % base)
+  threads = 2
+  while threads<=maxThreads:
+    secs,result = timeEval(prog,X,threads)
+    same = (result!=expected).nnz==0
+    print('%d\t%.3f\t%.2f\t%s' % (threads,secs,base/secs,same))
+    threads *= 2
@@ -0,0 +1,411 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# cross-compiler that generates straight-line python code over scipy
+# sparse matrices
+#
+
+import logging
+import re
+import numpy as NP
+import scipy.sparse as SS
+
+from tensorlog import config
+from tensorlog import declare
+from tensorlog import learnxcomp
+from tensorlog import mutil
+from tensorlog import ops
+from tensorlog import xcomp
+
+conf = config.Config()
+conf.showSource = False; conf.help.showSource = 'log the python source generated for each mode'
+
+class SciPyCrossCompiler(xcomp.AbstractCrossCompiler):
+  """Cross-compiles a tensorlog function to flat python functions which
+  call scipy sparse operations directly, in the same representation
+  used by the native tensorlog engine, so there is none of the
+  per-operator dispatch, environment, scratchpad or tracing overhead
+  of funs.Function.eval.  For each mode, source is generated for four
+  functions - proof counting, inference, data loss, and the gradient
+  of the data loss - where the gradient code is produced by
+  reverse-mode differentiation of the same sequence of operations.
+  Constant DB matrices, and their transposes, are bound as closure
+  variables of the generated functions.
+
+  Plugins are python functions from scipy sparse matrices to a scipy
+  sparse matrix.  Their outputs are treated as constants when
+  computing gradients.
+
+  As for the other cross-compilers, the gradients are gradients of
+  the loss, so they have the opposite sign of the updates computed
+  by learn.Learner.crossEntropyGrad.
+  """
+
+  def __init__(self,prog):
+    super(SciPyCrossCompiler,self).__init__(prog)
+    # values bound in the generated code, and their names
+    self._consts = []
+    self._constNames = []
+    self._constValue = {}
+    # current values of the parameters, and the positions of the
+    # parameters in that list, indexed by (functor,arity)
+    self._params = []
+    self._paramIndex = {}
+    self._paramNames = set()
+    # maps the name of a constant matrix to the name of its transpose
+    self._transposeOf = {}
+    # maps expression names to the python functions that compute them
+    self._compiledFuns = {}
+    self._nextVarId = 0
+
+  #
+  # learning
+  #
+
+  def applyUpdate(self,key,grad,rate):
+    """Take a gradient step on the parameter with the given (functor,arity)
+    key, and clip negative weights to zero, as in
+    learn.Learner.applyUpdate.
+    """
+    i = self._paramIndex[key]
+    m = self._params[i] - rate*grad
+    self._params[i] = mutil.mapData(lambda d:NP.clip(d,0.0,NP.finfo('float32').max), SS.csr_matrix(m))
+
+  def source(self,mode,inputs=None):
+    """ Return the python source generated for a mode
+    """
+    mode = self.ensureCompiled(mode,inputs=inputs)
+    return self._wsDict[mode].source
+
+  #
+  # building the forward code
+  #
+
+  def _newVar(self,prefix='v'):
+    self._nextVarId += 1
+    return '%s%d' % (prefix,self._nextVarId)
+
+  def _bindConst(self,val,prefix='c'):
+    name = '%s%d' % (prefix,len(self._consts))
+    self._consts.append(val)
+    self._constNames.append(name)
+    self._constValue[name] = val
+    return name
+
+  def _needsGrad(self,expr):
+    return (expr in self.ws.needsGrad) or (expr in self._paramNames)
+
+  def _emit(self,kind,rows,template,*inputs):
+    """Append the line 'v = template % inputs' to the forward code for
+    the current workspace, where v is a new variable, and record the
+    operation so it can be differentiated.  rows is 'one' if v has a
+    single row, and 'batch' if it has one row per example.
+    """
+    rhs = template % inputs
+    if kind!='plugin':
+      if all(x in self._constValue for x in inputs):
+        # fold operations on constants into a new constant
+        return self._bindConst(eval(rhs,_codeGlobals(),self._constValue))
+      if rhs in self.ws.computed:
+        # reuse the result of an earlier identical operation
+        return self.ws.computed[rhs]
+    v = self._newVar()
+    self.ws.code.append('%s = %s' % (v,rhs))
+    if kind!='plugin': self.ws.computed[rhs] = v
+    self.ws.tape.append((kind,v) + inputs)
+    self.ws.rows[v] = rows
+    if kind!='plugin' and any(self._needsGrad(x) for x in inputs):
+      self.ws.needsGrad.add(v)
+    return v
+
+  def _rows(self,*exprs):
+    return 'batch' if any(self.ws.rows.get(x)=='batch' for x in exprs) else 'one'
+
+  #
+  # the xcomp interface
+  #
+
+  def _doCompile(self,fun,mode,inputs):
+    # lines of forward code, and the operations they perform
+    self.ws.code = []
+    self.ws.tape = []
+    # 'one' or 'batch' for each vector-valued variable
+    self.ws.rows = {}
+    # variables that depend on some parameter
+    self.ws.needsGrad = set()
+    # maps transposed parameter matrices back to the parameters
+    self.ws.transposeOf = {}
+    # maps right-hand sides of lines of code to the variables they set
+    self.ws.computed = {}
+    super(SciPyCrossCompiler,self)._doCompile(fun,mode,inputs)
+
+  def _op2Expr(self,nspacer,op,depth):
+    # plugins are called when the generated code is run
+    if isinstance(op,ops.CallPlugin):
+      pluginFun = self._bindConst(self.prog.plugins.definition(op.mode),prefix='plugin')
+      srcs = [nspacer[s] for s in op.srcs]
+      template = pluginFun + '(' + ','.join(['%s']*len(srcs)) + ')'
+      return self._emit('plugin',self._rows(*srcs),template,*srcs)
+    return super(SciPyCrossCompiler,self)._op2Expr(nspacer,op,depth)
+
+  def _createPlaceholder(self,name,kind,typeName):
+    assert kind=='vector'
+    x = self._newVar('x')
+    self.ws.rows[x] = 'batch'
+    return x
+
+  def _insertHandleExpr(self,key,name,val,broadcast=False):
+    if key in self.db.paramSet:
+      # parameters are read from self._params each time a generated
+      # function is called, so they can be updated in learning
+      self._paramIndex[key] = len(self._params)
+      self._params.append(val)
+      expr = 'p%d' % self._paramIndex[key]
+      self._paramNames.add(expr)
+    else:
+      expr = self._bindConst(val)
+      if key[1]==2:
+        exprT = self._bindConst(SS.csr_matrix(val.transpose()))
+        self._transposeOf[expr] = exprT
+        self._transposeOf[exprT] = expr
+    self._handleExpr[key] = self._handleExprVar[key] = expr
+
+  def _wrapMsg(self,vec):
+    return vec if (SS.issparse(vec) and vec.format=='csr') else SS.csr_matrix(vec,dtype='float32')
+
+  def _wrapDBVector(self,vec):
+    return vec
+
+  def _wrapDBMatrix(self,mat):
+    return mat
+
+  def _unwrapDBVector(self,key,vec):
+    return vec
+
+  def _unwrapDBMatrix(self,key,mat):
+    return mat
+
+  def _unwrapOutput(self,x):
+    return x
+
+  def _unwrapUpdate(self,key,up):
+    return up
+
+  def _transposeMatrixExpr(self,m):
+    if m in self._transposeOf:
+      return self._transposeOf[m]
+    mT = self._emit('transpose','mat','SS.csr_matrix(%s.transpose())',m)
+    self.ws.transposeOf[mT] = m
+    return mT
+
+  def _softmaxFun2Expr(self,subExpr,typeName):
+    return self._emit('softmax',self._rows(subExpr),'mutil.softmax(None,%%s,nullId=%d)' % self.db.nullId(typeName),subExpr)
+
+  def _vecMatMulExpr(self,v,m):
+    return self._emit('matmul',self._rows(v),'%s.dot(%s)',v,m)
+
+  def _componentwiseMulExpr(self,v1,v2):
+    return self._emit('mul',self._rows(v1,v2),'mutil.broadcastAndComponentwiseMultiply(%s,%s)',v1,v2)
+
+  def _weightedVecExpr(self,vec,weighter):
+    return self._emit('weighted',self._rows(vec,weighter),'mutil.broadcastAndWeightByRowSum(%s,%s)',vec,weighter)
+
+  def _addupExprs(self,accum,addend):
+    if self.ws.rows.get(accum,'one')==self.ws.rows.get(addend,'one'):
+      return self._emit('add',self._rows(accum,addend),'%s + %s',accum,addend)
+    else:
+      return self._emit('add','batch','_broadcastAndAdd(%s,%s)',accum,addend)
+
+  def _buildLossExpr(self,mode):
+    ws = self._wsDict[mode]
+    target_y = self._createPlaceholder(xcomp.TRAINING_TARGET_VARNAME,'vector',ws.inferenceOutputType)
+    ws.dataLossArgs = ws.inferenceArgs + [target_y]
+    ws.dataLossExpr = self._newVar('loss')
+    if ws.proofCountExpr is None:
+      logging.warn('no loss or gradient for %s - it is not softmax normalized' % str(mode))
+      ws.dataLossGradExprs = []
+      ws.gradCode = []
+    else:
+      # the fused softmax and cross-entropy computes delta = Y-P, and
+      # -delta is the gradient of the loss wrt the proof counts
+      ws.gradCode = self._backpropCode(ws,ws.proofCountExpr,'-delta')
+
+  def _finalizeCompile(self,mode):
+    ws = self._wsDict[mode]
+    ws.source = self._generateSource(ws)
+    if conf.showSource:
+      logging.info('python code for %s:\n%s' % (str(mode),ws.source))
+    env = _codeGlobals()
+    exec(compile(ws.source,'<scipyxcomp %s>' % str(mode),'exec'), env)
+    proofCountFun,inferenceFun,dataLossFun,dataLossGradFun = env['_bind'](self._consts,self._params)
+    self._compiledFuns[ws.proofCountExpr] = proofCountFun
+    self._compiledFuns[ws.inferenceExpr] = inferenceFun
+    self._compiledFuns[ws.dataLossExpr] = dataLossFun
+    self._compiledFuns[tuple(ws.dataLossGradExprs)] = dataLossGradFun
+
+  def _asOneInputFunction(self,arg1,expr,wrapInputs,unwrapOutputs):
+    f = self._compiledFuns[expr]
+    def closure(rawInput1):
+      input1 = self._wrapMsg(rawInput1) if wrapInputs else rawInput1
+      return f(input1)
+    return closure
+
+  def _asTwoInputFunction(self,arg1,arg2,expr,wrapInputs,unwrapOutputs):
+    f = self._compiledFuns[expr]
+    def closure(rawInput1,rawInput2):
+      input1 = self._wrapMsg(rawInput1) if wrapInputs else rawInput1
+      input2 = self._wrapMsg(rawInput2) if wrapInputs else rawInput2
+      return f(input1,input2)
+    return closure
+
+  def _exprListAsUpdateFunction(self,arg1,arg2,exprList,wrapInputs,unwrapOutputs):
+    f = self._compiledFuns[tuple(exprList)]
+    def closure(rawInput1,rawInput2):
+      input1 = self._wrapMsg(rawInput1) if wrapInputs else rawInput1
+      input2 = self._wrapMsg(rawInput2) if wrapInputs else rawInput2
+      return list(zip(self.prog.getParamList(), f(input1,input2)))
+    return closure
+
+  def getLearnedParam(self,key,session=None):
+    return self._params[self._paramIndex[key]]
+
+  #
+  # code generation
+  #
+
+  def _forwardLines(self,ws,expr):
+    """The lines of forward code needed to compute expr."""
+    for k,entry in enumerate(ws.tape):
+      if entry[1]==expr: return ws.code[:k+1]
+    return []
+
+  def _backpropCode(self,ws,expr,delta):
+    """Return lines of code that propagate delta, the gradient of the loss
+    wrt expr, back to the parameters, and set ws.dataLossGradExprs to
+    the variables holding the gradients of the parameters, in the
+    order of prog.getParamList().
+    """
+    code = []
+    deltaOf = {}
+    def accum(x,d,dRows):
+      if not self._needsGrad(x): return
+      if ws.rows.get(x,'one')=='one' and dRows=='batch':
+        # x was broadcast to every example, so sum its gradients
+        d = '_sumRows(%s)' % d
+      if x in deltaOf:
+        code.append('%s = %s + %s' % (deltaOf[x],deltaOf[x],d))
+      else:
+        deltaOf[x] = self._newVar('d')
+        code.append('%s = %s' % (deltaOf[x],d))
+    def transposeOf(m):
+      if m in self._transposeOf: return self._transposeOf[m]
+      elif m in ws.transposeOf: return ws.transposeOf[m]
+      else: return 'SS.csr_matrix(%s.transpose())' % m
+    accum(expr,delta,'batch')
+    numLines = len(self._forwardLines(ws,expr))
+    for entry in reversed(ws.tape[:numLines]):
+      kind,v,args = entry[0],entry[1],entry[2:]
+      if v not in deltaOf: continue
+      d = deltaOf[v]
+      rows = ws.rows[v]
+      if kind=='matmul':
+        (a,m) = args
+        accum(a, '%s.dot(%s)' % (d,transposeOf(m)), rows)
+        accum(m, 'SS.csr_matrix(%s.transpose().dot(%s))' % (a,d), 'mat')
+      elif kind=='transpose':
+        (m,) = args
+        accum(m, 'SS.csr_matrix(%s.transpose())' % d, 'mat')
+      elif kind=='mul':
+        (a,b) = args
+        accum(a, 'mutil.broadcastAndComponentwiseMultiply(%s,%s)' % (d,b), rows)
+        accum(b, 'mutil.broadcastAndComponentwiseMultiply(%s,%s)' % (d,a), rows)
+      elif kind=='weighted':
+        # see ops.WeightedVec._doBackprop
+        (vec,weighter) = args
+        accum(vec, 'mutil.broadcastAndWeightByRowSum(%s,%s)' % (d,weighter), rows)
+        accum(weighter, 'mutil.broadcastAndWeightByRowSum(%s,mutil.broadcastAndComponentwiseMultiply(%s,%s))' % (weighter,d,vec), rows)
+      elif kind=='add':
+        (a,b) = args
+        accum(a, d, rows)
+        accum(b, d, rows)
+      else:
+        assert False,'cannot differentiate through %s' % kind
+    ws.dataLossGradExprs = []
+    for (functor,arity) in self.prog.getParamList():
+      p = self._handleExprVar.get((functor,arity))
+      if p in deltaOf:
+        ws.dataLossGradExprs.append(deltaOf[p])
+      else:
+        # the parameter is not used in this mode
+        zeros = SS.csr_matrix(self.db.getParameter(functor,arity).shape,dtype='float32')
+        ws.dataLossGradExprs.append(self._bindConst(zeros,prefix='z'))
+    return code
+
+  def _generateSource(self,ws):
+    """Return the source of a function _bind(_consts,_params), which
+    returns the proof count, inference, data loss and data loss
+    gradient functions for the workspace.
+    """
+    x = ws.inferenceArgs[0]
+    y = ws.dataLossArgs[1]
+    def indent(lines): return ['    '+line for line in lines]
+    body = []
+    if ws.proofCountExpr is not None:
+      pcLines = indent(self._forwardLines(ws,ws.proofCountExpr))
+      body += ['  def proofCount(%s):' % x] + pcLines + ['    return %s' % ws.proofCountExpr]
+    else:
+      body += ['  proofCount = None']
+    body += ['  def inference(%s):' % x] + indent(self._forwardLines(ws,ws.inferenceExpr)) + ['    return %s' % ws.inferenceExpr]
+    if ws.proofCountExpr is not None:
+      body += ['  def dataLoss(%s,%s):' % (x,y)] + pcLines
+      nullId = self.db.nullId(ws.inferenceOutputType)
+      body += ['    P,xe,delta = mutil.softmaxCrossEntropy(%s,%s,%d)' % (ws.proofCountExpr,y,nullId), '    return xe']
+      body += ['  def dataLossGrad(%s,%s):' % (x,y)] + pcLines
+      body += ['    P,xe,delta = mutil.softmaxCrossEntropy(%s,%s,%d)' % (ws.proofCountExpr,y,nullId)]
+      body += indent(ws.gradCode) + ['    return [%s]' % ','.join(ws.dataLossGradExprs)]
+    else:
+      body += ['  dataLoss = dataLossGrad = None']
+    body += ['  return proofCount,inference,dataLoss,dataLossGrad']
+    # read the parameters at the start of each function, and bind the
+    # constants used in the body as closure variables
+    used = set(re.findall(r'\b[a-z]+\d+\b','\n'.join(body)))
+    paramLines = ['    %s = _params[%s]' % (p,p[1:]) for p in sorted(self._paramNames & used)]
+    withParams = []
+    for line in body:
+      withParams.append(line)
+      if line.startswith('  def '): withParams += paramLines
+    lines = ['def _bind(_consts,_params):']
+    lines += ['  %s = _consts[%d]' % (name,i) for i,name in enumerate(self._constNames) if name in used]
+    return '\n'.join(lines + withParams) + '\n'
+
+# helpers called by the generated code
+
+def _codeGlobals():
+  return {'mutil':mutil, 'SS':SS, '_sumRows':_sumRows, '_broadcastAndAdd':_broadcastAndAdd}
+
+def _sumRows(m):
+  """ Sum the rows of m, returning a one-row matrix """
+  return SS.csr_matrix(NP.ones((1,m.shape[0]),dtype='float32')).dot(m)
+
+def _broadcastAndAdd(m1,m2):
+  """ compute m1+m2, but broadcast m1 or m2 if it has one row """
+  if m1.shape[0]==m2.shape[0]: return m1+m2
+  elif m1.shape[0]==1: return mutil.repeat(m1,m2.shape[0]) + m2
+  else: return m1 + mutil.repeat(m2,m1.shape[0])
+
+class FixedRateGDLearner(learnxcomp.BatchEpochsLearner):
+  """ A gradient descent learner.
+  """
+
+  def __init__(self,prog,xc=None,compilerClass=SciPyCrossCompiler,epochs=20,rate=0.1,regularizer=None,tracer=None,epochTracer=None):
+    if xc is None: xc = compilerClass(prog)
+    super(FixedRateGDLearner,self).__init__(prog,xc,compilerClass=compilerClass,regularizer=regularizer,tracer=tracer,epochTracer=epochTracer)
+    self.epochs=epochs
+    self.rate=rate
+
+  def trainMode(self,mode,X,Y,epochs=-1):
+    if epochs<0: epochs=self.epochs
+    if isinstance(mode,str):mode=declare.asMode(mode)
+    gradFun = self.xc.dataLossGradFunction(mode)
+    for i in range(epochs):
+      for key,grad in gradFun(X,Y):
+        self.xc.applyUpdate(key,grad,self.rate)
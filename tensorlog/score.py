@@ -0,0 +1,206 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# offline batch scoring of a large query file with a pool of workers
+#
+
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+import multiprocessing.pool
+import numpy as NP
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import dataset
+from tensorlog import matrixdb
+from tensorlog import util
+
+conf = config.Config()
+conf.chunkSize = 100;    conf.help.chunkSize = 'number of queries sent to a worker at a time'
+conf.maxInFlight = 4;    conf.help.maxInFlight = 'max number of chunks per worker that have been read but not yet written'
+conf.topK = 10;          conf.help.topK = 'number of answers written for each query'
+conf.reportEvery = 100;  conf.help.reportEvery = 'log throughput after this many chunks'
+
+##############################################################################
+# These functions are defined at the top-level of a module so that
+# they can be sent to worker processes via pickling.
+##############################################################################
+
+def _initWorker(prog,topK):
+    """Called when each subprocess in the pool is created, to save a
+    copy of the program in a global variable called 'workerProg'.
+    Note: this global variable is only defined and used for worker
+    subprocesses.
+    """
+    global workerProg,workerTopK
+    workerProg = prog
+    workerTopK = topK
+
+def _doScoreTask(chunk):
+    return scoreChunk(workerProg,chunk,workerTopK)
+
+##############################################################################
+# reading queries and scoring them
+##############################################################################
+
+def queryChunks(fileName,chunkSize,proppr=None):
+    """Read queries from a .exam or .examples file as a stream, and
+    yield them as lists of at most chunkSize (mode,x) pairs, in the
+    order they appear in the file.  Any labels in the file are
+    ignored.
+    """
+    if proppr is None: proppr = fileName.endswith(".examples")
+    chunk = []
+    for line in util.linesIn(fileName):
+        mode,x,_ = dataset.Dataset._parseLine(line,proppr=proppr)
+        if mode:
+            chunk.append((mode,x))
+            if len(chunk)>=chunkSize:
+                yield chunk
+                chunk = []
+    if chunk: yield chunk
+
+def scoreChunk(prog,chunk,topK):
+    """Score a list of (mode,x) queries, returning a list of
+    (mode,x,answers,msec) tuples in the same order, where answers is a
+    list of the topK (score,y) pairs for x, and msec is the time per
+    query for the chunk.  Queries with the same mode are evaluated
+    together as a single minibatch.
+    """
+    start = time.time()
+    db = prog.db
+    rowsByMode = {}
+    for i,(mode,x) in enumerate(chunk):
+        rowsByMode.setdefault(mode,[]).append(i)
+    result = [None]*len(chunk)
+    for mode,rows in list(rowsByMode.items()):
+        if not prog.findPredDef(mode):
+            logging.warn('no definition for mode %s: skipping %d queries' % (mode,len(rows)))
+            for i in rows: result[i] = (mode,chunk[i][1],[])
+            continue
+        xType = db.schema.getDomain(mode.getFunctor(),2)
+        yType = db.schema.getRange(mode.getFunctor(),2)
+        X = db.onehots([chunk[i][1] for i in rows],typeName=xType,outOfVocabularySymbolsAllowed=True)
+        P = prog.eval(mode,[X])
+        nullId = db.schema.getId(yType,matrixdb.NULL_ENTITY_NAME)
+        for r,i in enumerate(rows):
+            lo,hi = P.indptr[r],P.indptr[r+1]
+            ids = P.indices[lo:hi]
+            scores = P.data[lo:hi]
+            keep = ids!=nullId
+            ids,scores = ids[keep],scores[keep]
+            # stable sort, so ties are broken by symbol id
+            order = NP.argsort(-scores,kind='mergesort')[:topK]
+            answers = [(float(scores[j]),db.schema.getSymbol(yType,ids[j])) for j in order]
+            result[i] = (mode,chunk[i][1],answers)
+    msec = 1000.0*(time.time()-start)/max(1,len(chunk))
+    return [(mode,x,answers,msec) for (mode,x,answers) in result]
+
+def writeProPPRSolutions(fp,scoredChunk,start=0):
+    """Write scored queries in the ProPPR solutions.txt format, as in
+    expt.Expt.predictionAsProPPRSolutions.  Returns the number of
+    queries written."""
+    for k,(mode,x,answers,msec) in enumerate(scoredChunk):
+        fp.write('# proved %d\t%s(%s,X1).\t%d msec\n' % (start+k+1,mode.functor,x,int(msec)))
+        for r,(py,y) in enumerate(answers):
+            fp.write('%d\t%.18f\t%s(%s,%s).\n' % (r+1,py,mode.functor,x,y))
+    return len(scoredChunk)
+
+class Scorer(object):
+    """Score the queries in a file with a pool of worker processes, and
+    write the top answers in the ProPPR solutions format.  Queries are
+    read as a stream, and no more than maxInFlight chunks per worker
+    are read but not yet written at any time, so memory use does not
+    grow with the size of the query file.  Output is in the same order
+    as the input.
+
+    parallel is an integer number of workers or None, which will be
+    interpreted as the number of CPUs.  If parallel is zero, queries
+    are scored in the current process.
+    """
+
+    def __init__(self,prog,parallel=None,chunkSize=None,maxInFlight=None,topK=None):
+        self.prog = prog
+        self.parallel = multiprocessing.cpu_count() if parallel is None else parallel
+        self.chunkSize = chunkSize or conf.chunkSize
+        self.maxInFlight = maxInFlight or conf.maxInFlight
+        self.topK = topK or conf.topK
+        self.pool = None
+        if self.parallel>0:
+            self.pool = multiprocessing.pool.Pool(
+                self.parallel, initializer=_initWorker, initargs=(self.prog,self.topK))
+            logging.info('created pool of %d workers' % self.parallel)
+
+    def _boundedChunks(self,chunks,slots):
+        # Pool.imap pulls tasks from its input in a separate thread as
+        # fast as it can, so a slot must be free before we read a chunk
+        for chunk in chunks:
+            slots.acquire()
+            yield chunk
+
+    def scoredChunks(self,fileName,proppr=None):
+        """Generate the scored chunks for a file of queries, in order."""
+        chunks = queryChunks(fileName,self.chunkSize,proppr=proppr)
+        if not self.pool:
+            for chunk in chunks:
+                yield scoreChunk(self.prog,chunk,self.topK)
+        else:
+            slots = threading.Semaphore(self.parallel*self.maxInFlight)
+            for scoredChunk in self.pool.imap(_doScoreTask, self._boundedChunks(chunks,slots), chunksize=1):
+                slots.release()
+                yield scoredChunk
+
+    def score(self,fileName,outFile,proppr=None):
+        """Score queries in fileName and write the solutions to outFile.
+        Returns the number of queries scored and the number scored per
+        second."""
+        start = time.time()
+        n = 0
+        with open(outFile,'w') as fp:
+            for k,scoredChunk in enumerate(self.scoredChunks(fileName,proppr=proppr)):
+                n += writeProPPRSolutions(fp,scoredChunk,start=n)
+                if not (k+1)%conf.reportEvery:
+                    logging.info('scored %d queries at %.1f qps' % (n,n/(time.time()-start)))
+        qps = n/max(time.time()-start,1e-6)
+        logging.info('scored %d queries in %.3f sec at %.1f qps' % (n,time.time()-start,qps))
+        return n,qps
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+if __name__=="__main__":
+
+    usageLines = [
+        'score-specific options, given after the argument +++:',
+        '    --input f           # f is a .exam or .examples file of queries',
+        '    --output g          # solutions are written to file g',
+        '    --topK k            # write top k answers for each query (default %d)' % conf.topK,
+        '    --parallel n        # number of worker processes (default #cpus, 0 for no pool)',
+        '    --chunkSize c       # queries sent to a worker at a time (default %d)' % conf.chunkSize,
+        '    --maxInFlight m     # max unwritten chunks per worker (default %d)' % conf.maxInFlight,
+    ]
+    argSpec = ["input=", "output=", "topK=", "parallel=", "chunkSize=", "maxInFlight="]
+    optdict,args = comline.parseCommandLine(
+        sys.argv[1:],
+        extraArgConsumer="score", extraArgSpec=argSpec, extraArgUsage=usageLines
+    )
+    assert 'input' in optdict and 'output' in optdict, '--input and --output are required'
+    db = optdict['db']
+    if 'proppr' in optdict and not all(db.parameterIsInitialized(f,a) for (f,a) in db.paramList):
+        # not a trained model, so use the default weights
+        optdict['prog'].setFeatureWeights()
+        optdict['prog'].setRuleWeights()
+    parallel = int(optdict['parallel']) if 'parallel' in optdict else None
+    scorer = Scorer(optdict['prog'],
+                    parallel=parallel,
+                    chunkSize=int(optdict.get('chunkSize',conf.chunkSize)),
+                    maxInFlight=int(optdict.get('maxInFlight',conf.maxInFlight)),
+                    topK=int(optdict.get('topK',conf.topK)))
+    n,qps = scorer.score(optdict['input'],optdict['output'])
+    scorer.close()
+    print('scored %d queries at %.1f qps' % (n,qps))
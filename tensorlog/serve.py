@@ -0,0 +1,374 @@
+# (C) William W. Cohen and Carnegie Mellon University, 2017
+#
+# serve queries to a program over a socket, with a pool of worker
+# processes, and generate load for a server
+#
+# protocol: each request is a line holding a JSON object like
+#   {"id": 17, "mode": "predict/io", "x": "doc21", "topK": 5}
+# where id and topK are optional, and each response is a line like
+#   {"id": 17, "answers": [[0.93, "pos"], [0.07, "neg"]]}
+# or {"id": 17, "error": "..."}.  Responses on a connection may come
+# back in a different order than the requests.
+#
+
+import sys
+import json
+import time
+import getopt
+import socket
+import asyncio
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+import numpy as NP
+
+from tensorlog import comline
+from tensorlog import config
+from tensorlog import declare
+from tensorlog import score
+
+conf = config.Config()
+conf.topK = 10;          conf.help.topK = 'default number of answers returned for each query'
+conf.batchSize = 32;     conf.help.batchSize = 'max number of queries sent to a worker at a time'
+conf.batchWait = 0.002;  conf.help.batchWait = 'seconds to wait for more queries before sending a partial batch'
+conf.maxInFlight = 2;    conf.help.maxInFlight = 'max number of batches per worker being scored at a time'
+conf.maxPending = 1000;  conf.help.maxPending = 'queries admitted but not yet answered; more are rejected as overloaded'
+
+##############################################################################
+# These functions are defined at the top-level of a module so that
+# they can be sent to worker processes via pickling.
+##############################################################################
+
+def _initWorker(prog):
+    """Called when each subprocess in the pool is created, to save the
+    program in a global variable called 'workerProg'.  Workers are
+    forked, so the program and its database are not copied, and
+    pages that are only read stay shared with the server.
+    """
+    global workerProg
+    workerProg = prog
+
+def _doServeTask(task):
+    chunk,topK = task
+    return _scoreEach(workerProg,chunk,topK)
+
+def _scoreEach(prog,chunk,topK):
+    """Score a chunk of queries with score.scoreChunk, and if that fails,
+    score the queries one at a time, so a query that can't be scored
+    doesn't fail the others.  Returns a list of (answers,error) pairs,
+    where error is None or a message.
+    """
+    try:
+        return [(answers,None) for (_,_,answers,_) in score.scoreChunk(prog,chunk,topK)]
+    except Exception as ex:
+        if len(chunk)==1:
+            logging.warning('scoring %s failed: %s' % (chunk[0][1],ex))
+            return [(None,str(ex))]
+    return [pair for query in chunk for pair in _scoreEach(prog,[query],topK)]
+
+##############################################################################
+# the server
+##############################################################################
+
+class Server(object):
+    """An asyncio server that answers queries to a program, sent over a
+    local TCP or Unix socket in the JSON-lines protocol described
+    above.  Queries from all connections are grouped into batches of
+    at most batchSize, and each batch is scored by a pool of forked
+    worker processes.
+
+    There is backpressure at two points: at most maxInFlight batches
+    per worker are being scored at once, and at most maxPending
+    queries are admitted but unanswered - queries beyond that are
+    answered immediately with an 'overloaded' error.
+
+    workers is an integer number of workers or None, which will be
+    interpreted as the number of CPUs.  If workers is zero, queries
+    are scored in a single thread of the server process, since
+    evaluating a program is not thread-safe.
+    """
+
+    def __init__(self,prog,workers=None,topK=None,batchSize=None,batchWait=None,maxInFlight=None,maxPending=None):
+        self.prog = prog
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+        self.topK = topK or conf.topK
+        self.batchSize = batchSize or conf.batchSize
+        self.batchWait = conf.batchWait if batchWait is None else batchWait
+        self.maxInFlight = maxInFlight or conf.maxInFlight
+        self.maxPending = maxPending or conf.maxPending
+        self.pending = 0
+        self.numAnswered = 0
+        self.numRejected = 0
+        self.pool = None
+        self.executor = None
+        if self.workers>0:
+            self.pool = multiprocessing.get_context('fork').Pool(
+                self.workers, initializer=_initWorker, initargs=(self.prog,))
+            logging.info('created pool of %d workers' % self.workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._server = None
+        self._queue = None
+        self._batcher = None
+        self._loop = None
+        self._thread = None
+
+    async def start(self,host='127.0.0.1',port=0,path=None):
+        """Start listening on a Unix socket if path is given, and otherwise
+        on a TCP port, where port 0 picks a free port.  Returns the
+        address, which is a path or a (host,port) pair."""
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max(1,self.workers)*self.maxInFlight)
+        self._batcher = asyncio.ensure_future(self._batchQueries())
+        if path:
+            self._server = await asyncio.start_unix_server(self._handleConnection,path=path)
+            address = path
+        else:
+            self._server = await asyncio.start_server(self._handleConnection,host=host,port=port)
+            address = self._server.sockets[0].getsockname()[:2]
+        logging.info('serving on %r' % (address,))
+        return address
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+
+    def startInBackground(self,host='127.0.0.1',port=0,path=None):
+        """Run the server's event loop in a daemon thread, and return its
+        address once it is listening."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        result = {}
+        def run():
+            asyncio.set_event_loop(self._loop)
+            result['address'] = self._loop.run_until_complete(self.start(host=host,port=port,path=path))
+            started.set()
+            self._loop.run_forever()
+        self._thread = threading.Thread(target=run,daemon=True)
+        self._thread.start()
+        started.wait()
+        return result['address']
+
+    def close(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(),self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def _handleConnection(self,reader,writer):
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line: break
+            if not line.strip(): continue
+            task = asyncio.ensure_future(self._answer(line,writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks: await asyncio.wait(tasks)
+        writer.close()
+
+    async def _answer(self,line,writer):
+        response = {}
+        try:
+            request = json.loads(line)
+            response['id'] = request.get('id')
+            query = (declare.asMode(request['mode']),request['x'])
+            topK = int(request.get('topK',self.topK))
+        except Exception as ex:
+            response['error'] = 'bad request: %s' % ex
+        else:
+            if not self.prog.findPredDef(query[0]):
+                response['error'] = 'no definition for mode %s' % query[0]
+            elif self.pending>=self.maxPending:
+                self.numRejected += 1
+                response['error'] = 'overloaded'
+            else:
+                self.pending += 1
+                future = asyncio.get_event_loop().create_future()
+                await self._queue.put((query,topK,future))
+                try:
+                    response['answers'] = [[py,y] for (py,y) in (await future)]
+                except Exception as ex:
+                    response['error'] = str(ex)
+                self.pending -= 1
+                self.numAnswered += 1
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    async def _batchQueries(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batchWait
+            while len(batch)<self.batchSize:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),max(0.0,deadline-loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            asyncio.ensure_future(self._scoreBatch(batch))
+
+    async def _scoreBatch(self,batch):
+        chunk = [query for (query,_,_) in batch]
+        topK = max(topK for (_,topK,_) in batch)
+        try:
+            if self.pool:
+                loop = asyncio.get_event_loop()
+                future = loop.create_future()
+                def deliver(fun,arg): loop.call_soon_threadsafe(lambda: future.done() or fun(arg))
+                self.pool.apply_async(_doServeTask, ((chunk,topK),),
+                                      callback=lambda r: deliver(future.set_result,r),
+                                      error_callback=lambda e: deliver(future.set_exception,e))
+                scored = await future
+            else:
+                scored = await asyncio.get_event_loop().run_in_executor(self.executor, _scoreEach, self.prog, chunk, topK)
+            for (_,k,f),(answers,error) in zip(batch,scored):
+                if error is None: f.set_result(answers[:k])
+                else: f.set_exception(ValueError(error))
+        except Exception as ex:
+            logging.warning('scoring failed: %s' % ex)
+            for (_,_,f) in batch:
+                if not f.done(): f.set_exception(ex)
+        finally:
+            self._slots.release()
+
+##############################################################################
+# clients
+##############################################################################
+
+def _connect(address):
+    if isinstance(address,str):
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+class Client(object):
+    """A blocking client for a server, mostly useful for testing.  The
+    address is a Unix socket path or a (host,port) pair."""
+
+    def __init__(self,address):
+        self.sock = _connect(address)
+        self.fp = self.sock.makefile('rwb')
+        self.nextId = 0
+
+    def query(self,mode,x,topK=None):
+        """Return the list of (score,y) answers for mode and input x, or
+        raise a ValueError if the server returns an error."""
+        self.nextId += 1
+        request = {'id':self.nextId, 'mode':str(mode), 'x':x}
+        if topK is not None: request['topK'] = topK
+        self.fp.write((json.dumps(request) + '\n').encode('utf-8'))
+        self.fp.flush()
+        response = json.loads(self.fp.readline())
+        if 'error' in response: raise ValueError(response['error'])
+        return [(py,y) for (py,y) in response['answers']]
+
+    def close(self):
+        self.fp.close()
+        self.sock.close()
+
+async def _openConnection(address):
+    if isinstance(address,str):
+        return await asyncio.open_unix_connection(path=address)
+    else:
+        return await asyncio.open_connection(host=address[0],port=address[1])
+
+async def _loadFromOneConnection(address,queries,latencies,errors,topK):
+    reader,writer = await _openConnection(address)
+    for mode,x in queries:
+        start = time.time()
+        writer.write((json.dumps({'mode':str(mode),'x':x,'topK':topK}) + '\n').encode('utf-8'))
+        response = json.loads(await reader.readline())
+        if 'error' in response: errors.append(response['error'])
+        else: latencies.append(time.time()-start)
+    writer.close()
+
+def generateLoad(address,queries,concurrency=8,topK=1):
+    """Send a list of (mode,x) queries to a server over concurrency
+    connections, each sending its next query when the last is
+    answered.  Returns a dictionary with the number of answers and
+    errors, the queries per second, and the 50th, 90th, 99th and
+    100th percentile latencies in milliseconds."""
+    latencies = []
+    errors = []
+    async def run():
+        await asyncio.gather(*[
+            _loadFromOneConnection(address,queries[k::concurrency],latencies,errors,topK)
+            for k in range(concurrency)])
+    start = time.time()
+    asyncio.run(run())
+    elapsed = time.time() - start
+    msec = 1000.0*NP.array(latencies) if latencies else NP.zeros(1)
+    return {'answered':len(latencies), 'errors':len(errors), 'qps':len(latencies)/max(elapsed,1e-6),
+            'p50':NP.percentile(msec,50), 'p90':NP.percentile(msec,90),
+            'p99':NP.percentile(msec,99), 'max':NP.max(msec)}
+
+def _parseAddress(optdict):
+    if 'unix' in optdict: return optdict['unix']
+    return (optdict.get('host','127.0.0.1'),int(optdict.get('port',8765)))
+
+if __name__=="__main__":
+
+    if sys.argv[1:2]==['--loadgen']:
+        # python -m tensorlog.serve --loadgen --input f [--port p | --unix path] [--concurrency c] [--requests n]
+        optlist,_ = getopt.getopt(sys.argv[2:], 'x', ["input=","host=","port=","unix=","concurrency=","requests=","topK="])
+        optdict = dict((k[2:],v) for (k,v) in optlist)
+        queries = [q for chunk in score.queryChunks(optdict['input'],1000) for q in chunk]
+        n = int(optdict.get('requests',len(queries)))
+        queries = (queries * (n//max(1,len(queries)) + 1))[:n]
+        stats = generateLoad(_parseAddress(optdict),queries,
+                             concurrency=int(optdict.get('concurrency',8)),topK=int(optdict.get('topK',1)))
+        print('answered %(answered)d queries, %(errors)d errors, at %(qps).1f qps' % stats)
+        print('latency msec: p50 %(p50).2f p90 %(p90).2f p99 %(p99).2f max %(max).2f' % stats)
+        sys.exit(0)
+
+    usageLines = [
+        'serve-specific options, given after the argument +++:',
+        '    --port p            # listen on local TCP port p (default 8765)',
+        '    --host h            # listen on host h (default 127.0.0.1)',
+        '    --unix path         # listen on a Unix socket instead of TCP',
+        '    --workers n         # number of worker processes (default #cpus, 0 for no pool)',
+        '    --topK k            # default number of answers for each query (default %d)' % conf.topK,
+        '    --batchSize b       # max queries scored by a worker at a time (default %d)' % conf.batchSize,
+        '    --maxPending m      # max queries admitted but not answered (default %d)' % conf.maxPending,
+        'to generate load for a running server:',
+        '    python -m tensorlog.serve --loadgen --input f [--port p | --unix path] [--concurrency c] [--requests n]',
+    ]
+    argSpec = ["port=", "host=", "unix=", "workers=", "topK=", "batchSize=", "maxPending="]
+    optdict,args = comline.parseCommandLine(
+        sys.argv[1:],
+        extraArgConsumer="serve", extraArgSpec=argSpec, extraArgUsage=usageLines
+    )
+    db = optdict['db']
+    if 'proppr' in optdict and not all(db.parameterIsInitialized(f,a) for (f,a) in db.paramList):
+        # not a trained model, so use the default weights
+        optdict['prog'].setFeatureWeights()
+        optdict['prog'].setRuleWeights()
+    server = Server(optdict['prog'],
+                    workers=int(optdict['workers']) if 'workers' in optdict else None,
+                    topK=int(optdict.get('topK',conf.topK)),
+                    batchSize=int(optdict.get('batchSize',conf.batchSize)),
+                    maxPending=int(optdict.get('maxPending',conf.maxPending)))
+    address = _parseAddress(optdict)
+    async def main():
+        if isinstance(address,str): await server.start(path=address)
+        else: await server.start(host=address[0],port=address[1])
+        await asyncio.Event().wait()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -16,23 +16,19 @@ from tensorlog import matrixdb
 from tensorlog import parser
 from tensorlog import program
 from tensorlog import xctargets
-if xctargets.tf:
-  import tensorflow as tf
-  from tensorlog import tensorflowxcomp
-if xctargets.theano:
-  from tensorlog import theanoxcomp
 
 
 
 class Compiler(object):
 
-  def __init__(self,target='tensorflow',db=None,prog=None,rule_features=True,autoset_db_params=True,summary_file=None):
+  def __init__(self,target='tensorflow',db=None,prog=None,rule_features=True,autoset_db_params=True,summary_file=None,sparse_inputs=False):
 
     """Create an object with a simple interface that wraps a tensorlog compiler.
     Args:
 
       target: a string indicating the target language, currently
-      'tensorflow' or 'theano'
+      'tensorflow', 'theano', or 'scipy'.  Most of the methods below
+      are only available for 'tensorflow'.
 
       db: specifies the database used by tensorflow. Either a
         tensorlog.matrixdb.MatrixDB object, or a string that can be
@@ -72,6 +68,13 @@ class Compiler(object):
       summary_file: if not None, and if target=='tensorflow', this
         location will be used as to hold summary data for tensorboard
         on the tensorlog operations.
+
+      sparse_inputs: if True, and if target=='tensorflow', then inputs
+        and target outputs are sparse placeholders, so examples are
+        fed to tensorflow without converting them to dense matrices.
+        Use the placeholders themselves (or input_placeholder_name and
+        target_output_placeholder_name, which return them) as
+        feed_dict keys.
     """
 
     # parse the db argument
@@ -105,14 +108,21 @@ class Compiler(object):
 
     # parse the target argument
     self.target = target
+    # the cross-compiler modules are only imported when needed
     if target=='tensorflow':
       if not xctargets.tf: assert False, "tensorflow not available"
-      self.xc = tensorflowxcomp.SparseMatDenseMsgCrossCompiler(self.prog, summaryFile=summary_file)
+      tfxcomp = xctargets.load(target)
+      if sparse_inputs:
+        self.xc = tfxcomp.SparseMatSparseMsgCrossCompiler(self.prog, summaryFile=summary_file)
+      else:
+        self.xc = tfxcomp.SparseMatDenseMsgCrossCompiler(self.prog, summaryFile=summary_file)
     elif target=='theano':
       if not xctargets.theano: assert False, "theano not available"
-      self.xc = theanoxcomp.SparseMatDenseMsgCrossCompiler(self.prog)
+      self.xc = xctargets.load(target).SparseMatDenseMsgCrossCompiler(self.prog)
+    elif target=='scipy':
+      self.xc = xctargets.load(target).SciPyCrossCompiler(self.prog)
     else:
-      assert False,'illegal target %r: valid targets are "tensorflow" and "theano"' % target
+      assert False,'illegal target %r: valid targets are "tensorflow", "theano" and "scipy"' % target
 
   def get_cross_compiler(self):
     return self.xc
@@ -265,10 +275,11 @@ class Compiler(object):
     X is a matrix that can be used as a batch input to the inference
     function, and Y is a matrix that is the desired output.
 
-    Note that X is 'unwrapped', which may make it much larger than the
-    sparse matrix which is stored.  If this exceeds memory Python
-    usually just crashes.  In this case you should use
-    load_big_dataset instead.
+    Note that X is 'wrapped', which unless the compiler was created
+    with sparse_inputs=True converts it to a dense matrix, which may
+    be much larger than the sparse matrix which is stored.  If this
+    exceeds memory Python usually just crashes.  In this case you
+    should use sparse_inputs=True, or use load_big_dataset instead.
 
     Args:
 
@@ -308,11 +319,7 @@ class Compiler(object):
     else:
       assert False,'illegal dataset object %r' % dataset_obj
 
-  def minibatches(self,dataset_obj,batch_size=100,shuffle_first=True):
-    """Yields a series of pairs (mode,(X,Y)) where X and Y are a minibatch
-    suitable for training the function designated by mode.  Input is
-    something returned by load_small_dataset or load_big_dataset.
-    """
+  def _as_dataset(self,dataset_obj):
     if isinstance(dataset_obj,dict):
       dataset_dict = dataset_obj
       x_dict = {}
@@ -321,16 +328,51 @@ class Compiler(object):
         mode = declare.asMode(mode_str)
         x_dict[mode] = self.xc.unwrapInput(x)
         y_dict[mode] = self.xc.unwrapInput(y)
-        dset = dataset.Dataset(x_dict,y_dict)
-      for mode,bx,by in dset.minibatchIterator(batchSize=batch_size,shuffleFirst=shuffle_first):
-        yield str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
+      return dataset.Dataset(x_dict,y_dict)
     elif isinstance(dataset_obj, dataset.Dataset):
-      dset = dataset_obj
-      for mode,bx,by in dset.minibatchIterator(batchSize=batch_size,shuffleFirst=shuffle_first):
-        yield str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
+      return dataset_obj
+    elif isinstance(dataset_obj, str):
+      return dataset.Dataset.deserialize(dataset_obj)
     else:
       assert False,'illegal dataset object %r' % dataset_obj
 
+  def input_pipeline(self,mode,dataset_obj,batch_size=100,epochs=1):
+    """Compile the function designated by mode so that it reads
+    minibatches of inputs and target outputs from a tf.data pipeline
+    over dataset_obj, which is something returned by
+    load_small_dataset or load_big_dataset, or the directory of a
+    serialized dataset.  Examples are shuffled and sliced into
+    minibatches by a python generator, converted to tensors by
+    tensorflow's threads, and the next minibatches are prefetched
+    while the current one is used.  Returns the tf.data.Dataset.
+
+    After this, running a training step built from
+    loss(mode) consumes one minibatch, without a feed_dict, and
+    raises tf.errors.OutOfRangeError after epochs passes over the
+    data.  Only available for target 'tensorflow', and must be
+    called before mode is otherwise compiled.
+    """
+    assert self.target=='tensorflow','input pipelines are only available for tensorflow'
+    pipeline = self.xc.inputPipeline(mode,self._as_dataset(dataset_obj),minibatchSize=batch_size,epochs=epochs)
+    self.xc.compileFromPipeline(mode,pipeline)
+    return pipeline
+
+  def minibatches(self,dataset_obj,batch_size=100,shuffle_first=True):
+    """Yields a series of pairs (mode,(X,Y)) where X and Y are a minibatch
+    suitable for training the function designated by mode.  Input is
+    something returned by load_small_dataset or load_big_dataset.
+    Minibatches are only wrapped (eg densified) as they are yielded,
+    and with sparse_inputs=True they are passed on as sparse
+    indices and values.  For tensorflow, input_pipeline is usually
+    faster, since it does not feed minibatches from python.
+    """
+    dset = self._as_dataset(dataset_obj)
+    # slice the rows for each minibatch out of the csr matrices, rather
+    # than shuffling a copy of the whole dataset
+    for mode,rows in dset.minibatchRowIterator(batchSize=batch_size,shuffleFirst=shuffle_first):
+      bx,by = dset.getRows(mode,rows)
+      yield str(mode),(self.xc.wrapInput(bx),self.xc.wrapInput(by))
+
   def load_big_dataset(self,dataset_spec,verbose=True):
     """Return a dataset object, which can be used as the first argument to
     tlog.minibatches to cycle through the examples.  The object is an
@@ -609,6 +651,7 @@ class Experiment(Options):
     self.batch_size = 125
 
   def run(self):
+    import tensorflow as tf
     tlog = Compiler(db=self.db, prog=self.prog)
     train = tlog.load_big_dataset(self.train_data)
 
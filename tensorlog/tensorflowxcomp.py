@@ -13,9 +13,18 @@ from tensorlog import xcomp
 from tensorlog import expt
 from tensorlog import util
 from tensorlog import learnxcomp
+from tensorlog import mutil
 from tensorlog import dataset
 from tensorlog import declare
 
+conf = config.Config()
+conf.denseMaxCells = 1000000;  conf.help.denseMaxCells = 'HybridMatDenseMsgCrossCompiler never densifies a relation with more cells than this'
+conf.denseMinDensity = 0.05;   conf.help.denseMinDensity = 'HybridMatDenseMsgCrossCompiler densifies relations with at least this fraction of nonzero cells'
+conf.denseSmallCells = 10000;  conf.help.denseSmallCells = 'HybridMatDenseMsgCrossCompiler densifies relations with at most this many cells, whatever their density'
+conf.pipelineShuffleBuffer = 10000;  conf.help.pipelineShuffleBuffer = 'inputPipeline shuffles the examples in each epoch unless this is 0'
+conf.pipelineParallelCalls = 4;      conf.help.pipelineParallelCalls = 'number of minibatches inputPipeline converts to messages in parallel'
+conf.pipelinePrefetch = 2;           conf.help.pipelinePrefetch = 'number of minibatches inputPipeline prepares ahead of the training step'
+
 class TensorFlowCrossCompiler(xcomp.AbstractCrossCompiler):
 
   def __init__(self,db,summaryFile=None):
@@ -27,6 +36,9 @@ class TensorFlowCrossCompiler(xcomp.AbstractCrossCompiler):
     self.summaryFile = summaryFile
     self.session = None
     self.sessionInitialized = None
+    # maps a mode to the target-output tensor of the input pipeline
+    # it was compiled with, if any
+    self.pipelineTargets = {}
     logging.debug('TensorFlowCrossCompiler initialized %.3f Gb' % util.memusage())
 
   def close(self):
@@ -118,12 +130,107 @@ class TensorFlowCrossCompiler(xcomp.AbstractCrossCompiler):
         runAndSummarize(fd,i)
     else:
       X1,Y1 = self._ensureUnwrapped(X,Y,wrapped)
-      dset = dataset.Dataset({targetMode:X1},{targetMode:Y1})
+      dset = dataset.Dataset({mode:X1},{mode:Y1})
       for i in range(epochs):
-        for mode,miniX,miniY in dset.minibatchIterator(batchsize=minibatchSize):
+        for _,rows in dset.minibatchRowIterator(batchSize=minibatchSize):
+          miniX,miniY = dset.getRows(mode,rows)
           fd = self.getFeedDict(mode,miniX,miniY,wrapped=False)
           runAndSummarize(fd,i)
 
+  #
+  # tf.data input pipelines
+  #
+
+  def inputPipeline(self,mode,dset,minibatchSize=100,epochs=1,shuffleBuffer=None,parallelCalls=None,prefetch=None):
+    """Return a tf.data.Dataset of (X,Y) minibatches for the examples
+    of a mode, where dset is a tensorlog dataset.Dataset, the
+    directory it was serialized in, or a dataset.StreamingDataset.
+    The minibatches are sliced from dset by a python generator, one
+    at a time, so the data is never copied into the graph.
+    tensorflow's own threads convert parallelCalls minibatches to
+    the messages used by this compiler in parallel, and prepare
+    prefetch minibatches ahead of the consumer.  The examples are
+    shuffled in each epoch unless shuffleBuffer is 0 (a
+    StreamingDataset shuffles with its own buffer).  Defaults are
+    conf.pipelineShuffleBuffer, conf.pipelineParallelCalls and
+    conf.pipelinePrefetch.
+    """
+    if isinstance(mode,str): mode = declare.asMode(mode)
+    if isinstance(dset,str): dset = dataset.Dataset.deserialize(dset)
+    shuffleBuffer = conf.pipelineShuffleBuffer if shuffleBuffer is None else shuffleBuffer
+    parallelCalls = parallelCalls or conf.pipelineParallelCalls
+    prefetch = prefetch or conf.pipelinePrefetch
+    if isinstance(dset,dataset.StreamingDataset):
+      functor = mode.getFunctor()
+      xDim = dset.db.dim(dset.db.schema.getDomain(functor,2))
+      yDim = dset.db.dim(dset.db.schema.getRange(functor,2))
+      def minibatches():
+        for m,bX,bY in dset.minibatchIterator(batchSize=minibatchSize,shuffleFirst=bool(shuffleBuffer)):
+          if m==mode: yield bX,bY
+    else:
+      xDim,yDim = dset.getX(mode).shape[1],dset.getY(mode).shape[1]
+      def minibatches():
+        for m,rows in dset.minibatchRowIterator(batchSize=minibatchSize,shuffleFirst=bool(shuffleBuffer)):
+          if m==mode: yield dset.getRows(mode,rows)
+    def sparseParts(m):
+      m = ss.csr_matrix(m,dtype='float32')
+      return mutil.csrIndices(m).astype('int64'),m.data,np.array(m.shape,dtype='int64')
+    def generator():
+      for bX,bY in minibatches():
+        yield sparseParts(bX) + sparseParts(bY)
+    partTypes = (tf.int64,tf.float32,tf.int64)
+    partShapes = (tf.TensorShape([None,2]),tf.TensorShape([None]),tf.TensorShape([2]))
+    pipeline = tf.data.Dataset.from_generator(generator,partTypes*2,partShapes*2)
+    # the generator is called again for each epoch
+    pipeline = pipeline.repeat(epochs)
+    pipeline = pipeline.map(
+        lambda xi,xv,xs,yi,yv,ys: (self._pipelineMsg(tf.SparseTensor(xi,xv,xs),xDim),
+                                   self._pipelineMsg(tf.SparseTensor(yi,yv,ys),yDim)),
+        num_parallel_calls=parallelCalls)
+    return pipeline.prefetch(prefetch)
+
+  def _pipelineMsg(self,x,dim):
+    """ Convert a minibatch from an input pipeline, which is a
+    SparseTensor, to a message """
+    result = tf.sparse_tensor_to_dense(x,validate_indices=False)
+    result.set_shape([None,dim])
+    return result
+
+  def compileFromPipeline(self,mode,pipeline):
+    """Compile a mode so that its inference and loss expressions read
+    their inputs and targets from an input pipeline, as built by
+    inputPipeline, instead of from placeholders.  The mode must not
+    already have been compiled.  Inputs and targets can still be
+    overridden with a feed_dict, eg to evaluate on test data.
+    """
+    if isinstance(mode,str): mode = declare.asMode(mode)
+    assert mode not in self._wsDict,'mode %s was already compiled without a pipeline' % str(mode)
+    x,y = pipeline.make_one_shot_iterator().get_next()
+    self.pipelineTargets[mode] = y
+    return self.ensureCompiled(mode,inputs=[x])
+
+  def optimizeDataLossFromPipeline(self,mode,optimizer,pipeline=None):
+    """Train until the input pipeline for a mode is exhausted, and
+    return the number of minibatches used.  If pipeline is given, the
+    mode is first compiled with compileFromPipeline.
+    """
+    if pipeline is not None:
+      mode = self.compileFromPipeline(mode,pipeline)
+    if isinstance(mode,str): mode = declare.asMode(mode)
+    assert mode in self.pipelineTargets,'mode %s was not compiled from a pipeline' % str(mode)
+    trainStep = optimizer.minimize(self._wsDict[mode].dataLossExpr, var_list=self.getParamVariables(mode))
+    self.ensureSessionInitialized()
+    # the optimizer may have created its own variables, eg for momentum
+    self.session.run(tf.variables_initializer(optimizer.variables()))
+    n = 0
+    try:
+      while True:
+        self.session.run(trainStep)
+        n += 1
+    except tf.errors.OutOfRangeError:
+      pass
+    return n
+
   def accuracy(self,mode,X,Y,wrapped=False,inputs=None):
     """ Return accuracy of a model on a test set
     """
@@ -249,8 +356,13 @@ class TensorFlowCrossCompiler(xcomp.AbstractCrossCompiler):
     if self.summaryFile:
       self.summaryMergeAll = tf.summary.merge_all()
 
+  def _createTargetPlaceholder(self,mode):
+    if mode in self.pipelineTargets:
+      return self.pipelineTargets[mode]
+    return self._createPlaceholder(xcomp.TRAINING_TARGET_VARNAME,'vector',self._wsDict[mode].inferenceOutputType)
+
   def _buildLossExpr(self,mode):
-    target_y = self._createPlaceholder(xcomp.TRAINING_TARGET_VARNAME,'vector',self._wsDict[mode].inferenceOutputType)
+    target_y = self._createTargetPlaceholder(mode)
     self._wsDict[mode].dataLossArgs = self._wsDict[mode].inferenceArgs + [target_y]
     # we want to take the log of the non-zero entries and leave the
     # zero entries alone, so add 1 to all the zero indices, then take
@@ -313,6 +425,14 @@ class TensorFlowCrossCompiler(xcomp.AbstractCrossCompiler):
     if verbose>=1:
       TensorFlowCrossCompiler.pprintExpr(self.ws.inferenceExpr)
 
+  def memoryFootprint(self):
+    """Return the number of bytes used by the tensorflow variables
+    created so far, which hold the DB vectors and matrices (and
+    the indices of the sparse ones).
+    """
+    return sum(v.get_shape().num_elements()*v.dtype.base_dtype.size
+               for v in self.tfVarsToInitialize)
+
   def getLearnedParam(self,key,session=None):
     if session is None:
       self.ensureSessionInitialized()
@@ -447,6 +567,9 @@ class SparseMatDenseMsgCrossCompiler(DenseMatDenseMsgCrossCompiler):
     # we will need to save the original indices/indptr representation
     # of each sparse matrix
     self.sparseMatInfo = {}
+    # maps id(m) to the transpose of m, for every SparseTensor m
+    # that is a handle expression for a DB matrix, and its transpose
+    self.sparseTranspose = {}
     logging.debug('SparseMatDenseMsgCrossCompiler initialized %.3f Gb' % util.memusage())
 
   def _insertHandleExpr(self,key,name,val,broadcast=False):
@@ -464,11 +587,8 @@ class SparseMatDenseMsgCrossCompiler(DenseMatDenseMsgCrossCompiler):
 
       # first convert from scipy csr format of indices,indptr,data to
       # tensorflow's format, where the sparseindices are a 2-D tensor.
-      sparseIndices = []
+      sparseIndices = mutil.csrIndices(val)
       (nRows,nCols) = val.shape
-      for i in range(nRows):
-        for j in val.indices[val.indptr[i]:val.indptr[i+1]]:
-          sparseIndices.append([i,j])
       logging.debug('%d sparseIndices for %d x %d relation %s: sparsity %g' %
                     (len(sparseIndices),nRows,nCols,functor,len(sparseIndices)/float(nRows*nCols)))
       # save the old shape and indices for the scipy matrix so we can
@@ -477,15 +597,26 @@ class SparseMatDenseMsgCrossCompiler(DenseMatDenseMsgCrossCompiler):
       # create the handle expression, and save a link back to the
       # underlying varable which will be optimized, ie., the 'values'
       # of the SparseTensor,
-      indiceVar = tf.Variable(np.array(sparseIndices), name="tensorlog/%s_indices" % name)
+      indiceVar = tf.Variable(sparseIndices, name="tensorlog/%s_indices" % name)
       valueVar = self._reparameterizeAndRecordVar(val.data,name,isTrainable)
       # note: the "valueVar+0.0" seems to be necessary to get a non-zero
       # gradient, but I don't understand why.  w/o this there is no "read"
       # node in for the variable in the graph and the gradient fails
-      self._handleExpr[key] = tf.SparseTensor(indiceVar,self._reparameterizedVarExpr(valueVar,isTrainable)+0.0,[nRows,nCols])
+      values = self._reparameterizedVarExpr(valueVar,isTrainable)+0.0
+      m = tf.SparseTensor(indiceVar,values,[nRows,nCols])
+      # also build the transpose once, here, so no transpose is needed
+      # when the matrix is used.  it shares values with m, permuted
+      # into the order of the transposed indices
+      valT,perm = mutil.transposePermutation(val)
+      indiceVarT = tf.Variable(mutil.csrIndices(valT), name="tensorlog/%s_transposed_indices" % name)
+      mT = tf.SparseTensor(indiceVarT,tf.gather(values,perm),[nCols,nRows])
+      self.sparseTranspose[id(m)] = mT
+      self.sparseTranspose[id(mT)] = m
+      self._handleExpr[key] = m
       self._handleExprVar[key] = valueVar
-      # record the index variable, which also needs to be initialized
+      # record the index variables, which also need to be initialized
       self.tfVarsToInitialize.append(indiceVar)
+      self.tfVarsToInitialize.append(indiceVarT)
       self.summarize("%s_indices" % name,indiceVar)
 
   def _unwrapDBVector(self,key,vec):
@@ -519,14 +650,206 @@ class SparseMatDenseMsgCrossCompiler(DenseMatDenseMsgCrossCompiler):
     return mat
 
   def _transposeMatrixExpr(self,m):
+    if id(m) in self.sparseTranspose:
+      return self.sparseTranspose[id(m)]
     return tf.sparse_transpose(m)
 
   def _vecMatMulExpr(self,v,m):
-    # TODO: the sparse_transpose below throws two op_scope deprecation warning
-    mT = tf.sparse_transpose(m)
-    vT = tf.transpose(v)
-    result = tf.transpose(tf.sparse_tensor_dense_matmul(mT,vT))
-    return result
+    # tensorflow only multiplies a sparse matrix on the left, so use
+    # v*m = (mT*vT)T, where mT is precomputed, and vT is transposed
+    # inside the matmul op
+    mT = self._transposeMatrixExpr(m)
+    return tf.transpose(tf.sparse_tensor_dense_matmul(mT,v,adjoint_b=True))
+
+###############################################################################
+# implementation for dense messages, and a mix of dense and sparse
+# relation matrices
+###############################################################################
+
+class HybridMatDenseMsgCrossCompiler(SparseMatDenseMsgCrossCompiler):
+  """Like SparseMatDenseMsgCrossCompiler, but each relation matrix is
+  placed in a dense tensor or a SparseTensor depending on its shape
+  and density.  A relation is dense if it has at most
+  conf.denseMaxCells cells, and either has at most
+  conf.denseSmallCells cells or at least a fraction
+  conf.denseMinDensity of them are nonzero.  Placement decisions
+  are logged, and kept in the dictionary self.placement, which maps
+  (functor,arity) to 'dense' or 'sparse'.
+  """
+
+  def __init__(self,db,summaryFile=None):
+    super(HybridMatDenseMsgCrossCompiler,self).__init__(db,summaryFile=summaryFile)
+    self.placement = {}
+
+  def _placeDense(self,mat):
+    nCells = mat.shape[0]*mat.shape[1]
+    if nCells > conf.denseMaxCells: return False
+    return nCells <= conf.denseSmallCells or mat.nnz >= conf.denseMinDensity*nCells
+
+  def _insertHandleExpr(self,key,name,val,broadcast=False):
+    (functor,arity) = key
+    if arity<2:
+      super(HybridMatDenseMsgCrossCompiler,self)._insertHandleExpr(key,name,val,broadcast=broadcast)
+    else:
+      (nRows,nCols) = val.shape
+      if self._placeDense(val):
+        self.placement[key] = 'dense'
+        DenseMatDenseMsgCrossCompiler._insertHandleExpr(self,key,name,val.todense(),broadcast=broadcast)
+      else:
+        self.placement[key] = 'sparse'
+        super(HybridMatDenseMsgCrossCompiler,self)._insertHandleExpr(key,name,val,broadcast=broadcast)
+      logging.info('placed %d x %d relation %s/%d with %d nonzeros as %s: graph variables now use %.3f Mb' %
+                   (nRows,nCols,functor,arity,val.nnz,self.placement[key],self.memoryFootprint()/1e6))
+
+  def _finalizeCompile(self,mode):
+    super(HybridMatDenseMsgCrossCompiler,self)._finalizeCompile(mode)
+    nDense = sum(1 for p in self.placement.values() if p=='dense')
+    logging.info('compiled %s with %d dense and %d sparse relations: graph variables use %.3f Mb' %
+                 (mode,nDense,len(self.placement)-nDense,self.memoryFootprint()/1e6))
+
+  def _unwrapDBMatrix(self,key,mat):
+    if self.placement.get(key)=='dense':
+      return self._unwrapOutput(mat)
+    return super(HybridMatDenseMsgCrossCompiler,self)._unwrapDBMatrix(key,mat)
+
+  def _unwrapUpdate(self,key,up):
+    if self.placement.get(key)=='dense':
+      return self._unwrapOutput(up)
+    return super(HybridMatDenseMsgCrossCompiler,self)._unwrapUpdate(key,up)
+
+  def _transposeMatrixExpr(self,m):
+    if isinstance(m,tf.SparseTensor):
+      return super(HybridMatDenseMsgCrossCompiler,self)._transposeMatrixExpr(m)
+    return tf.transpose(m)
+
+  def _vecMatMulExpr(self,v,m):
+    if isinstance(m,tf.SparseTensor):
+      return super(HybridMatDenseMsgCrossCompiler,self)._vecMatMulExpr(v,m)
+    return tf.matmul(v,m)
+
+###############################################################################
+# implementation for sparse inputs and targets, sparse relation matrices
+###############################################################################
+
+class SparseMatSparseMsgCrossCompiler(SparseMatDenseMsgCrossCompiler):
+  """Like SparseMatDenseMsgCrossCompiler, but the input and target
+  placeholders are sparse, so minibatches are fed as the indices and
+  values of their nonzeros, and are never densified in python.
+  Intermediate messages are still dense.  Tensorflow has no
+  sparse-by-sparse matmul, so an input multiplied by a sparse
+  relation matrix is multiplied by gathering the rows of the matrix
+  for the input's nonzeros, and the input is never densified; inputs
+  multiplied by a dense matrix, or weighted by their row sums, also
+  stay sparse.
+  """
+
+  def __init__(self,db,summaryFile=None):
+    super(SparseMatSparseMsgCrossCompiler,self).__init__(db,summaryFile=summaryFile)
+    # maps id(x) to a pair (x,dense version of x) for the sparse
+    # messages x that have been densified
+    self.densified = {}
+
+  def _createPlaceholder(self,name,kind,typeName):
+    assert kind=='vector'
+    return tf.sparse_placeholder(tf.float32, shape=[None,self.db.dim(typeName)], name="tensorlog/"+name)
+
+  def getInputName(self,mode,inputs=None):
+    """ A feed_dict key for the input placeholder.  Sparse placeholders
+    have no single name, so this is the placeholder itself.
+    """
+    return self.getInputPlaceholder(mode,inputs=inputs)
+
+  def getTargetOutputName(self,mode,inputs=None):
+    """ A feed_dict key for the target-output placeholder
+    """
+    return self.getTargetOutputPlaceholder(mode,inputs=inputs)
+
+  def _wrapMsg(self,vec):
+    """ Convert a scipy matrix to the value fed to a sparse placeholder """
+    vec = ss.csr_matrix(vec,dtype='float32')
+    return tf.SparseTensorValue(mutil.csrIndices(vec), vec.data, vec.shape)
+
+  def _pipelineMsg(self,x,dim):
+    return x
+
+  def unwrapInput(self,x):
+    (nRows,nCols) = x.dense_shape
+    return ss.csr_matrix((x.values,(x.indices[:,0],x.indices[:,1])),shape=(nRows,nCols),dtype='float32')
+
+  def _dense(self,x):
+    """ Convert a sparse message to a dense one, if needed """
+    if not isinstance(x,tf.SparseTensor):
+      return x
+    if id(x) not in self.densified:
+      self.densified[id(x)] = (x,tf.sparse_tensor_to_dense(x,validate_indices=False))
+    return self.densified[id(x)][1]
+
+  def _buildLossExpr(self,mode):
+    target_y = self._createTargetPlaceholder(mode)
+    self._wsDict[mode].dataLossArgs = self._wsDict[mode].inferenceArgs + [target_y]
+    inferenceReplacing0With1 = tf.where(
+        self._wsDict[mode].inferenceExpr>0.0,
+        self._wsDict[mode].inferenceExpr,
+        tf.ones(tf.shape(self._wsDict[mode].inferenceExpr), tf.float32))
+    # multiplying a SparseTensor by a dense one only looks at the
+    # positions of the sparse one's nonzeros
+    self._wsDict[mode].dataLossExpr = -tf.sparse_reduce_sum(target_y * tf.log(inferenceReplacing0With1))
+    self._wsDict[mode].dataLossGradExprs = tf.gradients(self._wsDict[mode].dataLossExpr,self.getParamVariables(mode))
+
+  def _softmaxFun2Expr(self,subExpr,typeName):
+    return super(SparseMatSparseMsgCrossCompiler,self)._softmaxFun2Expr(self._dense(subExpr),typeName)
+
+  def _vecMatMulExpr(self,v,m):
+    if isinstance(v,tf.SparseTensor) and isinstance(m,tf.SparseTensor):
+      return self._sparseVecMatMul(v,m)
+    elif isinstance(v,tf.SparseTensor):
+      return tf.sparse_tensor_dense_matmul(v,m)
+    return super(SparseMatSparseMsgCrossCompiler,self)._vecMatMulExpr(v,m)
+
+  def _sparseVecMatMul(self,v,m):
+    """ The dense product v*m of two SparseTensors: each nonzero v[r,c]
+    is multiplied by the nonzeros in row c of m, which are gathered
+    from m, and the products are added into row r of the output.
+    Only the output is dense, so the memory used for v is
+    proportional to its number of nonzeros.
+    """
+    # relation matrices and their transposes have their nonzeros in
+    # row-major order already
+    if id(m) not in self.sparseTranspose:
+      m = tf.sparse_reorder(m)
+    # position of the first nonzero of each row of m, and one past the last
+    rowStarts = tf.searchsorted(m.indices[:,0], tf.range(m.dense_shape[0]+1), side='left', out_type=tf.int64)
+    starts = tf.gather(rowStarts, v.indices[:,1])
+    lens = tf.gather(rowStarts, v.indices[:,1]+1) - starts
+    ends = tf.cumsum(lens)
+    # the k-th product comes from the nonzero seg[k] of v and the
+    # nonzero pos[k] of m
+    k = tf.range(tf.reduce_sum(lens), dtype=tf.int64)
+    seg = tf.searchsorted(ends, k, side='right', out_type=tf.int64)
+    pos = tf.gather(starts,seg) + k - (tf.gather(ends,seg) - tf.gather(lens,seg))
+    indices = tf.stack([tf.gather(v.indices[:,0],seg), tf.gather(m.indices[:,1],pos)], axis=1)
+    products = tf.gather(v.values,seg) * tf.gather(m.values,pos)
+    # scatter_nd adds up products with the same indices
+    return tf.scatter_nd(indices, products, tf.stack([v.dense_shape[0],m.dense_shape[1]]))
+
+  def _componentwiseMulExpr(self,v1,v2):
+    if isinstance(v1,tf.SparseTensor) and isinstance(v2,tf.SparseTensor):
+      return tf.multiply(self._dense(v1),self._dense(v2))
+    elif isinstance(v1,tf.SparseTensor):
+      return self._dense(v1 * v2)
+    elif isinstance(v2,tf.SparseTensor):
+      return self._dense(v2 * v1)
+    return tf.multiply(v1,v2)
+
+  def _weightedVecExpr(self,vec,weighter):
+    if isinstance(weighter,tf.SparseTensor):
+      weight = tf.sparse_reduce_sum(weighter, axis=1, keep_dims=True)
+    else:
+      weight = tf.reduce_sum(weighter, axis=1, keep_dims=True)
+    return tf.multiply(self._dense(vec), weight)
+
+  def _addupExprs(self,accum,addend):
+    return self._dense(accum) + self._dense(addend)
 
 class FixedRateGDLearner(learnxcomp.BatchEpochsLearner):
     """ A gradient descent learner.
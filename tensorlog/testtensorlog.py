@@ -10,13 +10,18 @@ import unittest
 import logging
 import logging.config
 import collections
+import json
 import sys
 import math
 import os
+import time
+import threading
 import os.path
 import shutil
 import tempfile
 import scipy
+import numpy as NP
+import numpy.random as NR
 
 from tensorlog import comline
 from tensorlog import dataset
@@ -24,13 +29,19 @@ from tensorlog import dbschema
 from tensorlog import declare
 from tensorlog import expt
 from tensorlog import funs
+from tensorlog import importtime
 from tensorlog import interp
 from tensorlog import learn
 from tensorlog import matrixdb
 from tensorlog import mutil
+from tensorlog import ops
+from tensorlog import opfunutil
 from tensorlog import parser
 from tensorlog import plearn
 from tensorlog import program
+from tensorlog import rowblockbench
+from tensorlog import score
+from tensorlog import serve
 from tensorlog import util
 
 
@@ -261,6 +272,31 @@ class TestSmallProofs(unittest.TestCase):
         self.assertAlmostEqual(actual[k], expected[k], delta=0.05)
 
 
+class TestRowBlocks(unittest.TestCase):
+
+  def setUp(self):
+    self.prog = rowblockbench.syntheticProgram(numEntities=300,degree=5)
+    self.X = self.prog.db.onehots(['e%d' % i for i in NR.RandomState(1).randint(300,size=100)])
+    self.saved = (mutil.conf.rowBlockThreads,mutil.conf.rowBlockMinNnz)
+
+  def tearDown(self):
+    mutil.conf.rowBlockThreads,mutil.conf.rowBlockMinNnz = self.saved
+
+  def testStack(self):
+    blocks = [mutil.rowBlock(self.X,lo,hi) for lo,hi in [(0,7),(7,8),(8,100)]]
+    self.assertEqual(mutil.numRows(blocks[1]),1)
+    self.assertEqual((mutil.stackRowBlocks(blocks)!=self.X).nnz,0)
+
+  def testSameOutput(self):
+    mutil.conf.rowBlockMinNnz = 1
+    secs,expected = rowblockbench.timeEval(self.prog,self.X,1,repeats=1)
+    for threads in [2,3,8]:
+      secs,actual = rowblockbench.timeEval(self.prog,self.X,threads,repeats=1)
+      self.assertEqual(actual.shape,expected.shape)
+      self.assertTrue(NP.array_equal(actual.indptr,expected.indptr))
+      self.assertTrue(NP.array_equal(actual.indices,expected.indices))
+      self.assertTrue(NP.array_equal(actual.data,expected.data))
+
 class TestMultiRowOps(unittest.TestCase):
   #TODO document this
 
@@ -384,6 +420,191 @@ class TestMatrixRecursion(unittest.TestCase):
       for k in list(da.keys()):
         self.assertAlmostEqual(da[k],de[k],delta=0.05)
 
+class TestIncrementalCompile(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.ruleStrings = ['s(X,Y):-spouse(X,Y).','t(X,Z):-spouse(X,Y),s(Y,Z).','u(X,Y):-sister(X,Y).']
+    self.modes = [declare.asMode(m) for m in ['t/io','u/io','s/io']]
+
+  def compiledProgram(self,ruleStrings):
+    prog = program.Program(db=self.db,rules=rules_from_strings(ruleStrings))
+    for mode in self.modes: prog.getFunction(mode)
+    return prog
+
+  def answers(self,prog,mode,sym):
+    return prog.db.rowAsSymbolDict(prog.evalSymbols(mode,[sym]))
+
+  def testRuleChange(self):
+    prog = self.compiledProgram(self.ruleStrings)
+    # t/io at depth 0 calls s/io at depth 1
+    self.assertEqual(prog.numCompiled, 4)
+    t,u,s = self.modes
+    uFun = prog.function[(u,0)]
+    prog.rules.add(parser.Parser().parseRule('s(X,Y):-sister(X,Y).'))
+    # t and s (at both depths) are recompiled, but not u
+    answers = self.answers(prog,t,'susan')
+    self.assertTrue('rachel' in answers)
+    self.assertEqual(answers, self.answers(self.compiledProgram(self.ruleStrings + ['s(X,Y):-sister(X,Y).']),t,'susan'))
+    self.assertEqual(prog.numCompiled, 7)
+    self.assertTrue(prog.function[(u,0)] is uFun)
+    # sister/2 is now used by every function
+    self.assertEqual(prog.updateFunctions(['sister/2']), 4)
+    self.assertEqual(prog.updateFunctions(['child/2']), 0)
+
+  def testSettings(self):
+    prog = self.compiledProgram(self.ruleStrings)
+    t,u,s = self.modes
+    # no function reaches depth 5
+    self.assertEqual(prog.setMaxDepth(5), 0)
+    # the normalizer is only used by the three top-level functions
+    self.assertEqual(prog.setNormalize('none'), 3)
+    self.assertEqual(self.answers(prog,u,'william'), {'rachel':1.0, 'lottie':1.0, 'sarah':1.0})
+    # t/io needs s/io at depth 1
+    self.assertEqual(prog.setMaxDepth(0), 2)
+    self.assertEqual(self.answers(prog,t,'susan'), {})
+    self.assertEqual(self.answers(prog,u,'william'), {'rachel':1.0, 'lottie':1.0, 'sarah':1.0})
+
+  def testCompileAll(self):
+    expected = self.compiledProgram(self.ruleStrings)
+    prog = program.Program(db=self.db,rules=rules_from_strings(self.ruleStrings))
+    prog.compileAll(self.modes,workers=2)
+    self.assertEqual(sorted(map(str,prog.function.keys())), sorted(map(str,expected.function.keys())))
+    t,u,s = self.modes
+    # calls to other predicates are linked to the adopted functions
+    def calledFuns(node):
+      if isinstance(node,ops.DefinedPredOp): return [node.subfun]
+      return sum([calledFuns(child) for child in node.children()], [])
+    self.assertEqual(calledFuns(prog.function[(t,0)]), [prog.function[(s,1)]])
+    for mode in self.modes:
+      self.assertEqual(prog.function[(mode,0)].pprint(), expected.function[(mode,0)].pprint())
+      for sym in ['susan','william']:
+        self.assertEqual(self.answers(prog,mode,sym), self.answers(expected,mode,sym))
+
+class TestBranchWorkers(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.db.markAsParameter('spouse',2)
+    self.ruleStrings = ['p(X,Y):-spouse(X,Y).', 'p(X,Y):-sister(X,Y).', 'p(X,Y):-child(X,Z),s(Z,Y).',
+                        's(X,Y):-spouse(X,Y).', 's(X,Y):-child(X,Y).']
+    self.mode = declare.asMode('p/io')
+    self.X = self.db.onehots(['william','susan','lottie','rachel'])
+    self.Y = self.db.onehots(['susan','william','sarah','rachel'])
+
+  def evalAndGrad(self,workers):
+    prog = program.Program(db=self.db,rules=rules_from_strings(self.ruleStrings))
+    prog.getFunction(self.mode)
+    prog.setBranchWorkers(workers)
+    P = prog.eval(self.mode,[self.X])
+    grad = learn.FixedRateGDLearner(prog).crossEntropyGrad(self.mode,self.X,self.Y)
+    return P,grad[('spouse',2)]
+
+  def testSameResults(self):
+    P1,grad1 = self.evalAndGrad(1)
+    P3,grad3 = self.evalAndGrad(3)
+    self.assertEqual(P1.nnz,P3.nnz)
+    self.assertEqual((P1!=P3).nnz,0)
+    self.assertTrue(grad1.nnz>0)
+    self.assertAlmostEqual(abs(grad1-grad3).max(),0.0,places=6)
+
+  def testLazyEncoding(self):
+    # the branches find relations with added facts and no dense blocks
+    results = []
+    for workers in [1,3]:
+      self.setUp()
+      self.db.addLines(['child\tsusan\tlottie\n'])
+      self.db.blockEncoding.clear()
+      self.assertTrue(self.db._staleKeys)
+      results.append(self.evalAndGrad(workers))
+    (P1,grad1),(P3,grad3) = results
+    self.assertEqual((P1!=P3).nnz,0)
+    self.assertAlmostEqual(abs(grad1-grad3).max(),0.0,places=6)
+
+  def testAuditContextPerThread(self):
+    mutil.setAuditContext('main')
+    funs._branchExecutor(2).submit(mutil.setAuditContext,'branch').result()
+    self.assertEqual(mutil._auditContext(),'main')
+
+class TestResultCache(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.prog = program.Program(db=self.db,rules=rules_from_strings(['u(X,Y):-sister(X,Y).']))
+    self.prog.normalize = 'none'
+    self.mode = declare.asMode('u/io')
+
+  def testCache(self):
+    self.prog.enableResultCache(1<<20)
+    cache = self.prog.resultCache
+    expected = self.db.rowAsSymbolDict(self.prog.evalSymbols(self.mode,['william']))
+    self.assertEqual((cache.hits,cache.misses), (0,1))
+    self.assertEqual(self.db.rowAsSymbolDict(self.prog.evalSymbols(self.mode,['william'])), expected)
+    self.assertEqual((cache.hits,cache.misses), (1,1))
+    # only the misses in a batch are evaluated
+    X = mutil.stack([self.db.onehot(s) for s in ['william','rachel','william']])
+    actual = self.prog.eval(self.mode,[X])
+    self.assertEqual((cache.hits,cache.misses), (3,2))
+    uncached = program.Program(db=self.db,rules=self.prog.rules)
+    uncached.normalize = 'none'
+    self.assertEqual(abs(actual - uncached.eval(self.mode,[X])).max(), 0.0)
+    self.assertEqual(cache.stats()['rows'], 2)
+    self.assertAlmostEqual(cache.hitRate(), 0.6)
+    # setting a parameter makes the cached rows out of date
+    self.db.markAsParameter('sister',2)
+    self.db.setParameter('sister',2,self.db.matrix(declare.asMode('sister(i,o)'))*2.0)
+    doubled = self.db.rowAsSymbolDict(self.prog.evalSymbols(self.mode,['william']))
+    self.assertEqual((cache.hits,cache.misses), (3,3))
+    self.assertEqual(doubled, dict((y,2*w) for y,w in expected.items()))
+
+  def testNewSymbols(self):
+    self.prog.enableResultCache(1<<20)
+    self.prog.evalSymbols(self.mode,['william'])
+    # adding symbols changes the dimension of the outputs, so the
+    # cached rows can no longer be used
+    dim = self.db.dim()
+    self.db.addLines(['brandnew\tfoo\tbar\n'])
+    self.assertEqual(self.db.dim(), dim+2)
+    X = mutil.stack([self.db.onehot(s) for s in ['william','rachel']])
+    actual = self.prog.eval(self.mode,[X])
+    self.assertEqual(actual.shape, (2,dim+2))
+    self.assertEqual(self.prog.resultCache.hits, 0)
+
+  def testEviction(self):
+    row = self.prog.evalSymbols(self.mode,['william'])
+    self.prog.enableResultCache(program.ResultCache._size(row))
+    cache = self.prog.resultCache
+    for s in ['william','rachel','william']:
+      self.prog.evalSymbols(self.mode,[s])
+    self.assertEqual((cache.hits,cache.misses), (0,3))
+    self.assertEqual(len(cache.rows), 1)
+    self.assertTrue(cache.numBytes <= cache.maxBytes)
+    # the bookkeeping for a row counts towards its size
+    self.assertTrue(program.ResultCache._size(row) > row.data.nbytes + row.indices.nbytes + row.indptr.nbytes)
+
+  def testCopies(self):
+    self.prog.enableResultCache(1<<20)
+    expected = self.db.rowAsSymbolDict(self.prog.evalSymbols(self.mode,['william']))
+    # changing a returned row does not change the cached row
+    for _ in range(2):
+      row = self.prog.evalSymbols(self.mode,['william'])
+      row.data *= 0.0
+    self.assertEqual(self.prog.resultCache.hits, 2)
+    self.assertEqual(self.db.rowAsSymbolDict(self.prog.evalSymbols(self.mode,['william'])), expected)
+
+  def testStaleRowsDropped(self):
+    self.prog.enableResultCache(1<<20)
+    cache = self.prog.resultCache
+    self.prog.evalSymbols(self.mode,['william'])
+    self.prog.evalSymbols(self.mode,['rachel'])
+    self.assertEqual(len(cache.rows), 2)
+    self.db.markAsParameter('sister',2)
+    self.db.setParameter('sister',2,self.db.matrix(declare.asMode('sister(i,o)'))*2.0)
+    self.prog.evalSymbols(self.mode,['william'])
+    # rows computed with the old parameters are gone
+    self.assertEqual(len(cache.rows), 1)
+    self.assertEqual(cache.numBytes, sum(program.ResultCache._size(entry) for entry in cache.rows.values()))
+
 class TestGrad(unittest.TestCase):
 
   def setUp(self):
@@ -656,6 +877,64 @@ class TestProPPR(unittest.TestCase):
     for i,x in enumerate(self.rawNeg):
       checkGrad(i+len(self.rawPos),x,-1,+1)
 
+  def testDedupRows(self):
+    X,Y = matrixAsTrainingData(self.labeledData,'train',2)
+    rows = [0,3,0,1,3,3,2,0]
+    X2 = mutil.stack([X.getrow(i) for i in rows])
+    # the last example repeats the input of the first with a different
+    # target, so they can share the prediction but not the gradient
+    Y2 = mutil.stack([Y.getrow(i) for i in rows[:-1]] + [Y.getrow(6)])
+    learner = learn.OnePredFixedRateGDLearner(self.prog,tracer=learn.Tracer.recordDefaults)
+    softmaxRows = []
+    candidateScores = learner.candidateScores
+    def recordingCandidateScores(unnorm,Y):
+      softmaxRows.append(mutil.numRows(unnorm))
+      return candidateScores(unnorm,Y)
+    learner.candidateScores = recordingCandidateScores
+    def predictAndGrad(dedup):
+      saved = learn.conf.dedupRows
+      learn.conf.dedupRows = dedup
+      try:
+        return learner.predict(self.mode,X2),learner.crossEntropyGrad(self.mode,X2,Y2)
+      finally:
+        learn.conf.dedupRows = saved
+    P0,grad0 = predictAndGrad(False)
+    P1,grad1 = predictAndGrad(True)
+    # the softmax is only computed for the distinct rows, and the loss
+    # counts each copy
+    self.assertEqual(softmaxRows, [len(rows),len(set(rows))+1])
+    self.assertAlmostEqual(grad0.counter['crossEnt'],grad1.counter['crossEnt'],places=4)
+    # intermediate results saved on a scratchpad the caller passes in
+    # have a row for each example
+    pad = opfunutil.Scratchpad()
+    learner.crossEntropyGrad(self.mode,X2,Y2,pad=pad)
+    fun = self.prog.getPredictFunction(self.mode)
+    self.assertEqual(mutil.numRows(pad[fun.fun.id].output),len(rows))
+    self.assertEqual(P0.shape,P1.shape)
+    self.assertAlmostEqual(abs(P0-P1).sum(),0.0,places=5)
+    self.assertEqual(set(grad0.keys()),set(grad1.keys()))
+    for key in grad0.keys():
+      self.assertEqual(grad0[key].shape,grad1[key].shape)
+      self.assertAlmostEqual(abs(grad0[key]-grad1[key]).sum(),0.0,places=5)
+    # gradients are clipped for each example, as without dedup
+    saved = (learn.conf.minGradient,learn.conf.maxGradient)
+    learn.conf.minGradient,learn.conf.maxGradient = -0.001,0.001
+    try:
+      for (functor,arity) in grad0.keys():
+        clipped0 = learner.meanUpdate(functor,arity,grad0[(functor,arity)],len(rows))
+        clipped1 = learner.meanUpdate(functor,arity,grad1[(functor,arity)],len(rows))
+        self.assertTrue(abs(mutil.mean(grad0[(functor,arity)])-clipped0).max() > 0.001)
+        self.assertAlmostEqual(abs(clipped0-clipped1).sum(),0.0,places=5)
+    finally:
+      learn.conf.minGradient,learn.conf.maxGradient = saved
+
+  def testRuleWeightsAfterAddingFacts(self):
+    db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    prog = program.ProPPRProgram(db=db,rules=rules_from_strings(['u(X,Y):-sister(X,Y) {r1}.','u(X,Y):-child(X,Y) {r2}.']))
+    prog.setRuleWeights()
+    db.addLines(['weighted\tr1\t0.5\n'])
+    self.assertEqual(db.rowAsSymbolDict(prog.getRuleWeights()), {'r1':1.5,'r2':1.0})
+
   def testLabeledData(self):
     self.assertTrue(self.labeledData.inDB('train',2))
     self.assertTrue(self.labeledData.inDB('test',2))
@@ -706,6 +985,57 @@ class TestProPPR(unittest.TestCase):
     ##
 
 
+  def testShardedParallelLearn(self):
+    dset = dataset.Dataset.loadExamples(
+        self.prog.db,
+        os.path.join(TEST_DATA_DIR,"toytrain.examples"),
+        proppr=True)
+    direc = os.path.join(tempfile.mkdtemp(),'toytrain.dset')
+    dset.serialize(direc,sharded=True)
+    shards = dataset.Dataset.deserialize(direc)
+    learner = plearn.ParallelFixedRateGDLearner(self.prog,epochs=5,parallel=1,miniBatchSize=2)
+    P0 = learner.datasetPredict(shards)
+    xent0 = learner.datasetCrossEntropy(shards,P0)
+    learner.train(shards)
+    P1 = learner.datasetPredict(shards)
+    acc1 = learner.datasetAccuracy(shards,P1)
+    xent1 = learner.datasetCrossEntropy(shards,P1)
+    learner.pool.close()
+    print('toy train: acc1',acc1,'xent1',xent1)
+    self.assertTrue(xent0>xent1)
+    self.assertTrue(acc1==1)
+
+  def testStreamingParallelLearn(self):
+    filename = os.path.join(TEST_DATA_DIR,"toytrain.examples")
+    dset = dataset.Dataset.loadExamples(self.prog.db,filename,proppr=True)
+    stream = dataset.StreamingDataset(self.prog.db,filename,proppr=True,seed=0)
+    learner = plearn.ParallelFixedRateGDLearner(self.prog,epochs=5,parallel=1,miniBatchSize=2)
+    P0 = learner.datasetPredict(dset)
+    xent0 = learner.datasetCrossEntropy(dset,P0)
+    learner.train(stream)
+    P1 = learner.datasetPredict(dset)
+    acc1 = learner.datasetAccuracy(dset,P1)
+    xent1 = learner.datasetCrossEntropy(dset,P1)
+    learner.pool.close()
+    self.assertTrue(xent0>xent1)
+    self.assertTrue(acc1==1)
+
+  def testSampledSoftmaxLearn(self):
+    dset = dataset.Dataset.loadExamples(
+        self.prog.db,
+        os.path.join(TEST_DATA_DIR,"toytrain.examples"),
+        proppr=True)
+    learner = learn.SampledSoftmaxSGDLearner(self.prog,epochs=5,numSamples=1,seed=0)
+    P0 = learner.datasetPredict(dset)
+    xent0 = learner.datasetCrossEntropy(dset,P0)
+    learner.train(dset)
+    P1 = learner.datasetPredict(dset)
+    acc1 = learner.datasetAccuracy(dset,P1)
+    xent1 = learner.datasetCrossEntropy(dset,P1)
+    print('toy train: acc1',acc1,'xent1',xent1)
+    self.assertTrue(xent0>xent1)
+    self.assertTrue(acc1==1)
+
   def testLearn(self):
     mode = declare.ModeDeclaration('predict(i,o)')
     X,Y = matrixAsTrainingData(self.labeledData,'train',2)
@@ -1008,6 +1338,58 @@ class TestDataset(unittest.TestCase):
       self.assertEqual(s[i,0], 1.0)
     dataset.conf.normalize_outputs = saved_config
 
+  def testShardedSerialization(self):
+    dset = dataset.Dataset.loadExamples(self.db,os.path.join(TEST_DATA_DIR,'matchtoy-train.exam'))
+    direc = os.path.join(tempfile.mkdtemp(),'matchtoy.dset')
+    dset.serialize(direc,sharded=True)
+    dset2 = dataset.Dataset.deserialize(direc)
+    self.assertEqual(dset2.shardDir,os.path.abspath(direc))
+    self.assertEqual(set(dset.modesToLearn()),set(dset2.modesToLearn()))
+    for mode in dset.modesToLearn():
+      self.assertEqual((dset.getX(mode)-dset2.getX(mode)).nnz,0)
+      self.assertEqual((dset.getY(mode)-dset2.getY(mode)).nnz,0)
+      self.assertEqual(dset2.getX(mode).dtype,'float32')
+    # each row appears in exactly one minibatch
+    seen = collections.defaultdict(list)
+    for mode,rows in dset2.minibatchRowIterator(batchSize=1):
+      seen[mode].extend(rows)
+      X,Y = dset2.getRows(mode,rows)
+      self.assertEqual((X-dset.getX(mode)[rows]).nnz,0)
+    for mode in dset.modesToLearn():
+      self.assertEqual(sorted(seen[mode]),list(range(mutil.numRows(dset.getX(mode)))))
+
+  def testUncacheSharded(self):
+    exampleFile = os.path.join(TEST_DATA_DIR,'matchtoy-train.exam')
+    saved = sys.argv
+    sys.argv = ['prog']  # no command-line arguments
+    try:
+      for sharded in [False,True]:
+        direc = os.path.join(tempfile.mkdtemp(),'matchtoy.dset')
+        dataset.Dataset.uncacheExamples(direc,self.db,exampleFile,proppr=False,sharded=sharded)
+        self.assertEqual(dataset.Dataset.deserialize(direc).shardDir is not None,sharded)
+    finally:
+      sys.argv = saved
+
+  def testStreamingDataset(self):
+    for filename,proppr in [('matchtoy-train.exam',False),('matchtoy-train.examples',True)]:
+      filename = os.path.join(TEST_DATA_DIR,filename)
+      dset = dataset.Dataset.loadExamples(self.db,filename,proppr=proppr)
+      stream = dataset.StreamingDataset(self.db,filename,proppr=proppr,shuffleBufferSize=2,seed=0)
+      self.assertEqual(set(stream.modesToLearn()),set(dset.modesToLearn()))
+      # unshuffled minibatches are the rows of the loaded dataset, in order
+      for mode,X,Y in stream.minibatchIterator(batchSize=10,shuffleFirst=False):
+        self.assertEqual((X-dset.getX(mode)).nnz,0)
+        self.assertEqual((Y-dset.getY(mode)).nnz,0)
+        self.assertEqual(X.dtype,'float32')
+      # shuffled ones have every example exactly once
+      seen = collections.defaultdict(list)
+      for mode,X,Y in stream.minibatchIterator(batchSize=1):
+        seen[mode].append(self.db.matrixAsSymbolDict(mutil.stack([X,Y])))
+      for mode in dset.modesToLearn():
+        expected = [self.db.matrixAsSymbolDict(mutil.stack([dset.getX(mode)[i],dset.getY(mode)[i]]))
+                    for i in range(mutil.numRows(dset.getX(mode)))]
+        self.assertEqual(sorted(map(str,seen[mode])),sorted(map(str,expected)))
+
   def checkMatchExamples(self,filename,proppr):
     dset = dataset.Dataset.loadExamples(self.db,filename,proppr=proppr)
     modes = dset.modesToLearn()
@@ -1039,6 +1421,21 @@ class TestMatrixUtils(unittest.TestCase):
     self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
     self.row1 = self.db.onehot('william')+self.db.onehot('poppy')
 
+  def testDistinctRows(self):
+    for (m,expectedInverse) in [(self.db.onehots(['william','poppy','william','sarah','poppy']),[0,1,0,2,1]),
+                                (mutil.stack([self.row1,self.db.onehot('sarah'),self.row1]),[0,1,0])]:
+      U,inverse = mutil.distinctRows(m)
+      self.assertEqual(list(inverse),expectedInverse)
+      self.assertEqual(mutil.numRows(U),max(expectedInverse)+1)
+      self.assertEqual((mutil.gatherRows(U,inverse)!=m).nnz,0)
+      # sumRowsInto is the adjoint of gatherRows
+      summed = mutil.sumRowsInto(m,inverse,mutil.numRows(U))
+      self.assertEqual((summed-U.multiply(NP.bincount(inverse).reshape(-1,1))).nnz,0)
+    # rows are not compared if one is much longer than the others
+    m = mutil.stack([self.db.ones()] + [self.db.onehot('william')]*6)
+    U,inverse = mutil.distinctRows(m)
+    self.assertEqual(list(inverse),list(range(7)))
+
   def testRepeat(self):
     mat = mutil.repeat(self.row1,3)
     self.assertEqual(mutil.numRows(mat), 3)
@@ -1049,6 +1446,348 @@ class TestMatrixUtils(unittest.TestCase):
       self.assertTrue('poppy' in di)
       self.assertEqual(len(list(di.keys())), 2)
 
+  def testCSRIndices(self):
+    m = self.db.matrix(declare.asMode('child(i,o)'))
+    indices = mutil.csrIndices(m)
+    self.assertEqual(indices.shape, (m.nnz,2))
+    self.assertEqual(indices.dtype, NP.int64)
+    coo = m.tocoo()
+    self.assertTrue((indices[:,0]==coo.row).all())
+    self.assertTrue((indices[:,1]==coo.col).all())
+
+  def testTransposePermutation(self):
+    m = self.db.matrix(declare.asMode('child(i,o)'))
+    m = mutil.mapData(lambda d:NP.arange(1,len(d)+1,dtype='float32'), m)
+    mT,perm = mutil.transposePermutation(m)
+    self.assertEqual(abs(mT-m.transpose()).max(), 0.0)
+    self.assertTrue((mT.data==m.data[perm]).all())
+
+  def testDenseBlock(self):
+    m = self.db.matrix(declare.asMode('child(i,o)'))
+    b = mutil.DenseBlock.fromCSR(m)
+    self.assertTrue(b is not None)
+    self.assertTrue(b.block.size < m.shape[0]*m.shape[1])
+    self.assertEqual(abs(b.toCSR()-m).max(), 0.0)
+    v = self.row1 + self.db.onehot('charlotte')
+    self.assertEqual(abs(b.vecMatMul(v) - v*m).max(), 0.0)
+    self.assertEqual(abs(b.transpose().vecMatMul(v) - v*m.transpose()).max(), 0.0)
+    # the block is selected when the db is loaded, and used in both
+    # directions
+    self.assertTrue(self.db.blockEncoding[('child',2)][1] is not None)
+    for mode in ['child(i,o)','child(o,i)']:
+      mode = declare.asMode(mode)
+      self.assertEqual(abs(self.db.vecMatMul(v,mode) - v*self.db.matrix(mode)).max(), 0.0)
+    # large products fall back to the csr matrix
+    saved = mutil.conf.maxBlockProductCells
+    try:
+      mutil.conf.maxBlockProductCells = 1
+      V = mutil.stack([v,self.row1])
+      for mode in ['child(i,o)','child(o,i)']:
+        mode = declare.asMode(mode)
+        self.assertEqual(abs(self.db.vecMatMul(V,mode) - V*self.db.matrix(mode)).max(), 0.0)
+    finally:
+      mutil.conf.maxBlockProductCells = saved
+    # parameters are not stored as blocks
+    self.db.markAsParameter('child',2)
+    self.assertTrue(self.db._denseBlock(('child',2)) is None)
+    self.db.setParameter('child',2,self.db.getParameter('child',2)*2.0)
+    self.assertEqual(abs(self.db.vecMatMul(v,declare.asMode('child(i,o)')) - v*m*2.0).max(), 0.0)
+    self.assertFalse(('child',2) in self.db.blockEncoding)
+    # non-zeros in opposite corners are not worth a block
+    n = self.db.dim()
+    corners = scipy.sparse.csr_matrix(([1.0,1.0],([0,n-1],[0,n-1])),shape=(n,n),dtype='float32')
+    self.assertTrue(mutil.DenseBlock.fromCSR(corners,maxBlockExpand=1.0) is None)
+    # nor is a sparse block in a matrix with many rows
+    n = 1000000
+    rng = NR.RandomState(0)
+    rows,cols = rng.randint(700,size=700)+1000,rng.randint(700,size=700)+5000
+    sparse = scipy.sparse.csr_matrix((NP.ones(700),(rows,cols)),shape=(n,n),dtype='float32')
+    self.assertTrue(mutil.DenseBlock.fromCSR(sparse) is None)
+
+  def testPatternRelations(self):
+    # by default relations keep their data arrays
+    self.assertFalse(mutil.isPattern(self.db.matEncoding[('child',2)]))
+    saved = matrixdb.conf.pattern_relations
+    try:
+      matrixdb.conf.pattern_relations = True
+      self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    finally:
+      matrixdb.conf.pattern_relations = saved
+    # if asked, unweighted relations are loaded without a data array
+    m = self.db.matEncoding[('child',2)]
+    self.assertTrue(mutil.isPattern(m))
+    self.assertEqual(m.data.strides, (0,))
+    mT = mutil.patternTranspose(m)
+    self.assertTrue(mutil.isPattern(mT))
+    self.assertEqual(abs(mT-m.transpose()).max(), 0.0)
+    v = self.row1 + self.db.onehot('charlotte')
+    self.assertEqual(abs(mutil.patternVecMatMul(v,m) - v*m).max(), 0.0)
+    saved = matrixdb.conf.dense_blocks
+    try:
+      matrixdb.conf.dense_blocks = False
+      for mode in ['child(i,o)','child(o,i)']:
+        mode = declare.asMode(mode)
+        self.assertEqual(abs(self.db.vecMatMul(v,mode) - v*self.db.matrix(mode)).max(), 0.0)
+        ones = self.db.matrixPreimageOnes(mode)
+        self.assertEqual(abs(self.db.matrixPreimage(mode) - ones*self.db.matrixPreimageMat(mode)).max(), 0.0)
+    finally:
+      matrixdb.conf.dense_blocks = saved
+    # parameters get their own, writable values
+    self.db.markAsParameter('child',2)
+    self.assertFalse(mutil.isPattern(self.db.getParameter('child',2)))
+
+  def testDtypeDiscipline(self):
+    def isCompact(m):
+      return m.dtype==NP.float32 and m.indices.dtype==NP.int32 and m.indptr.dtype==NP.int32
+    m = self.db.matrix(declare.asMode('child(i,o)'))
+    m64 = scipy.sparse.csr_matrix(m,dtype='float64')
+    self.assertTrue(isCompact(mutil.selectRows(m64,1,4)))
+    self.assertTrue(isCompact(mutil.shuffleRows(m64)))
+    self.assertTrue(isCompact(mutil.repeat(self.row1,3)))
+    self.assertTrue(isCompact(mutil.mapData(lambda d:d*2,m)))
+    self.assertEqual(abs(mutil.selectRows(m,1,4) - m[1:4]).max(), 0.0)
+    perm = NP.arange(m.shape[0])[::-1]
+    self.assertEqual(abs(mutil.shuffleRows(m,perm) - m[perm]).max(), 0.0)
+    saved = mutil.conf.auditDtypes
+    try:
+      mutil.conf.auditDtypes = True
+      mutil.dtypeAudit.clear()
+      # evaluating a program needs no conversions
+      prog = program.Program(db=self.db,rules=rules_from_strings(["p(X,Y):-spouse(X,Z),child(Z,Y)."]))
+      prog.eval(declare.asMode('p(i,o)'),[self.row1])
+      self.assertEqual(mutil.dtypeAuditReport(), [])
+      # but building a matrix from wider arrays does
+      mutil.setAuditContext('test')
+      mutil.csrMatrix(m.data.astype('float64'),m.indices.astype('int64'),m.indptr.astype('int64'),m.shape)
+      self.assertTrue(('test','int64->int32',2) in mutil.dtypeAuditReport())
+      self.assertTrue(('test','float64->float32',1) in mutil.dtypeAuditReport())
+    finally:
+      mutil.conf.auditDtypes = saved
+      mutil.dtypeAudit.clear()
+
+class TestBatchOnehots(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    self.prog = program.Program(db=self.db,rules=rules_from_strings(["p(X,Y):-sister(X,Y)."]))
+    self.mode = declare.ModeDeclaration('p(i,o)')
+    self.symbols = ['william','rachel','william','sarah']
+
+  def testOnehots(self):
+    m = self.db.onehots(self.symbols)
+    self.assertEqual(m.shape,(len(self.symbols),self.db.dim()))
+    self.assertEqual(m.dtype,'float32')
+    expected = mutil.stack([self.db.onehot(s) for s in self.symbols])
+    self.assertEqual((m-expected).nnz,0)
+
+  def testOnehotsOOV(self):
+    m = self.db.onehots(['william','no_such_person'],outOfVocabularySymbolsAllowed=True)
+    self.assertEqual(self.db.rowAsSymbolDict(m.getrow(1)),{matrixdb.OOV_ENTITY_NAME:1.0})
+
+  def testEvalIds(self):
+    ids = [self.db.asSymbolId(s) for s in self.symbols]
+    P = self.prog.evalIds(self.mode,ids)
+    for k,s in enumerate(self.symbols):
+      expected = self.prog.evalSymbols(self.mode,[s])
+      self.assertEqual((P.getrow(k)-expected).nnz,0)
+
+class TestSoftmaxCrossEntropy(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'fam.cfacts'))
+    # row 0 has several scores, row 1 already has a score for the null
+    # entity, and row 2 is empty
+    self.mat = mutil.stack([
+        self.db.onehot('william')*2.0 + self.db.onehot('poppy')*0.5 + self.db.onehot('rachel')*-1.0,
+        self.db.onehot('sarah')*3.0 + self.db.onehot(matrixdb.NULL_ENTITY_NAME),
+        self.db.onehot('william')*0.0])
+    self.Y = mutil.stack([self.db.onehot('poppy'),self.db.onehot('sarah'),self.db.onehot('william')])
+
+  def testSoftmax(self):
+    P = mutil.softmax(self.db,self.mat)
+    d = self.db.matrixAsSymbolDict(P)
+    for i,scores in enumerate([
+        {'william':2.0,'poppy':0.5,'rachel':-1.0,matrixdb.NULL_ENTITY_NAME:-10.0},
+        {'sarah':3.0,matrixdb.NULL_ENTITY_NAME:-9.0},
+        {matrixdb.NULL_ENTITY_NAME:-10.0}]):
+      softmax_normalize(scores)
+      self.assertEqual(set(d[i].keys()),set(scores.keys()))
+      for k in scores:
+        self.assertAlmostEqual(d[i][k],scores[k],delta=1e-5)
+    # the null entity is found by its id
+    self.assertEqual(self.db.nullId(), self.db.schema.getId(matrixdb.THING,matrixdb.NULL_ENTITY_NAME))
+    P = mutil.softmax(None,self.mat,nullId=self.db.schema.getId(matrixdb.THING,'sarah'))
+    scores = {'sarah':-10.0}
+    softmax_normalize(scores)
+    self.assertEqual(self.db.matrixAsSymbolDict(P)[2],scores)
+
+  def testFusedCrossEntropy(self):
+    P,xe,delta = mutil.softmaxCrossEntropy(self.mat,self.Y,self.db.nullId())
+    self.assertEqual((P-mutil.softmax(self.db,self.mat)).nnz,0)
+    self.assertAlmostEqual(xe,learn.Learner.crossEntropy(self.Y,P),delta=1e-4)
+    self.assertAlmostEqual(abs(delta-(self.Y-P)).sum(),0.0,delta=1e-6)
+
+  def testSampledCandidates(self):
+    mat = mutil.stack([self.db.onehot(s)*w for s,w in
+                       [('william',1.0),('poppy',2.0),('rachel',3.0),('sarah',4.0),('lottie',5.0)]])
+    mat = mutil.stack([mutil.rowsum(mat),mutil.rowsum(mat)])
+    Y = mutil.stack([self.db.onehot('william'),self.db.onehot('sarah')])
+    S = mutil.sampleSoftmaxCandidates(mat,Y,2,rng=NR.RandomState(0))
+    d = self.db.matrixAsSymbolDict(S)
+    for i,gold in enumerate(['william','sarah']):
+      # the gold answer is kept and not corrected, plus 2 samples
+      self.assertEqual(len(d[i]),3)
+      self.assertAlmostEqual(d[i][gold],dict(william=1.0,sarah=4.0)[gold])
+      negTotal = 15.0 - d[i][gold]
+      for s,w in [('poppy',2.0),('rachel',3.0),('lottie',5.0),('william',1.0),('sarah',4.0)]:
+        if s in d[i] and s!=gold:
+          self.assertAlmostEqual(d[i][s],w-math.log(min(1.0,2*w/negTotal)),delta=1e-5)
+    # no sampling needed if there are few enough candidates
+    S = mutil.sampleSoftmaxCandidates(mat,Y,10)
+    self.assertEqual((S-mat).nnz,0)
+
+class TestScore(unittest.TestCase):
+
+  def setUp(self):
+    self.prog = program.ProPPRProgram.loadRules(
+        os.path.join(TEST_DATA_DIR,'textcat.ppr'),
+        db=matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts')))
+    self.prog.setFeatureWeights()
+    self.queryFile = os.path.join(TEST_DATA_DIR,'toytest.examples')
+    self.outFile = os.path.join(tempfile.mkdtemp(),'toytest.solutions.txt')
+
+  def testInProcess(self):
+    self.checkScorer(score.Scorer(self.prog,parallel=0,chunkSize=3,topK=1))
+
+  def testPool(self):
+    scorer = score.Scorer(self.prog,parallel=2,chunkSize=3,maxInFlight=1,topK=1)
+    self.checkScorer(scorer)
+    scorer.close()
+
+  def checkScorer(self,scorer):
+    n,qps = scorer.score(self.queryFile,self.outFile)
+    queries = [q for chunk in score.queryChunks(self.queryFile,1000) for q in chunk]
+    self.assertEqual(n,len(queries))
+    lines = [line.strip().split("\t") for line in open(self.outFile)]
+    headers = [parts for parts in lines if parts[0].startswith('#')]
+    answers = [parts for parts in lines if not parts[0].startswith('#')]
+    self.assertEqual(len(headers),n)
+    self.assertEqual(len(answers),n)
+    mode = declare.asMode('predict/io')
+    for k,((_,x),header,answer) in enumerate(zip(queries,headers,answers)):
+      self.assertEqual(header[0],'# proved %d' % (k+1))
+      self.assertEqual(header[1],'predict(%s,X1).' % x)
+      d = self.prog.db.rowAsSymbolDict(self.prog.evalSymbols(mode,[x]))
+      best = max((py,y) for (y,py) in d.items() if y!=matrixdb.NULL_ENTITY_NAME)
+      self.assertEqual(answer[0],'1')
+      self.assertAlmostEqual(float(answer[1]),best[0],delta=1e-5)
+
+class TestServe(unittest.TestCase):
+
+  def setUp(self):
+    self.prog = program.ProPPRProgram.loadRules(
+        os.path.join(TEST_DATA_DIR,'textcat.ppr'),
+        db=matrixdb.MatrixDB.loadFile(os.path.join(TEST_DATA_DIR,'textcattoy.cfacts')))
+    self.prog.setFeatureWeights()
+    self.queryFile = os.path.join(TEST_DATA_DIR,'toytest.examples')
+    self.queries = [q for chunk in score.queryChunks(self.queryFile,1000) for q in chunk]
+
+  def testInProcess(self):
+    self.checkServer(serve.Server(self.prog,workers=0,batchSize=3))
+
+  def testPool(self):
+    self.checkServer(serve.Server(self.prog,workers=2,batchSize=3))
+
+  def testUnixSocket(self):
+    path = os.path.join(tempfile.mkdtemp(),'tensorlog.sock')
+    server = serve.Server(self.prog,workers=0)
+    address = server.startInBackground(path=path)
+    try:
+      client = serve.Client(address)
+      mode,x = self.queries[0]
+      self.assertEqual(client.query(mode,x,topK=2), score.scoreChunk(self.prog,[(mode,x)],2)[0][2])
+      client.close()
+    finally:
+      server.close()
+
+  def testAdmissionControl(self):
+    # the first query waits for a batch to fill, so the second is rejected
+    server = serve.Server(self.prog,workers=0,batchSize=2,batchWait=0.5,maxPending=1)
+    address = server.startInBackground()
+    try:
+      client = serve.Client(address)
+      for k,(mode,x) in enumerate(self.queries[:2]):
+        client.fp.write((json.dumps({'id':k,'mode':str(mode),'x':x}) + '\n').encode('utf-8'))
+      client.fp.flush()
+      responses = dict((r['id'],r) for r in [json.loads(client.fp.readline()) for _ in range(2)])
+      self.assertEqual(responses[1]['error'], 'overloaded')
+      self.assertTrue('answers' in responses[0])
+      client.close()
+    finally:
+      server.close()
+
+  def testPerQueryErrors(self):
+    # evaluation fails for one input, and is never run concurrently
+    db = self.prog.db
+    badX = self.queries[1][1]
+    badId = db.schema.getId(db.schema.getDomain('predict',2),badX)
+    state = {'active':0,'maxActive':0}
+    lock = threading.Lock()
+    evalFun = self.prog.eval
+    def eval(mode,inputs):
+      with lock:
+        state['active'] += 1
+        state['maxActive'] = max(state['maxActive'],state['active'])
+      try:
+        time.sleep(0.001)
+        if inputs[0][:,badId].nnz: raise ValueError('cannot score %s' % badX)
+        return evalFun(mode,inputs)
+      finally:
+        with lock: state['active'] -= 1
+    self.prog.eval = eval
+    server = serve.Server(self.prog,workers=0,batchSize=3,maxInFlight=4)
+    address = server.startInBackground()
+    try:
+      client = serve.Client(address)
+      for k,(mode,x) in enumerate(self.queries):
+        client.fp.write((json.dumps({'id':k,'mode':str(mode),'x':x}) + '\n').encode('utf-8'))
+      client.fp.flush()
+      responses = dict((r['id'],r) for r in [json.loads(client.fp.readline()) for _ in self.queries])
+      for k,(mode,x) in enumerate(self.queries):
+        if x==badX: self.assertEqual(responses[k]['error'], 'cannot score %s' % badX)
+        else: self.assertTrue('answers' in responses[k])
+      client.close()
+      stats = serve.generateLoad(address,self.queries*3,concurrency=4)
+      self.assertEqual(stats['errors'],3*sum(1 for (_,x) in self.queries if x==badX))
+      self.assertEqual(state['maxActive'],1)
+    finally:
+      server.close()
+
+  def checkServer(self,server):
+    address = server.startInBackground()
+    try:
+      client = serve.Client(address)
+      for mode,x in self.queries:
+        expected = score.scoreChunk(self.prog,[(mode,x)],1)[0][2]
+        actual = client.query(mode,x,topK=1)
+        self.assertEqual(len(actual),1)
+        self.assertEqual(actual[0][1],expected[0][1])
+        self.assertAlmostEqual(actual[0][0],expected[0][0],delta=1e-5)
+      self.assertRaises(ValueError, client.query, 'predict/ioo', self.queries[0][1])
+      client.close()
+      stats = serve.generateLoad(address,self.queries*5,concurrency=4)
+      self.assertEqual(stats['answered'],5*len(self.queries))
+      self.assertEqual(stats['errors'],0)
+      self.assertTrue(stats['p50'] <= stats['p99'] <= stats['max'])
+    finally:
+      server.close()
+
+class TestLazyBackends(unittest.TestCase):
+
+  def testSimpleDoesNotImportBackends(self):
+    secs,rss,backends = importtime.importStats('tensorlog.simple')
+    self.assertEqual(backends,[])
+
 class TestTypes(unittest.TestCase):
 
   def setUp(self):
@@ -1109,6 +1848,101 @@ class TestTypes(unittest.TestCase):
     self.testStabs()
     self.testDeclarations()
 
+  def testAddFacts(self):
+    head = self.db.matEncoding[('head',2)]
+    newLines = ['\t'.join(['creator','rxy','cnn']) + '\n', '\t'.join(['rel','rxy','r']) + '\n']
+    self.db.addLines(newLines)
+    # facts are merged when the relation is next used, and only
+    # relations with a new symbol in their types are changed
+    self.assertEqual(sorted(self.db._deltabuf.keys()), [('creator',2),('rel',2)])
+    self.assertTrue(self.db.matEncoding[('head',2)] is head)
+    creator = self.db.matrix(declare.asMode('creator(i,o)'))
+    self.assertEqual(creator.shape, (self.db.dim('triple_t'),self.db.dim('source_t')))
+    self.assertEqual(self.db.rowAsSymbolDict(self.db.onehot('rxy','triple_t')*creator,'source_t'),
+                     {'nyt':1.0,'fox':1.0,'cnn':1.0})
+    self.assertEqual(self.db.matrix(declare.asMode('rel(i,o)'))[self.db.onehot('rxy','triple_t').indices[0]].data[0], 2.0)
+    self.assertTrue(self.db.matEncoding[('head',2)] is head)
+    # merging as soon as the threshold is reached
+    saved = matrixdb.conf.delta_merge_threshold
+    matrixdb.conf.delta_merge_threshold = 1
+    try:
+      self.db.addLines(['\t'.join(['head','rab','z']) + '\n'])
+    finally:
+      matrixdb.conf.delta_merge_threshold = saved
+    self.assertFalse(self.db._deltabuf)
+    # the result is the same as loading all the facts at once
+    db2 = matrixdb.MatrixDB(initSchema=dbschema.TypedSchema())
+    db2.addLines(self.testLines + newLines + ['\t'.join(['head','rab','z']) + '\n'])
+    self.assertEqual(self.db.size(), db2.size())
+    for key in db2.matEncoding:
+      self.assertEqual(abs(self.db.matEncoding[key] - db2.matEncoding[key]).max(), 0.0)
+
+  def testCompactSymbols(self):
+    saved = dbschema.conf.compact_symbols
+    dbschema.conf.compact_symbols = True
+    try:
+      self.db = matrixdb.MatrixDB(initSchema=dbschema.TypedSchema())
+      self.db.addLines(self.testLines)
+    finally:
+      dbschema.conf.compact_symbols = saved
+    schema = self.db.schema
+    self.assertTrue(isinstance(schema._stab['entity_t'],dbschema.CompactSymbolTable))
+    self.testStabs()
+    stab = schema._stab['source_t']
+    self.assertEqual(list(stab.getIds(['fox','cnn','nyt'])), [4,0,3])
+    self.assertEqual(list(stab.extend(['cnn','bbc'])), [5,6])
+    self.assertEqual(stab.getId('bbc'), 6)
+    self.assertEqual(stab.getSymbol(5), 'cnn')
+    self.assertFalse(stab.hasId('abc'))
+    # the symbol text is still written, and the tables are memory-mapped back
+    direc = tempfile.mkdtemp()
+    schema.serialize(direc)
+    schema2 = dbschema.AbstractSchema.deserialize(direc)
+    self.assertTrue(isinstance(schema2._stab['source_t']._slots,NP.memmap))
+    self.assertEqual(schema2._stab['source_t'].getSymbolList(), stab.getSymbolList())
+    self.assertEqual(schema2.getId('source_t','abc'), 7)
+    self.assertEqual(schema._stab['source_t'].getMaxId(), 6)
+    with open(os.path.join(direc,'typed-symbols.txt')) as fp:
+      schema3 = dbschema.TypedSchema.deserializeFrom(fp)
+    self.assertTrue(isinstance(schema3._stab['source_t'],dbschema.SymbolTable))
+    self.assertEqual(schema3._stab['source_t'].getSymbolList(), stab.getSymbolList())
+
+  def testParallelLoad(self):
+    direc = tempfile.mkdtemp()
+    typedFile = os.path.join(direc,'typed.cfacts.gz')
+    with util.openFile(typedFile,'w') as fp:
+      fp.writelines(self.testLines)
+    famFile = os.path.join(TEST_DATA_DIR,'fam.cfacts')
+    # lines with weights, bad weights and undeclared relations are
+    # read the same way by both loaders
+    oddFile = os.path.join(direc,'odd.cfacts')
+    with open(oddFile,'w') as fp:
+      fp.writelines(['# :- pos(doc_t)\n', '# :- link(doc_t,doc_t)\n',
+                     'pos\td1\t0.5\n', 'pos\td2\t-1\n', 'link\td1\td2\n', 'link\td2\td3\t0.3\n',
+                     'link\td3\td1\t-3\n', 'odd\td4\t2.0\n', 'odd\td4\td5\n', 'pos\td6\tx\ty\n'])
+    saved = matrixdb.conf.load_chunk_bytes
+    # split fam.cfacts into several pieces
+    matrixdb.conf.load_chunk_bytes = 100
+    try:
+      db = matrixdb.MatrixDB.loadFile(oddFile,workers=3)
+      self.assertEqual(db.rowAsSymbolDict(db.matEncoding[('pos',1)],'doc_t'), {'d1':0.5})
+      self.assertEqual(db.matEncoding[('link',2)].nnz, 2)
+      for filenames in [typedFile, famFile, os.path.join(TEST_DATA_DIR,'textcattoy3.cfacts'), oddFile]:
+        db1 = matrixdb.MatrixDB.loadFile(filenames,workers=1)
+        db2 = matrixdb.MatrixDB.loadFile(filenames,workers=3)
+        self.assertEqual(sorted(db1.matEncoding.keys()), sorted(db2.matEncoding.keys()))
+        self.assertEqual(db1.paramSet, db2.paramSet)
+        for typeName in db1.schema.getTypes():
+          self.assertEqual(db1.schema._stab[typeName].getSymbolList(), db2.schema._stab[typeName].getSymbolList())
+        for key in db1.matEncoding:
+          self.assertEqual(db1.matEncoding[key].shape, db2.matEncoding[key].shape)
+          self.assertEqual((db1.matEncoding[key] != db2.matEncoding[key]).nnz, 0)
+    finally:
+      matrixdb.conf.load_chunk_bytes = saved
+    self.db = matrixdb.MatrixDB.loadFile(typedFile,workers=2)
+    self.testStabs()
+    self.testDeclarations()
+
 
   def testUntypedSerialization(self):
     db = matrixdb.MatrixDB()
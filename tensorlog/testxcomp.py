@@ -35,6 +35,7 @@ from tensorlog import testtensorlog
 from tensorlog import funs
 from tensorlog import ops
 from tensorlog import learnxcomp as learnxc
+from tensorlog import scipyxcomp
 from tensorlog.expt import Expt
 
 if xctargets.tf:
@@ -53,9 +54,14 @@ if xctargets.tf:
   for c in [
     tensorflowxcomp.DenseMatDenseMsgCrossCompiler,
     tensorflowxcomp.SparseMatDenseMsgCrossCompiler,
+    tensorflowxcomp.SparseMatSparseMsgCrossCompiler,
+    tensorflowxcomp.HybridMatDenseMsgCrossCompiler,
     ]:
     TESTED_COMPILERS.append(c)
     TESTED_LEARNERS[c]=tensorflowxcomp.FixedRateGDLearner
+# needs no backend beyond scipy, so it is always tested
+TESTED_COMPILERS.append(scipyxcomp.SciPyCrossCompiler)
+TESTED_LEARNERS[scipyxcomp.SciPyCrossCompiler]=scipyxcomp.FixedRateGDLearner
     
 RUN_OLD_INFERENCE_TESTS = False
 SAVE_SUMMARIES = False
@@ -1263,12 +1269,141 @@ class TestPlugins(unittest.TestCase):
     self.assertTrue(acc1>=0.9)
     session.close()
 
+class TestSciPyXC(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(testtensorlog.TEST_DATA_DIR,"textcattoy3.cfacts"))
+    self.dset = dataset.Dataset.loadExamples(self.db,os.path.join(testtensorlog.TEST_DATA_DIR,"toytrain.exam"),proppr=False)
+    self.mode = self.dset.modesToLearn()[0]
+
+  def loadProg(self,ruleStrings,plugins=None):
+    prog = program.ProPPRProgram(rules=testtensorlog.rules_from_strings(ruleStrings),db=self.db,plugins=plugins)
+    prog.setAllWeights()
+    return prog
+
+  def testMatchesNativeEval(self):
+    prog = self.loadProg(['predict(X,Pos) :- assign(Pos,pos,label) {weighted(F): hasWord(X,W),posPair(W,F)}.',
+                          'predict(X,Neg) :- assign(Neg,neg,label) {weighted(F): hasWord(X,W),negPair(W,F)}.'])
+    xc = scipyxcomp.SciPyCrossCompiler(prog)
+    X = self.dset.getX(self.mode)
+    P = xc.inferenceFunction(self.mode)(X)
+    P0 = prog.eval(self.mode,[X])
+    self.assertTrue(abs(P-P0).max() < 1e-6)
+    # each row can also be evaluated alone
+    P1 = xc.inferenceFunction(self.mode)(X[0])
+    self.assertTrue(abs(P1-P0[0]).max() < 1e-6)
+    # constants are bound outside the generated functions
+    src = xc.source(self.mode)
+    self.assertTrue(src.startswith('def _bind(_consts,_params):'))
+    self.assertTrue('_consts' not in src.split('def proofCount')[1])
+
+  def testPluginLearning(self):
+    plugins = program.Plugins()
+    plugins.define('double/io', lambda x:2*x, lambda inputType:inputType)
+    prog = self.loadProg(['predict(X,Pos) :- assign(Pos,pos,label) {weighted(F): hasWord(X,W),double(W,W2),posPair(W2,F)}.',
+                          'predict(X,Neg) :- assign(Neg,neg,label) {weighted(F2): hasWord(X,W),negPair(W,F),double(F,F2)}.'],
+                         plugins=plugins)
+    xc = scipyxcomp.SciPyCrossCompiler(prog)
+    learner = scipyxcomp.FixedRateGDLearner(prog,xc=xc,epochs=10,rate=0.1)
+    X,Y = self.dset.getX(self.mode),self.dset.getY(self.mode)
+    lossFun = xc.dataLossFunction(self.mode)
+    acc0 = learner.accuracy(Y,learner.predict(self.mode,X))
+    loss0 = lossFun(X,Y)
+    learner.trainMode(self.mode,X,Y)
+    acc1 = learner.accuracy(Y,learner.predict(self.mode,X))
+    self.assertTrue(lossFun(X,Y) < loss0)
+    self.assertTrue(acc0 < 0.6)
+    self.assertTrue(acc1 >= 0.9)
+
+class TestHybridPlacement(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(testtensorlog.TEST_DATA_DIR,"textcattoy3.cfacts"))
+    self.dset = dataset.Dataset.loadExamples(self.db,os.path.join(testtensorlog.TEST_DATA_DIR,"toytrain.exam"),proppr=False)
+    self.mode = self.dset.modesToLearn()[0]
+    self.prog = program.ProPPRProgram(
+        rules=testtensorlog.rules_from_strings(['predict(X,Pos) :- assign(Pos,pos,label) {weighted(F): hasWord(X,W),posPair(W,F)}.']),
+        db=self.db)
+    self.prog.setAllWeights()
+    self.saved = (tensorflowxcomp.conf.denseMaxCells,tensorflowxcomp.conf.denseSmallCells) if xctargets.tf else None
+
+  def tearDown(self):
+    if self.saved:
+      tensorflowxcomp.conf.denseMaxCells,tensorflowxcomp.conf.denseSmallCells = self.saved
+
+  @unittest.skipUnless(xctargets.tf,"Tensorflow not available")
+  def testPlacement(self):
+    X = self.dset.getX(self.mode)
+    P0 = self.prog.eval(self.mode,[X])
+    footprint = {}
+    for maxCells,smallCells in [(0,0),(10**9,10**9)]:
+      tensorflowxcomp.conf.denseMaxCells = maxCells
+      tensorflowxcomp.conf.denseSmallCells = smallCells
+      xc = tensorflowxcomp.HybridMatDenseMsgCrossCompiler(self.prog)
+      P = xc.inferenceFunction(self.mode)(X)
+      self.assertTrue(abs(P-P0).max() < 1e-5)
+      placed = set(xc.placement.values())
+      self.assertEqual(placed, set(['sparse']) if maxCells==0 else set(['dense']))
+      footprint[maxCells] = xc.memoryFootprint()
+      close_cross_compiler(xc)
+    # hasWord and posPair are mostly zeros
+    self.assertTrue(footprint[0] < footprint[10**9])
+
+class TestSparseMessages(unittest.TestCase):
+
+  def setUp(self):
+    self.db = matrixdb.MatrixDB.loadFile(os.path.join(testtensorlog.TEST_DATA_DIR,"textcattoy3.cfacts"))
+    self.dset = dataset.Dataset.loadExamples(self.db,os.path.join(testtensorlog.TEST_DATA_DIR,"toytrain.exam"),proppr=False)
+    self.mode = self.dset.modesToLearn()[0]
+    self.prog = program.ProPPRProgram(
+        rules=testtensorlog.rules_from_strings(['predict(X,Pos) :- assign(Pos,pos,label) {weighted(F): hasWord(X,W),posPair(W,F)}.']),
+        db=self.db)
+    self.prog.setAllWeights()
+
+  @unittest.skipUnless(xctargets.tf,"Tensorflow not available")
+  def testSparseInput(self):
+    X,Y = self.dset.getX(self.mode),self.dset.getY(self.mode)
+    xc = tensorflowxcomp.SparseMatSparseMsgCrossCompiler(self.prog)
+    P = xc.inferenceFunction(self.mode)(X)
+    self.assertTrue(abs(P-self.prog.eval(self.mode,[X])).max() < 1e-5)
+    # the input is multiplied by hasWord without being densified
+    x = xc.getInputPlaceholder(self.mode)
+    self.assertFalse(any(sparse is x for (sparse,_) in xc.densified.values()))
+    # and gradients flow through the sparse product
+    lossFun = xc.dataLossFunction(self.mode)
+    loss0 = lossFun(X,Y)
+    xc.optimizeDataLoss(self.mode,tf.train.GradientDescentOptimizer(learning_rate=0.1),X,Y,epochs=10)
+    self.assertTrue(lossFun(X,Y) < loss0)
+    close_cross_compiler(xc)
+
+class TestInputPipeline(unittest.TestCase):
+
+  @unittest.skipUnless(xctargets.tf,"Tensorflow not available")
+  def testPipelineTraining(self):
+    tlog = simple.Compiler(
+        db=os.path.join(testtensorlog.TEST_DATA_DIR,"textcattoy3.cfacts"),
+        prog=os.path.join(testtensorlog.TEST_DATA_DIR,"textcat3.ppr"))
+    trainData = dataset.Dataset.loadExamples(tlog.db,os.path.join(testtensorlog.TEST_DATA_DIR,"toytrain.exam"),proppr=False)
+    mode = trainData.modesToLearn()[0]
+    X,Y = trainData.getX(mode),trainData.getY(mode)
+    for compilerClass in [tensorflowxcomp.SparseMatDenseMsgCrossCompiler,
+                          tensorflowxcomp.SparseMatSparseMsgCrossCompiler]:
+      xc = compilerClass(tlog.prog)
+      pipeline = xc.inputPipeline(mode,trainData,minibatchSize=3,epochs=20)
+      xc.compileFromPipeline(mode,pipeline)
+      lossFun = xc.dataLossFunction(mode)
+      loss0 = lossFun(X,Y)
+      optimizer = tf.train.GradientDescentOptimizer(learning_rate=0.1)
+      n = xc.optimizeDataLossFromPipeline(mode,optimizer)
+      self.assertEqual(n, 20*((X.shape[0]+2)//3))
+      self.assertTrue(lossFun(X,Y) < loss0)
+      close_cross_compiler(xc)
 
 if __name__ == "__main__":
   logging.basicConfig(level=logging.INFO)
 
   # default is to test on everything adding command line arguments
-  # 'tensorflow' 'theano' 'sparse' 'dense' filters the list (so
+  # 'tensorflow' 'theano' 'scipy' 'sparse' 'dense' filters the list (so
   # 'testxcomp.py tensorflow sparse' will run just
   # tensorflowxcomp.SparseMatDenseMsgCrossCompiler)
 
@@ -1276,11 +1411,13 @@ if __name__ == "__main__":
     TESTED_COMPILERS = [c for c in TESTED_COMPILERS if c.__module__.endswith("theanoxcomp")]
   if 'tensorflow' in sys.argv[1:]:
     TESTED_COMPILERS = [c for c in TESTED_COMPILERS if c.__module__.endswith("tensorflowxcomp")]
+  if 'scipy' in sys.argv[1:]:
+    TESTED_COMPILERS = [c for c in TESTED_COMPILERS if c.__module__.endswith("scipyxcomp")]
   if 'dense' in sys.argv[1:]:
     TESTED_COMPILERS = [c for c in TESTED_COMPILERS if c.__name__.startswith("Dense")]
   if 'sparse' in sys.argv[1:]:
     TESTED_COMPILERS = [c for c in TESTED_COMPILERS if c.__name__.startswith("Sparse")]
-  sys.argv = [a for a in sys.argv if a not in "theano tensorflow dense sparse".split()]
+  sys.argv = [a for a in sys.argv if a not in "theano tensorflow scipy dense sparse".split()]
   print('TESTED_COMPILERS',TESTED_COMPILERS)
   
   unittest.main()
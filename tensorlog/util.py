@@ -1,4 +1,7 @@
 import os
+import bz2
+import gzip
+import lzma
 import inspect
 
 # misc utilities
@@ -18,11 +21,30 @@ def memusage():
     except IOError:
         return 0.0
 
+# openers for compressed files, by extension
+COMPRESSED_OPENERS = {'.gz':gzip.open, '.bz2':bz2.open, '.xz':lzma.open}
+
+def isCompressed(filename):
+  """ True if the file will be decompressed by openFile
+  """
+  return os.path.splitext(filename)[1] in COMPRESSED_OPENERS
+
+def openFile(filename,mode='r'):
+  """ Open a file, decompressing it if its name ends in .gz, .bz2 or .xz.
+  The mode is 'r', 'w' or 'a' for text, or 'rb', 'wb' or 'ab' for bytes.
+  """
+  opener = COMPRESSED_OPENERS.get(os.path.splitext(filename)[1])
+  if opener is None:
+    return open(filename,mode)
+  if 'b' not in mode: mode += 't'
+  return opener(filename,mode)
+
 def linesIn(fileLike):
   """ If fileLike is a string, open it as a file and return lines in the file.
   Otherwise, just call fileLike's iterator method and iterate over that.
   Thus, you can use open file handles or strings as arguments to a function f if
-  it accesses its arguments thru linesIn:
+  it accesses its arguments thru linesIn.  Compressed files are opened
+  with openFile, so they are decompressed as they are read:
 
   def f(fileLikeInput,....):
     ...
@@ -31,7 +53,7 @@ def linesIn(fileLike):
 
   """
   if isinstance(fileLike,str):
-    with open(fileLike) as fp:
+    with openFile(fileLike) as fp:
       for line in fp:
         yield line
   else:
@@ -523,7 +523,7 @@ class AbstractCrossCompiler(object):
     return (X,Y) if wrapped else (self._wrapMsg(X),self._wrapMsg(Y))
 
   def _ensureUnwrapped(self,X,Y,wrapped):
-    return (X,Y) if not wrapped else (self._unwrapOutput(X),self._unwrapOutput(Y))
+    return (X,Y) if not wrapped else (self.unwrapInput(X),self.unwrapInput(Y))
   #
   # subclasses should implement these
   #
@@ -1,14 +1,31 @@
-# collect available target languages:
-try:
-  import tensorflow as private1
-  tf=True
-except:
-  tf=False
-try:
-  import theano as private2
-  theano=True
-except:
-  theano=False
+# collect available target languages.  This only checks that the
+# packages can be found, without importing them, since importing
+# tensorflow or theano takes several seconds and a lot of memory:
+# use load() to import the cross-compiler for a target when it is
+# first needed.
+import importlib
+import importlib.util
+
+def _installed(packageName):
+  try:
+    return importlib.util.find_spec(packageName) is not None
+  except (ImportError,ValueError):
+    return False
+
+tf=_installed('tensorflow')
+theano=_installed('theano')
 # disable theano tests for now, some of them fail and it's not a
 # priority...
 theano=False
+
+# modules holding the cross-compilers for each target
+XCOMP_MODULES = {'tensorflow':'tensorlog.tensorflowxcomp', 'theano':'tensorlog.theanoxcomp', 'scipy':'tensorlog.scipyxcomp'}
+
+def load(target):
+  """Import and return the cross-compiler module for a target,
+  'tensorflow', 'theano' or 'scipy'.  The scipy target needs nothing
+  beyond tensorlog's own dependencies, so it is always available."""
+  assert target in XCOMP_MODULES,'illegal target %r: valid targets are "tensorflow", "theano" and "scipy"' % target
+  available = {'tensorflow':tf, 'theano':theano, 'scipy':True}[target]
+  assert available, "%s not available" % target
+  return importlib.import_module(XCOMP_MODULES[target])